@@ -0,0 +1,113 @@
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, List, Tuple, Type
+
+from game.prompt_helpers import (
+    generate_functions_from_actions,
+    generate_tools_from_actions,
+)
+from schema import Action, ActionCompletion, ArgumentError
+
+_PYTHON_TYPES: Dict[str, Tuple[Type[Any], ...]] = {
+    "number": (int, float),
+    "string": (str,),
+    "boolean": (bool,),
+}
+
+
+@dataclass(frozen=True)
+class _ParameterValidator:
+    name: str
+    type_name: str
+    types: Tuple[Type[Any], ...]
+    enum: FrozenSet[str]
+
+    def validate(self, value: Any) -> List[ArgumentError]:
+        # bool is a subclass of int, but True isn't a number.
+        if not isinstance(value, self.types) or (
+            isinstance(value, bool) and self.type_name != "boolean"
+        ):
+            return [
+                ArgumentError(
+                    parameter=self.name,
+                    kind="type",
+                    message=f"Expected a {self.type_name}, got {value!r}.",
+                )
+            ]
+        if self.enum and str(value) not in self.enum:
+            return [
+                ArgumentError(
+                    parameter=self.name,
+                    kind="enum",
+                    message=f"{value!r} is not one of {sorted(self.enum)}.",
+                )
+            ]
+        return []
+
+
+class ActionRegistry:
+    """The actions of one AgentDef, compiled once: the tool payloads sent to the
+    LLM and validators for the arguments it returns. Rebuild it when the AgentDef
+    changes."""
+
+    def __init__(self, actions: List[Action]):
+        self.functions = generate_functions_from_actions(actions)
+        self.tools = generate_tools_from_actions(actions)
+        self._validators: Dict[str, Tuple[_ParameterValidator, ...]] = {
+            action.name: tuple(
+                _ParameterValidator(
+                    name=parameter.name,
+                    type_name=parameter.type,
+                    types=_PYTHON_TYPES[parameter.type],
+                    enum=frozenset(parameter.enum),
+                )
+                for parameter in action.parameters
+            )
+            for action in actions
+        }
+        self._parameter_names: Dict[str, FrozenSet[str]] = {
+            action.name: frozenset(parameter.name for parameter in action.parameters)
+            for action in actions
+        }
+
+    def validate(self, completion: ActionCompletion) -> ActionCompletion:
+        """Returns `completion` with `errors` describing every way its arguments
+        don't match the action's parameters."""
+        if completion.errors:
+            return completion
+
+        validators = self._validators.get(completion.action)
+        if validators is None:
+            completion.errors = [
+                ArgumentError(
+                    kind="unknown_action",
+                    message=f"{completion.action} is not an action of this agent.",
+                )
+            ]
+            return completion
+
+        errors: List[ArgumentError] = []
+        for validator in validators:
+            if validator.name not in completion.args:
+                errors.append(
+                    ArgumentError(
+                        parameter=validator.name,
+                        kind="missing",
+                        message=f"{validator.name} is required.",
+                    )
+                )
+                continue
+            errors += validator.validate(completion.args[validator.name])
+
+        known = self._parameter_names[completion.action]
+        errors += [
+            ArgumentError(
+                parameter=name,
+                kind="unexpected",
+                message=f"{name} is not a parameter of {completion.action}.",
+            )
+            for name in completion.args
+            if name not in known
+        ]
+
+        completion.errors = errors
+        return completion
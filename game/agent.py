@@ -1,52 +1,87 @@
+import itertools
 import logging
 import asyncio
-from typing import List, Optional, Tuple, Union
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
 import re
-import numpy as np
 
 from pydantic import UUID4
 
+from game.actions import ActionRegistry
+from game.guardrail import GuardrailPrefilter
+from game.keywords import parse_citations, strip_citations
 from game.memory import GenAgentMemory
 from game.prompt_helpers import (
+    CompiledPrompt,
+    batch_ratings_to_ints,
     clean_response,
-    generate_functions_from_actions,
-    generate_tools_from_actions,
+    format_transcript,
     get_action_messages,
+    get_batch_guardrail_messages,
+    get_batch_query_messages,
+    get_batch_rate_function,
     get_chat_messages,
+    get_conversation_summary_message,
     get_guardrail_query,
     get_interact_messages,
     get_query_messages,
     get_rate_function,
+    get_suggestion_function,
+    get_suggestion_messages,
     rating_to_int,
+    suggestions_to_messages,
 )
-from llm.openai import OpenAIInterface
+from game.summarizer import ConversationSummarizer
+from llm.base import LLMBase
 
 #from openai.embeddings_utils import cosine_similarity
 
 from schema import ActionCompletion, Conversation, Knowledge, Memory, Message
 
+_SENTENCE_DELIMITERS = re.compile(r"[,.!?，。！？]")
+_LORE_ATTRIBUTION_THRESHOLD = 0.9
+
 
 class GenAgent:
     def __init__(
         self,
         knowledge: Knowledge,
+        llm: LLMBase,
         memory: GenAgentMemory,
+        summarizer: Optional[ConversationSummarizer] = None,
+        guardrail_prefilter: Optional[GuardrailPrefilter] = None,
     ):
         """Should never be called directly. Use create() instead."""
+        self._llm = llm
         self._memory = memory
+        self._summarizer = summarizer
+        self._guardrail_prefilter = guardrail_prefilter
         self._conversation_history: List[Message] = []
+        self._conversation_summary = ""
+        self._summary_task: Optional["asyncio.Task[None]"] = None
         self._knowledge = knowledge
         self._conversation_context = Conversation()
+        self._compiled_prompt: Optional[CompiledPrompt] = None
+        self._actions = ActionRegistry(knowledge.agent_def.actions)
 
     @classmethod
     async def create(
-        cls, knowledge: Knowledge, memory: GenAgentMemory
+        cls,
+        knowledge: Knowledge,
+        llm: LLMBase,
+        memory: GenAgentMemory,
+        summarizer: Optional[ConversationSummarizer] = None,
+        guardrail_prefilter: Optional[GuardrailPrefilter] = None,
+        fill_memories: bool = True,
     ):
-        agent = cls(knowledge, memory)
-        await agent._fill_memories()
+        """When not `fill_memories`, the agent starts without its lore, e.g. to
+        restore a saved agent with restore_conversation() and add_memories()."""
+        agent = cls(knowledge, llm, memory, summarizer, guardrail_prefilter)
+        if fill_memories:
+            await agent.fill_memories()
         return agent
 
-    async def _fill_memories(self):
+    async def fill_memories(self):
+        """Adds the agent's lore to its memories, for agents created without."""
         initial_memories = [
             lore.memory
             for lore in self._knowledge.shared_lore
@@ -58,8 +93,31 @@ class GenAgent:
 
         initial_memories += self._knowledge.agent_def.personal_lore
 
-        awaitables = [self._memory.add_memory(memory) for memory in initial_memories]
-        await asyncio.gather(*awaitables)
+        await self._memory.add_memories(initial_memories)
+
+    @property
+    def _prompt(self) -> CompiledPrompt:
+        if self._compiled_prompt is None:
+            self._compiled_prompt = CompiledPrompt(
+                self._knowledge, self._conversation_context
+            )
+        return self._compiled_prompt
+
+    @property
+    def memory(self) -> GenAgentMemory:
+        return self._memory
+
+    @property
+    def conversation_context(self) -> Conversation:
+        return self._conversation_context
+
+    @property
+    def conversation_history(self) -> List[Message]:
+        return self._conversation_history
+
+    @property
+    def conversation_summary(self) -> str:
+        return self._conversation_summary
 
     @property
     def uuid(self) -> UUID4:
@@ -84,24 +142,32 @@ class GenAgent:
             self._knowledge,
             self._conversation_context,
             memories,
-            self._conversation_history,
+            self._prompt_history(),
+            self._prompt,
         )
 
         self._debugMessage(messages)
 
-        openAI = OpenAIInterface()
-
-        tools = generate_tools_from_actions(self._knowledge.agent_def.actions)
-        completion = await openAI.completion(messages, tools)
+        completion = await self._llm.completion(messages, self._actions.tools)
+        if isinstance(completion, ActionCompletion):
+            completion = self._actions.validate(completion)
 
         if isinstance(completion, Message):
-            self._conversation_history.append(clean_response(self.name, completion))
-            # process each message in messages
-            completion.content = self._processKeywords(completion.content, memories)
+            completion = clean_response(self.name, completion)
+            self._conversation_history.append(completion.copy())
+            await self._processLore(completion)
+            self._processKeywords(completion)
 
+        self._maybe_summarize()
         return completion, messages
 
-    async def chat(self, message: str) -> Tuple[Message, List[Message]]:
+    async def chat(
+        self,
+        message: str,
+        on_token: Optional[Callable[[str], Awaitable[None]]] = None,
+    ) -> Tuple[Message, List[Message]]:
+        """Responds to `message`. With `on_token`, the completion is streamed to
+        it as it's generated, before the response is cleaned up."""
         self._conversation_history.append(Message(role="user", content=message))
 
         memories = await self._queryMemories(message)
@@ -110,17 +176,63 @@ class GenAgent:
             self._knowledge,
             self._conversation_context,
             memories,
-            self._conversation_history,
+            self._prompt_history(),
+            self._prompt,
         )
 
-        openAI = OpenAIInterface()
+        if on_token:
+            tokens: List[str] = []
+            async for token in self._llm.chat_completion_stream(messages):
+                tokens.append(token)
+                await on_token(token)
+            response = Message(role="assistant", content="".join(tokens))
+        else:
+            response = await self._llm.chat_completion(messages)
+
+        completion = clean_response(self.name, response)
+        self._conversation_history.append(completion.copy())
+        await self._processLore(completion)
+        self._processKeywords(completion)
+
+        self._maybe_summarize()
+        return completion, messages
 
-        completion = await openAI.chat_completion(messages)
-        # process each message in messages
-        completion.content = self._processKeywords(completion.content, memories)
+    async def suggest(
+        self, message: Optional[str], count: int, guardrail: bool = False
+    ) -> Tuple[List[Message], List[int], List[Message]]:
+        """Up to `count` alternative next lines for the agent, from a single
+        completion, e.g. reply options for a playable character. Unlike chat(),
+        neither `message` nor the suggestions are added to the conversation.
 
-        self._conversation_history.append(clean_response(self.name, completion))
-        return completion, messages
+        When `guardrail`, the suggestions are also rated with guardrail_many();
+        otherwise the ratings are empty."""
+        history = list(self._prompt_history())
+        if message:
+            history.append(Message(role="user", content=message))
+
+        memories = await self._queryMemories(message)
+
+        messages = get_suggestion_messages(
+            self._knowledge,
+            self._conversation_context,
+            memories,
+            history,
+            count,
+            self._prompt,
+        )
+
+        completion = await self._llm.structured_completion(
+            messages, get_suggestion_function(count)
+        )
+        suggestions = suggestions_to_messages(self.name, completion, count)
+
+        ratings: List[int] = []
+        if guardrail and suggestions:
+            ratings = await self.guardrail_many(
+                [suggestion.content for suggestion in suggestions]
+            )
+
+        return suggestions, ratings, messages
 
     async def act(
         self, message: Optional[str]
@@ -134,155 +246,194 @@ class GenAgent:
             self._knowledge,
             self._conversation_context,
             memories,
-            self._conversation_history,
-        )
-        functions = generate_functions_from_actions(self._knowledge.agent_def.actions)
-
-        openAI = OpenAIInterface()
-
-        return (
-            await openAI.action_completion(messages, functions),
-            messages,
+            self._prompt_history(),
+            self._prompt,
         )
+        action = await self._llm.action_completion(messages, self._actions.functions)
+        if action:
+            action = self._actions.validate(action)
+        self._maybe_summarize()
+        return action, messages
 
-    async def query(self, queries: List[str]) -> List[int]:
+    async def query(self, queries: List[str], batched: bool = True) -> List[int]:
         """Returns a numerical answer to queries into the Agent's
         thoughts and emotions. 1 = not at all, 5 = extremely
-        Ex. How happy are you given this conversation? -> 3 (moderately)"""
+        Ex. How happy are you given this conversation? -> 3 (moderately)
+
+        When `batched`, all queries are asked in a single completion. Queries the
+        batched completion fails to answer are retried one prompt per query."""
         memories = await asyncio.gather(
             *[self._queryMemories(query) for query in queries]
         )
 
+        ratings = [-1] * len(queries)
+        if batched and len(queries) > 1:
+            ratings = await self._batch_query(queries, memories)
+
+        failed = [index for index, rating in enumerate(ratings) if rating == -1]
+        if not failed:
+            return ratings
+
         query_messages = get_query_messages(
             self._knowledge,
             self._conversation_context,
-            memories,
-            self._conversation_history,
-            queries,
+            [memories[index] for index in failed],
+            self._prompt_history(),
+            [queries[index] for index in failed],
+            self._prompt,
         )
 
-        functions = [get_rate_function()]
-        openAI = OpenAIInterface()
+        rate_function = get_rate_function()
         awaitables = [
-            openAI.action_completion(msgs, functions)
+            self._llm.structured_completion(msgs, rate_function)
             for msgs in query_messages
         ]
-        ratings = await asyncio.gather(*awaitables)
+        completions = await asyncio.gather(*awaitables)
+
+        for index, completion in zip(failed, completions):
+            ratings[index] = rating_to_int(completion)
+
+        return ratings
 
-        return [rating_to_int(rating) for rating in ratings]
+    async def _batch_query(
+        self, queries: List[str], memories: List[List[Memory]]
+    ) -> List[int]:
+        unique_memories: Dict[str, Memory] = {}
+        for memory in itertools.chain.from_iterable(memories):
+            unique_memories.setdefault(memory.description, memory)
+
+        messages = get_batch_query_messages(
+            self._knowledge,
+            self._conversation_context,
+            list(unique_memories.values()),
+            self._prompt_history(),
+            queries,
+            self._prompt,
+        )
+
+        completion = await self._llm.structured_completion(
+            messages, get_batch_rate_function(len(queries))
+        )
+
+        return batch_ratings_to_ints(completion, len(queries))
 
     async def guardrail(self, message: str) -> int:
         """Is `message` something that the LLM thinks the GenAgent might say?
         Useful for playable characters and not letting players say inappropriate or
         anachronistic things.
+
+        Lines the guardrail prefilter can rate locally skip the LLM.
         """
+        if self._guardrail_prefilter:
+            rating = await self._guardrail_prefilter.rate(message)
+            if rating is not None:
+                return rating
+
+        return await self._llm_guardrail(message)
+
+    async def guardrail_many(self, messages: List[str]) -> List[int]:
+        """guardrail() for several candidate lines, e.g. the options of a dialogue
+        menu. Lines the prefilter can't rate are asked in a single completion and
+        any it fails to answer are retried one prompt per line. Ratings are in the
+        order of `messages`."""
+        ratings: List[Optional[int]] = [None] * len(messages)
+        if self._guardrail_prefilter:
+            ratings = await self._guardrail_prefilter.rate_many(messages)
+
+        undecided = [index for index, rating in enumerate(ratings) if rating is None]
+        if len(undecided) > 1:
+            batch_messages = get_batch_guardrail_messages(
+                self._knowledge,
+                self._conversation_context,
+                self._prompt_history(),
+                [messages[index] for index in undecided],
+                self._prompt,
+            )
+            completion = await self._llm.structured_completion(
+                batch_messages, get_batch_rate_function(len(undecided))
+            )
+            for index, rating in zip(
+                undecided, batch_ratings_to_ints(completion, len(undecided))
+            ):
+                if rating != -1:
+                    ratings[index] = rating
+
+        failed = [index for index, rating in enumerate(ratings) if rating is None]
+        for index, rating in zip(
+            failed,
+            await asyncio.gather(
+                *[self._llm_guardrail(messages[index]) for index in failed]
+            ),
+        ):
+            ratings[index] = rating
+
+        return [rating if rating is not None else -1 for rating in ratings]
+
+    async def _llm_guardrail(self, message: str) -> int:
         guardrail_query = get_guardrail_query(self._knowledge, message)
 
         query_messages = get_query_messages(
             self._knowledge,
             self._conversation_context,
             [[]],
-            self._conversation_history,
+            self._prompt_history(),
             [guardrail_query],
+            self._prompt,
         )
 
-        functions = [get_rate_function()]
-        openAI = OpenAIInterface()
-        completion = await openAI.action_completion(
-            query_messages[0], functions
+        completion = await self._llm.structured_completion(
+            query_messages[0], get_rate_function()
         )
 
         return rating_to_int(completion)
-    
-    def _processKeywords(
-            self, 
-            message:str,
-            memorys:List[Memory]
-        ) -> str:
-    
-        for memory in memorys:
-            if memory.keywords is None:
-                continue
-            
-            for keyword in memory.keywords:
-                if keyword in message:
-                    message = message.replace(keyword, '[keyword]' + keyword + '[/keyword]')
-
-        return message
-    
-    async def _processMessage(
-            self,
-            content:str
-        ):
-        # TODO: this is a hacky way to do this, but it works for now
-        sentances = re.split(r'([,.I?，。！？])', content)
-        # sentances:List[str] = []
-        # sentances.append(content)
-
-        for msg in sentances:
-
-            # msg is too short to be a meanning full sentance
-            if len(msg) <= 3:
-                continue
-
-            logger = logging.getLogger()
-            logger.debug('Sentence:' + msg)
-            #get embed of this msg from llm
-            openAI = OpenAIInterface()
-            msg_embed = await openAI.embed(msg)
-
-            retrived_memories:List[Memory] = []
-            retrived_memories = await self._memory.retrieve_relevant_memories(
-                [Memory(description=msg, embedding=msg_embed)], 
-                self._conversation_context.memories_to_include
-                )
 
-            for memory in retrived_memories:
-
-                if memory.embedding is None:
-                    memory.embedding = await openAI.embed(memory.description)
-
-                similarity = self._cosineSimilarity(memory.embedding, msg_embed)
-                distance = self._distanceFromEmbedding(memory.embedding, msg_embed)
+    def _processKeywords(self, message: Message) -> None:
+        """Tags the keywords of the agent's memories in `message` and collects the
+        memories it cites."""
+        message.memory_ids = parse_citations(message.content)
+        message.content = self._memory.keyword_annotator.annotate(message.content)
+
+    async def _processLore(self, message: Message) -> None:
+        """Collects the client IDs of the lore `message` is about, in order of
+        first mention."""
+        attributions = await self._processMessage(strip_citations(message.content))
+        message.lore_ids = list(
+            dict.fromkeys(
+                lore_id for _, lore_ids in attributions for lore_id in lore_ids
+            )
+        )
 
-                loreID = ""
-                if memory.client_id is not None:
-                    loreID = memory.client_id
+    async def _processMessage(
+        self, content: str, threshold: float = _LORE_ATTRIBUTION_THRESHOLD
+    ) -> List[Tuple[str, List[str]]]:
+        """Attributes each sentence of `content` to the lore it is about: the
+        client IDs of memories whose embedding is at least `threshold` similar.
+        All sentences are embedded in one request and scored in one batch."""
+        sentences = [
+            sentence.strip()
+            for sentence in _SENTENCE_DELIMITERS.split(content)
+            # Too short to be a meaningful sentence
+            if len(sentence.strip()) > 3
+        ]
+        if not sentences:
+            return []
 
-                logger.debug('LoreID ' + loreID + ':' + memory.description + ' Similarity:' + str(similarity) + ' Distance:' + str(distance))
-                #if(similarity > 0.95):
-                #    msg = '<LORE ' + 'ID=' + lore.client_id + ' >' + msg + '</LORE>'
-                #    break
+        embeddings = await self._llm.embed_many(sentences)
+        similar = self._memory.get_similar_memories(embeddings, threshold)
 
-        return content
-    
-    def _distanceFromEmbedding(self, memory:Optional[List[float]] = None, message:Optional[List[float]] = None):
-        if memory is None:
-            logger = logging.getLogger()
-            logger.warn("memory embedding is None")
-            return 0
-        
-        if message is None:
-            logger = logging.getLogger()
-            logger.warn("message embedding is None")
-            return 0
-        
-        return np.linalg.norm(np.subtract(memory, message))
-    
-    def _cosineSimilarity(self, memory:Optional[List[float]] = None, message:Optional[List[float]] = None):
-
-        if memory is None:
-            logger = logging.getLogger()
-            logger.warn("memory embedding is None")
-            return 0
-        
-        if message is None:
-            logger = logging.getLogger()
-            logger.warn("message embedding is None")
-            return 0
+        logger = logging.getLogger()
+        attributions: List[Tuple[str, List[str]]] = []
+        for sentence, memories in zip(sentences, similar):
+            logger.debug(
+                "Sentence: %s, similar memories: %s",
+                sentence,
+                [(memory.client_id, score) for memory, score in memories],
+            )
+            lore_ids = [memory.client_id for memory, _ in memories if memory.client_id]
+            attributions.append((sentence, lore_ids))
+
+        return attributions
 
-        return np.dot(memory, message) / (np.linalg.norm(memory) * np.linalg.norm(memory))
-    
     def _debugMessage(self, msg:List[Message]):
         logger = logging.getLogger()
         logger.info("GPT Message:")
@@ -297,15 +448,76 @@ class GenAgent:
     ):
         self._conversation_context = conversation
         self._conversation_history = history
+        self._conversation_summary = ""
+        self._compiled_prompt = None
+
+    def restore_conversation(
+        self, conversation: Conversation, history: List[Message], summary: str
+    ):
+        """Like startConversation, but also restores the summary of turns that
+        were already folded out of `history`."""
+        self.startConversation(conversation, history)
+        self._conversation_summary = summary
 
     def resetConversation(self):
         self._conversation_history = []
+        self._conversation_summary = ""
+
+    def _prompt_history(self) -> List[Message]:
+        if not self._conversation_summary:
+            return self._conversation_history
+        return [
+            get_conversation_summary_message(self._conversation_summary)
+        ] + self._conversation_history
+
+    def _maybe_summarize(self) -> None:
+        """Folds old turns into the running summary in the background, so that
+        the request that pushed history over the limit doesn't wait on it."""
+        if not self._summarizer or self._summary_task:
+            return
+        if not self._summarizer.turns_to_fold(self._conversation_history):
+            return
+        self._summary_task = asyncio.create_task(self._summarize())
+
+    async def _summarize(self) -> None:
+        summarizer = self._summarizer
+        history = self._conversation_history
+        try:
+            if not summarizer:
+                return
+            turns = summarizer.turns_to_fold(history)
+            summary = await summarizer.fold(
+                self._knowledge,
+                self._conversation_context,
+                self._conversation_summary,
+                turns,
+            )
+
+            # The conversation was restarted while we were summarizing.
+            if history is not self._conversation_history:
+                return
+
+            # Turns are only ever appended, so the folded ones are still first.
+            del history[: len(turns)]
+            self._conversation_summary = summary
+
+            if summarizer.remember_folded_turns:
+                transcript = format_transcript(
+                    self._knowledge, self._conversation_context, turns
+                )
+                await self._memory.add_memories([Memory(description=transcript)])
+        except Exception:
+            logging.getLogger().exception("Failed to summarize conversation.")
+        finally:
+            self._summary_task = None
 
     # TODO: use setter?
     def updateKnowledge(self, knowledge: Knowledge):
         # TODO: this doesn't update their memories, but we also don't really
         # want to overwrite what exists. Not sure what to do here.
         self._knowledge = knowledge
+        self._compiled_prompt = None
+        self._actions = ActionRegistry(knowledge.agent_def.actions)
 
     async def _queryMemories(
         self, message: Optional[str] = None, max_memories: Optional[int] = None
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from typing import List, Optional
+
+import numpy as np
+from numpy.typing import NDArray
+
+from game.keywords import KeywordAnnotator
+from llm.base import LLMBase
+from schema.game import GuardrailConfig
+
+BLOCKED_RATING = 1
+ALLOWED_RATING = 5
+
+
+class GuardrailPrefilter:
+    """First, local stage of the guardrail. Rates lines that contain a blocklisted
+    phrase, or that are clearly closer to one set of example lines than to the
+    other, without an LLM completion. Everything else is left to the LLM.
+
+    The examples are embedded once, on first use, and re-embedded after
+    `update_config`."""
+
+    def __init__(self, llm: LLMBase, config: GuardrailConfig):
+        self._llm = llm
+        self._lock = asyncio.Lock()
+        self.update_config(config)
+
+    def update_config(self, config: GuardrailConfig) -> None:
+        self._config = config
+        self._blocklist = KeywordAnnotator(
+            phrase.lower() for phrase in config.blocklist if phrase.strip()
+        )
+        self._in_tone: Optional[NDArray[np.float32]] = None
+        self._out_of_tone: Optional[NDArray[np.float32]] = None
+        self._embedded = False
+
+    @property
+    def has_examples(self) -> bool:
+        return bool(self._config.in_tone_examples and self._config.out_of_tone_examples)
+
+    async def rate_many(self, messages: List[str]) -> List[Optional[int]]:
+        """A 1-5 rating for each message decided locally, or None where the LLM
+        has to decide."""
+        ratings: List[Optional[int]] = [
+            BLOCKED_RATING if self._is_blocked(message) else None
+            for message in messages
+        ]
+
+        undecided = [i for i, rating in enumerate(ratings) if rating is None]
+        if not undecided or not self.has_examples:
+            return ratings
+
+        await self._embed_examples()
+        if self._in_tone is None or self._out_of_tone is None:
+            return ratings
+
+        embeddings = np.array(
+            await self._llm.embed_many([messages[i] for i in undecided]),
+            dtype=np.float32,
+        )
+        margins = _max_similarity(embeddings, self._in_tone) - _max_similarity(
+            embeddings, self._out_of_tone
+        )
+
+        for i, margin in zip(undecided, margins):
+            if margin >= self._config.pass_margin:
+                ratings[i] = ALLOWED_RATING
+            elif -margin >= self._config.block_margin:
+                ratings[i] = BLOCKED_RATING
+
+        logging.debug(
+            "Guardrail prefilter rated %d of %d lines",
+            sum(rating is not None for rating in ratings),
+            len(ratings),
+        )
+        return ratings
+
+    async def rate(self, message: str) -> Optional[int]:
+        return (await self.rate_many([message]))[0]
+
+    def _is_blocked(self, message: str) -> bool:
+        """Whether `message` contains a blocklisted phrase as whole words, so
+        that e.g. "gun" doesn't block "begun"."""
+        text = message.lower()
+        return any(
+            _is_whole_words(text, start, end)
+            for start, end, _ in self._blocklist.find(text)
+        )
+
+    async def _embed_examples(self) -> None:
+        async with self._lock:
+            if self._embedded:
+                return
+            config = self._config
+            embeddings = await self._llm.embed_many(
+                config.in_tone_examples + config.out_of_tone_examples
+            )
+            if config is not self._config:
+                # The config changed while embedding; embed the new one next time.
+                return
+            if len(embeddings) == len(config.in_tone_examples) + len(
+                config.out_of_tone_examples
+            ):
+                matrix = _normalized(np.array(embeddings, dtype=np.float32))
+                self._in_tone = matrix[: len(config.in_tone_examples)]
+                self._out_of_tone = matrix[len(config.in_tone_examples) :]
+            self._embedded = True
+
+
+def _normalized(matrix: NDArray[np.float32]) -> NDArray[np.float32]:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _max_similarity(
+    embeddings: NDArray[np.float32], examples: NDArray[np.float32]
+) -> NDArray[np.float32]:
+    return (_normalized(embeddings) @ examples.T).max(axis=1)
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+def _is_whole_words(text: str, start: int, end: int) -> bool:
+    """Whether text[start:end] doesn't start or end in the middle of a word."""
+    starts_mid_word = (
+        start > 0 and _is_word_char(text[start - 1]) and _is_word_char(text[start])
+    )
+    ends_mid_word = (
+        end < len(text) and _is_word_char(text[end - 1]) and _is_word_char(text[end])
+    )
+    return not starts_mid_word and not ends_mid_word
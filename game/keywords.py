@@ -0,0 +1,112 @@
+import re
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+_CITATION_PATTERN = re.compile(r"\[memory_id\](.*?)\[/memory_id\]", re.DOTALL)
+
+
+def parse_citations(text: str) -> List[str]:
+    """IDs of the memories cited as [memory_id]id[/memory_id], in order of first
+    citation."""
+    citations: Dict[str, None] = {}
+    for citation in _CITATION_PATTERN.findall(text):
+        if citation.strip():
+            citations.setdefault(citation.strip())
+    return list(citations)
+
+
+def strip_citations(text: str) -> str:
+    return _CITATION_PATTERN.sub("", text)
+
+
+class _Node:
+    __slots__ = ("children", "fail", "output", "keyword")
+
+    def __init__(self):
+        self.children: Dict[str, _Node] = {}
+        self.fail: Optional[_Node] = None
+        # Nearest node along the failure chain (excluding self) that ends a keyword.
+        self.output: Optional[_Node] = None
+        self.keyword: Optional[str] = None
+
+
+class KeywordAnnotator:
+    """Tags memory keywords in text as [keyword]...[/keyword] with one linear scan
+    of an Aho-Corasick automaton. Overlapping matches resolve to the leftmost,
+    then longest, keyword.
+
+    Keywords can be added at any time. The failure links are rebuilt lazily, on
+    the first scan after new keywords were added."""
+
+    def __init__(self, keywords: Iterable[str] = ()):
+        self._root = _Node()
+        self._keywords: Set[str] = set()
+        self._stale = False
+        self.add_keywords(keywords)
+
+    def add_keywords(self, keywords: Iterable[str]) -> None:
+        for keyword in keywords:
+            if not keyword or keyword in self._keywords:
+                continue
+            self._keywords.add(keyword)
+
+            node = self._root
+            for char in keyword:
+                node = node.children.setdefault(char, _Node())
+            node.keyword = keyword
+            self._stale = True
+
+    def find(self, text: str) -> List[Tuple[int, int, str]]:
+        """Non-overlapping (start, end, keyword) matches, in order."""
+        if self._stale:
+            self._build()
+
+        matches: List[Tuple[int, int, str]] = []
+        node = self._root
+        for end, char in enumerate(text, start=1):
+            while node is not self._root and char not in node.children:
+                node = node.fail or self._root
+            node = node.children.get(char, self._root)
+
+            match = node if node.keyword else node.output
+            while match and match.keyword:
+                matches.append((end - len(match.keyword), end, match.keyword))
+                match = match.output
+
+        matches.sort(key=lambda match: (match[0], match[0] - match[1]))
+
+        selected: List[Tuple[int, int, str]] = []
+        covered_until = 0
+        for start, end, keyword in matches:
+            if start >= covered_until:
+                selected.append((start, end, keyword))
+                covered_until = end
+        return selected
+
+    def annotate(self, text: str) -> str:
+        pieces: List[str] = []
+        last = 0
+        for start, end, keyword in self.find(text):
+            pieces += [text[last:start], "[keyword]", keyword, "[/keyword]"]
+            last = end
+        pieces.append(text[last:])
+        return "".join(pieces)
+
+    def _build(self) -> None:
+        queue: Deque[_Node] = deque()
+        for child in self._root.children.values():
+            child.fail = self._root
+            child.output = None
+            queue.append(child)
+
+        while queue:
+            node = queue.popleft()
+            for char, child in node.children.items():
+                fail = node.fail
+                while fail is not None and char not in fail.children:
+                    fail = fail.fail
+                child.fail = fail.children[char] if fail else self._root
+                child.output = child.fail if child.fail.keyword else child.fail.output
+                queue.append(child)
+
+        self._stale = False
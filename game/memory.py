@@ -1,8 +1,13 @@
+import asyncio
 import logging
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
+
+from game.keywords import KeywordAnnotator
+from game.prompt_helpers import get_importance_batch_function
 from game.ti_retriever import TIRetriever
-from llm.openai import OpenAIInterface
+from llm.base import LLMBase
 
 # from eastworld.wrappers.openai
 from schema import Memory, Message
@@ -16,26 +21,99 @@ explanation.
 \nMemory: {memory_content}
 \nRating: """
 
+_MEM_IMPORTANCE_BATCH_TMPL = """On the scale of 0 to 9, where 0 is purely mundane
+(e.g., brushing teeth, making bed) and 9 is
+extremely poignant (e.g., a break up, college
+acceptance), rate the likely poignancy of each of the
+following numbered memories. Respond with the provided
+RateMemories() function, giving exactly one rating per memory
+in the order they are listed.
+\nMemories:
+{memories}"""
+
+# How many memories are rated per LLM call when ingesting in bulk.
+_IMPORTANCE_BATCH_SIZE = 25
+
 
 class GenAgentMemory:
-    # TODO: make LLM configurable
     def __init__(
         self,
+        llm: LLMBase,
         default_num_memories_returned: int,
         retriever: TIRetriever,
     ):
+        self._llm = llm
         self._default_num_memories_returned = default_num_memories_returned
         self._retriever = retriever
+        self.keyword_annotator = KeywordAnnotator()
 
     async def add_memory(self, memory: Memory) -> None:
         # TODO: parallelize
         if memory.importance == 0:
-            memory.importance = await self._rate_importance(memory)
+            memory.importance = await _rate_importance(self._llm, memory)
         if not memory.embedding:
-            openAI = OpenAIInterface()
-            memory.embedding = await openAI.embed(memory.description)
+            memory.embedding = await self._llm.embed(memory.description)
 
         self._retriever.add_memory(memory)
+        self.keyword_annotator.add_keywords(memory.keywords or [])
+
+    async def add_memories(self, memories: List[Memory]) -> None:
+        """Bulk version of add_memory. Unrated memories are rated in chunks with
+        one LLM call per chunk and unembedded ones are embedded in one request."""
+        unrated = [memory for memory in memories if memory.importance == 0]
+        unembedded = [memory for memory in memories if not memory.embedding]
+
+        importances, embeddings = await asyncio.gather(
+            rate_importances(self._llm, unrated),
+            self._llm.embed_many([memory.description for memory in unembedded]),
+        )
+
+        for memory, importance in zip(unrated, importances):
+            memory.importance = importance
+        for memory, embedding in zip(unembedded, embeddings):
+            memory.embedding = embedding
+
+        for memory in memories:
+            self._retriever.add_memory(memory)
+            self.keyword_annotator.add_keywords(memory.keywords or [])
+
+    def restore_memories(self, memories: List[Memory]) -> None:
+        """Adds saved memories as they are, with their saved importance and
+        embedding. Unlike add_memories, this never calls the LLM."""
+        for memory in memories:
+            self._retriever.add_memory(memory)
+            self.keyword_annotator.add_keywords(memory.keywords or [])
+
+    def remove_memories(self, memories: List[Memory]) -> None:
+        """Forgets `memories`, e.g. lore that was removed from the game."""
+        self._retriever.remove_memories(memories)
+        self.keyword_annotator = KeywordAnnotator(
+            keyword
+            for memory in self.get_all_memory()
+            for keyword in memory.keywords or []
+        )
+
+    def get_similar_memories(
+        self, embeddings: List[List[float]], threshold: float
+    ) -> List[List[Tuple[Memory, float]]]:
+        """For each embedding, the memories whose cosine similarity to it is at
+        least `threshold`, most similar first. Scored in one matrix product."""
+        if not embeddings or not self.get_all_memory():
+            return [[] for _ in embeddings]
+
+        similarities = self._retriever.get_similarities(np.array(embeddings))
+        similar: List[List[Tuple[Memory, float]]] = []
+        for row in similarities:
+            indices = np.flatnonzero(row >= threshold)
+            indices = indices[np.argsort(-row[indices])]
+            similar.append(
+                [(self._retriever.get_memory_of(i), float(row[i])) for i in indices]
+            )
+        return similar
+
+    @property
+    def nbytes(self) -> int:
+        return self._retriever.nbytes
 
     def get_all_memory(self) -> List[Memory]:
         return self._retriever.get_all_memory()
@@ -54,8 +132,7 @@ class GenAgentMemory:
 
         for query in queries:
             if not query.embedding:
-                openAI = OpenAIInterface()
-                query.embedding = await openAI.embed(query.description)
+                query.embedding = await self._llm.embed(query.description)
 
             top_k_for_query = self._retriever.get_relevant_memories(query, top_k)
             for memory, score in top_k_for_query:
@@ -73,10 +150,66 @@ class GenAgentMemory:
 
         return [memory_desc_to_memory[desc] for desc, _ in vals[:top_k]]
 
-    async def _rate_importance(self, memory: Memory) -> int:
-        message = Message(
-            role="user",
-            content=_MEM_IMPORTANCE_TMPL.format(memory_content=memory.description),
+
+async def rate_importances(llm: LLMBase, memories: List[Memory]) -> List[int]:
+    """Importances of `memories`, rated in chunks with one LLM call per chunk."""
+    chunks = [
+        memories[i : i + _IMPORTANCE_BATCH_SIZE]
+        for i in range(0, len(memories), _IMPORTANCE_BATCH_SIZE)
+    ]
+    rated_chunks = await asyncio.gather(
+        *[_rate_importance_chunk(llm, chunk) for chunk in chunks]
+    )
+    return [importance for chunk in rated_chunks for importance in chunk]
+
+
+async def _rate_importance(llm: LLMBase, memory: Memory) -> int:
+    message = Message(
+        role="user",
+        content=_MEM_IMPORTANCE_TMPL.format(memory_content=memory.description),
+    )
+    return (await llm.digit_completions([[message]]))[0] + 1
+
+
+async def _rate_importance_chunk(llm: LLMBase, memories: List[Memory]) -> List[int]:
+    numbered = "\n".join(
+        f"{i + 1}. {memory.description}" for i, memory in enumerate(memories)
+    )
+    message = Message(
+        role="user",
+        content=_MEM_IMPORTANCE_BATCH_TMPL.format(memories=numbered),
+    )
+    completion = await llm.structured_completion(
+        [message], get_importance_batch_function(len(memories))
+    )
+
+    ratings: Any = completion.args.get("ratings") if completion else None
+    if not isinstance(ratings, list) or len(ratings) != len(memories):
+        logging.getLogger().warning(
+            "Batch importance rating failed, rating %d memories individually.",
+            len(memories),
         )
-        openAI = OpenAIInterface()
-        return (await openAI.digit_completions([[message]]))[0] + 1
+        ratings = [None] * len(memories)
+
+    importances = [_parse_rating(rating) for rating in ratings]
+    failed = [i for i, importance in enumerate(importances) if importance is None]
+    fallbacks = await asyncio.gather(
+        *[_rate_importance(llm, memories[i]) for i in failed]
+    )
+    for i, importance in zip(failed, fallbacks):
+        importances[i] = importance
+
+    return [importance or 0 for importance in importances]
+
+
+def _parse_rating(rating: Any) -> Optional[int]:
+    """Converts a 0-9 rating from the LLM into a 1-10 importance."""
+    if isinstance(rating, bool):
+        return None
+    try:
+        digit = int(rating)
+    except (TypeError, ValueError):
+        return None
+    if not 0 <= digit <= 9:
+        return None
+    return digit + 1
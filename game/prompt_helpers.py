@@ -1,14 +1,36 @@
+from functools import lru_cache
 from typing import Any, Dict, List, Optional
 
 from schema import Action, ActionCompletion, Conversation, Knowledge, Message, Parameter, Memory
 
 
-def get_knowledge_fragment(
-    knowledge: Knowledge, conversation: Conversation, memories: List[Memory]
-) -> str:
-    
-    memory_fragment: List[str] = []
+class CompiledPrompt:
+    """The prompt of one agent in one conversation. Everything that only depends
+    on the AgentDef and Conversation is rendered once, up front, so that each
+    request only appends its memories. Keeping the volatile memories at the end
+    also leaves a stable prefix for provider-side prompt caching.
+
+    Must be recompiled when the agent's knowledge or conversation changes."""
+
+    def __init__(self, knowledge: Knowledge, conversation: Conversation):
+        self.knowledge = knowledge
+        self.conversation = conversation
+        self._knowledge_prefix = _render_knowledge_prefix(knowledge, conversation)
+        self._system_prefix = self._knowledge_prefix + _render_instructions(
+            knowledge, conversation
+        )
+
+    def knowledge_fragment(self, memories: List[Memory]) -> str:
+        return self._knowledge_prefix + _render_memories(self.knowledge, memories)
+
+    def system_prompt(self, memories: List[Memory]) -> Message:
+        return Message(
+            role="system",
+            content=self._system_prefix + _render_memories(self.knowledge, memories),
+        )
 
+
+def _render_knowledge_prefix(knowledge: Knowledge, conversation: Conversation) -> str:
     fragment = [
         """You are roleplaying as a character named {knowledge.agent_def.name}.
 Description of {knowledge.agent_def.name}: 
@@ -29,26 +51,6 @@ Description of {knowledge.agent_def.name}:
 {knowledge.agent_def.example_speech}"""
         )
 
-    if memories:
-        fragment.append(
-            "{knowledge.agent_def.name} has the following memories: \n{Memories}"
-        )
-        for memory in memories:
-            memory_fragment.append(
-                """{memory.description}[memory_id]{memory.client_id}[/memory_id]\
-[keywords]{keywords}[/keywords]"""
-
-                .format(
-                    memory=memory, keywords=",".join(memory.keywords) if memory.keywords else ""
-                )
-            )
-        fragment.append(
-             """\nEvery memory has an memory ID between [memory_id] and [/memory_id]. \
-Eveny memory has a list of keywords between [keywords] and [/keywords].\
-You can reference a memory by its ID in your responses. If you reference a memory, you must do following things:\
-1. You must add the memory ID at the end of the sentence and between [memory_id] and [/memory_id].\
-2. You must use exact keywords without any change of the memory in your response. You can use the keywords in any order.""")
-
     if conversation.correspondent:
         fragment.append(
             """As {knowledge.agent_def.name}, you are currently speaking to \
@@ -66,19 +68,13 @@ You can reference a memory by its ID in your responses. If you reference a memor
 
     return "\n\n".join(
         [
-            piece.format(
-                knowledge=knowledge, conversation=conversation, Memories="\n".join(memory_fragment)
-            )
+            piece.format(knowledge=knowledge, conversation=conversation)
             for piece in fragment
         ]
     )
 
 
-def get_system_prompt(
-    knowledge: Knowledge, conversation: Conversation, memories: List[Memory]
-) -> Message:
-    system_prompt = get_knowledge_fragment(knowledge, conversation, memories)
-
+def _render_instructions(knowledge: Knowledge, conversation: Conversation) -> str:
     instructions: List[str] = []
     instructions.append(
         """\nYou MUST obey the following instructions:
@@ -93,16 +89,58 @@ Do not offer information that is irrelevant to the current conversation.
 respond ONLY as {knowledge.agent_def.name}."""
     )
 
-    system_prompt += "\n".join(instructions)
+    return "\n".join(instructions).format(
+        knowledge=knowledge, conversation=conversation
+    )
 
-    return Message(
-        role="system",
-        content=system_prompt.format(
-            knowledge=knowledge, conversation=conversation, memorys=memories
-        ),
+
+def _render_memories(knowledge: Knowledge, memories: List[Memory]) -> str:
+    if not memories:
+        return ""
+
+    memory_fragment = [
+        """{memory.description}[memory_id]{memory.client_id}[/memory_id]\
+[keywords]{keywords}[/keywords]""".format(
+            memory=memory,
+            keywords=",".join(memory.keywords) if memory.keywords else "",
+        )
+        for memory in memories
+    ]
+
+    return "\n\n" + "\n\n".join(
+        [
+            "{name} has the following memories: \n{memories}".format(
+                name=knowledge.agent_def.name, memories="\n".join(memory_fragment)
+            ),
+            """\nEvery memory has an memory ID between [memory_id] and [/memory_id]. \
+Eveny memory has a list of keywords between [keywords] and [/keywords].\
+You can reference a memory by its ID in your responses. If you reference a memory, you must do following things:\
+1. You must add the memory ID at the end of the sentence and between [memory_id] and [/memory_id].\
+2. You must use exact keywords without any change of the memory in your response. You can use the keywords in any order.""",
+        ]
     )
 
 
+def get_knowledge_fragment(
+    knowledge: Knowledge,
+    conversation: Conversation,
+    memories: List[Memory],
+    compiled: Optional[CompiledPrompt] = None,
+) -> str:
+    compiled = compiled or CompiledPrompt(knowledge, conversation)
+    return compiled.knowledge_fragment(memories)
+
+
+def get_system_prompt(
+    knowledge: Knowledge,
+    conversation: Conversation,
+    memories: List[Memory],
+    compiled: Optional[CompiledPrompt] = None,
+) -> Message:
+    compiled = compiled or CompiledPrompt(knowledge, conversation)
+    return compiled.system_prompt(memories)
+
+
 _CHARACTER_DIALOG_PREPEND = "{character} says: {message}"
 _CHARACTER_INTERACT_PREPEND = "{character} says:"
 
@@ -112,9 +150,10 @@ def get_chat_messages(
     conversation: Conversation,
     memories: List[Memory],
     history: List[Message],
+    compiled: Optional[CompiledPrompt] = None,
 ) -> List[Message]:
     return (
-        [get_system_prompt(knowledge, conversation, memories)]
+        [get_system_prompt(knowledge, conversation, memories, compiled)]
         + _format_history(knowledge, conversation, history)
         + [
             Message(
@@ -127,14 +166,39 @@ def get_chat_messages(
     )
 
 
+def get_suggestion_messages(
+    knowledge: Knowledge,
+    conversation: Conversation,
+    memories: List[Memory],
+    history: List[Message],
+    count: int,
+    compiled: Optional[CompiledPrompt] = None,
+) -> List[Message]:
+    """Asks for `count` alternative next lines for the agent, to be answered with
+    get_suggestion_function(count)."""
+    request = """Write {count} different things {knowledge.agent_def.name} could say next. Each one must be a complete line of dialogue in {knowledge.agent_def.name}'s voice, without the speaker's name. Make them meaningfully different from each other. Please respond with the provided SuggestLines() function."""
+
+    return (
+        [get_system_prompt(knowledge, conversation, memories, compiled)]
+        + _format_history(knowledge, conversation, history)
+        + [
+            Message(
+                role="system",
+                content=request.format(count=count, knowledge=knowledge),
+            )
+        ]
+    )
+
+
 def get_interact_messages(
     knowledge: Knowledge,
     conversation: Conversation,
     memories: List[Memory],
     history: List[Message],
+    compiled: Optional[CompiledPrompt] = None,
 ) -> List[Message]:
     return (
-        [get_system_prompt(knowledge, conversation, memories)]
+        [get_system_prompt(knowledge, conversation, memories, compiled)]
         + _format_history(knowledge, conversation, history)
         + [
             Message(
@@ -152,9 +216,10 @@ def get_action_messages(
     conversation: Conversation,
     memories: List[Memory],
     history: List[Message],
+    compiled: Optional[CompiledPrompt] = None,
 ) -> List[Message]:
     return (
-        [get_system_prompt(knowledge, conversation, memories)]
+        [get_system_prompt(knowledge, conversation, memories, compiled)]
         + _format_history(knowledge, conversation, history)
         + [Message(role="system", content="You must return a function call.")]
     )
@@ -164,6 +229,8 @@ def _format_history(
     knowledge: Knowledge, conversation: Conversation, history: List[Message]
 ) -> List[Message]:
     def format_message(message: Message) -> Message:
+        if message.role == "system":
+            return message
         if message.role == "user":
             character = (
                 conversation.correspondent.name
@@ -182,6 +249,50 @@ def _format_history(
     return [format_message(message) for message in history]
 
 
+def format_transcript(
+    knowledge: Knowledge, conversation: Conversation, history: List[Message]
+) -> str:
+    return "\n".join(
+        message.content for message in _format_history(knowledge, conversation, history)
+    )
+
+
+def get_conversation_summary_message(summary: str) -> Message:
+    return Message(
+        role="system",
+        content="Summary of the earlier part of this conversation: " + summary,
+    )
+
+
+def get_summarize_messages(
+    knowledge: Knowledge,
+    conversation: Conversation,
+    summary: str,
+    turns: List[Message],
+) -> List[Message]:
+    """Asks for `summary` to be updated with `turns`, which are being dropped
+    from the conversation history."""
+    instructions = """You are keeping a running summary of a conversation \
+{knowledge.agent_def.name} is having. Rewrite the summary so far to also cover the \
+new lines of dialogue. Keep every fact, promise, name and emotional beat that \
+could matter later. Respond with the summary only, in at most 200 words.
+
+Summary so far: {summary}"""
+
+    return (
+        [
+            Message(
+                role="system",
+                content=instructions.format(
+                    knowledge=knowledge, summary=summary or "(empty)"
+                ),
+            )
+        ]
+        + _format_history(knowledge, conversation, turns)
+        + [Message(role="system", content="Updated summary:")]
+    )
+
+
 def clean_response(agent_name: str, message: Message) -> Message:
     dialog_prepend = _CHARACTER_DIALOG_PREPEND.format(
         character=agent_name, message=""
@@ -200,6 +311,7 @@ def get_query_messages(
     memories: List[List[Memory]],
     history: List[Message],
     queries: List[str],
+    compiled: Optional[CompiledPrompt] = None,
 ) -> List[List[Message]]:
     query_base = """Pretend you are {knowledge.agent_def.name}'s inner \
 thoughts. Despite what {knowledge.agent_def.name} may be saying, {query}?
@@ -210,7 +322,9 @@ thoughts. Despite what {knowledge.agent_def.name} may be saying, {query}?
         query = queries[index]
         base_message = Message(
             role="system",
-            content=get_knowledge_fragment(knowledge, conversation, memories[index]),
+            content=get_knowledge_fragment(
+                knowledge, conversation, memories[index], compiled
+            ),
         )
 
         name = (
@@ -229,6 +343,44 @@ thoughts. Despite what {knowledge.agent_def.name} may be saying, {query}?
     return formatted_queries
 
 
+def get_batch_query_messages(
+    knowledge: Knowledge,
+    conversation: Conversation,
+    memories: List[Memory],
+    history: List[Message],
+    queries: List[str],
+    compiled: Optional[CompiledPrompt] = None,
+) -> List[Message]:
+    """Like get_query_messages but asks every query in a single prompt, to be
+    answered with get_batch_rate_function(len(queries))."""
+    query_base = """Pretend you are {knowledge.agent_def.name}'s inner \
+thoughts. Despite what {knowledge.agent_def.name} may be saying, answer each of \
+the following numbered questions:
+{queries}
+Please respond with the provided RateAll() function, with one rating per question."""
+
+    name = conversation.correspondent.name if conversation.correspondent else "player"
+    numbered_queries = "\n".join(
+        "{index}. {query}?".format(
+            index=index + 1,
+            query=query.format(
+                agent=knowledge.agent_def.name, player=name, player_character=name
+            ),
+        )
+        for index, query in enumerate(queries)
+    )
+
+    base_message = Message(
+        role="system",
+        content=get_knowledge_fragment(knowledge, conversation, memories, compiled),
+    )
+    query_as_message = Message(
+        role="system",
+        content=query_base.format(knowledge=knowledge, queries=numbered_queries),
+    )
+    return [base_message] + history + [query_as_message]
+
+
 def get_guardrail_query(
     knowledge: Knowledge,
     user_message: str,
@@ -250,14 +402,55 @@ def get_guardrail_query(
     return "\n".join(query_fragments)
 
 
-def generate_functions_from_actions(actions: List[Action]) -> List[Dict[str, str]]:
+def get_batch_guardrail_messages(
+    knowledge: Knowledge,
+    conversation: Conversation,
+    history: List[Message],
+    user_messages: List[str],
+    compiled: Optional[CompiledPrompt] = None,
+) -> List[Message]:
+    """Asks how appropriate each of `user_messages` would be in a single prompt, to
+    be answered with get_batch_rate_function(len(user_messages))."""
+    query_fragments: List[str] = [
+        """Pretend you are {knowledge.agent_def.name}'s inner thoughts.""".format(
+            knowledge=knowledge
+        )
+    ]
+
+    if knowledge.agent_def.instructions:
+        instructions = """With {knowledge.agent_def.name} obeying the following 
+        instructions: {knowledge.agent_def.instructions}, """
+
+        query_fragments.append(instructions.format(knowledge=knowledge))
+
+    query = """Based on the instructions, the tone and the time period of the game, 
+    and current conversation, how appropriate would it be for you as 
+    {knowledge.agent_def.name} to say each of the following numbered lines?
+{lines}
+Please respond with the provided RateAll() function, with one rating per line."""
+    numbered_lines = "\n".join(
+        f'{index + 1}. "{user_message}"'
+        for index, user_message in enumerate(user_messages)
+    )
+    query_fragments.append(query.format(knowledge=knowledge, lines=numbered_lines))
+
+    base_message = Message(
+        role="system",
+        content=get_knowledge_fragment(knowledge, conversation, [], compiled),
+    )
+    query_as_message = Message(role="system", content="\n".join(query_fragments))
+    return [base_message] + history + [query_as_message]
+
+
+def generate_functions_from_actions(actions: List[Action]) -> List[Dict[str, Any]]:
     # Format taken from https://platform.openai.com/docs/guides/gpt/function-calling
     functions = [action.dict() for action in actions]
 
     for func in functions:
         properties = {}
         for p in func["parameters"]:
-            properties[p["name"]] = p
+            # An empty enum would forbid every value.
+            properties[p["name"]] = {k: v for k, v in p.items() if k != "enum" or v}
         func["parameters"] = {
             "type": "object",
             "properties": properties,
@@ -266,30 +459,13 @@ def generate_functions_from_actions(actions: List[Action]) -> List[Dict[str, str
 
     return functions
 
-#Generate list of tools for OpenAI function call
-def generate_tools_from_actions(actions: List[Action]) -> List[Any]:
-    return [{
-        "type":"function",
-        "function":{
-            "name":action.name,
-            "description":action.description,
-            "parameters":[
-                {
-                    "type":"object",
-                    "properties":
-                    {
-                        p.name:{
-                            "type":p.type,
-                            "description":p.description,
-                            "enum":p.enum ,
-                        }
-                    },
-                } for p in action.parameters
-            ]
-            },
-}   for action in actions]
-  
-    
+
+# Generate list of tools for OpenAI function call
+def generate_tools_from_actions(actions: List[Action]) -> List[Dict[str, Any]]:
+    return [
+        {"type": "function", "function": function}
+        for function in generate_functions_from_actions(actions)
+    ]
 
 
 _RATING_ENUM_MAP: Dict[str, int] = {
@@ -301,7 +477,8 @@ _RATING_ENUM_MAP: Dict[str, int] = {
 }
 
 
-def get_rate_function() -> Dict[str, str]:
+@lru_cache(maxsize=None)
+def get_rate_function() -> Dict[str, Any]:
     act = Action(
         name="Rate",
         description="Answers the question with a rating",
@@ -318,6 +495,85 @@ def get_rate_function() -> Dict[str, str]:
     return generate_functions_from_actions([act])[0]
 
 
+@lru_cache(maxsize=None)
+def get_batch_rate_function(count: int) -> Dict[str, Any]:
+    """Tool that answers `count` numbered questions with one rating each."""
+    return {
+        "type": "function",
+        "function": {
+            "name": "RateAll",
+            "description": "Answers each of the numbered questions with a rating",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    _batch_rating_key(index): {
+                        "type": "string",
+                        "description": f"The rating for question {index + 1}.",
+                        "enum": list(_RATING_ENUM_MAP.keys()),
+                    }
+                    for index in range(count)
+                },
+                "required": [_batch_rating_key(index) for index in range(count)],
+            },
+        },
+    }
+
+
+@lru_cache(maxsize=None)
+def get_suggestion_function(count: int) -> Dict[str, Any]:
+    """Tool that returns `count` alternative lines of dialogue."""
+    return {
+        "type": "function",
+        "function": {
+            "name": "SuggestLines",
+            "description": "Suggests alternative lines of dialogue",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "lines": {
+                        "type": "array",
+                        "description": "The alternative lines of dialogue.",
+                        "items": {"type": "string"},
+                        "minItems": count,
+                        "maxItems": count,
+                    }
+                },
+                "required": ["lines"],
+            },
+        },
+    }
+
+
+def _batch_rating_key(index: int) -> str:
+    return f"rating_{index + 1}"
+
+
+@lru_cache(maxsize=None)
+def get_importance_batch_function(count: int) -> Dict[str, Any]:
+    """Tool that rates `count` memories at once as a JSON array of digits."""
+    return {
+        "type": "function",
+        "function": {
+            "name": "RateMemories",
+            "description": "Rates the poignancy of each memory, in order.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "ratings": {
+                        "type": "array",
+                        "description": "One rating from 0 to 9 per memory, in the "
+                        "same order as the memories were given.",
+                        "items": {"type": "integer", "minimum": 0, "maximum": 9},
+                        "minItems": count,
+                        "maxItems": count,
+                    }
+                },
+                "required": ["ratings"],
+            },
+        },
+    }
+
+
 def rating_to_int(completion: Optional[ActionCompletion]) -> int:
     if (
         completion is None
@@ -327,3 +583,40 @@ def rating_to_int(completion: Optional[ActionCompletion]) -> int:
         return -1
 
     return _RATING_ENUM_MAP[completion.args["rating"]]
+
+
+def suggestions_to_messages(
+    agent_name: str, completion: Optional[ActionCompletion], count: int
+) -> List[Message]:
+    """Parses a SuggestLines() completion into at most `count` distinct, non-empty
+    assistant messages."""
+    lines = completion.args.get("lines") if completion else None
+    if not isinstance(lines, list):
+        return []
+
+    suggestions: Dict[str, Message] = {}
+    for line in lines:
+        if not isinstance(line, str):
+            continue
+        message = clean_response(agent_name, Message(role="assistant", content=line))
+        content = message.content.strip().strip('"').strip()
+        if content and content not in suggestions:
+            suggestions[content] = Message(role="assistant", content=content)
+    return list(suggestions.values())[:count]
+
+
+def batch_ratings_to_ints(
+    completion: Optional[ActionCompletion], count: int
+) -> List[int]:
+    """Parses a RateAll() completion. Unanswered questions are returned as -1."""
+    return [
+        rating_to_int(
+            ActionCompletion(
+                action="Rate",
+                args={"rating": completion.args.get(_batch_rating_key(index))},
+            )
+            if completion
+            else None
+        )
+        for index in range(count)
+    ]
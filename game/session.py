@@ -1,14 +1,100 @@
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, TypeVar
 
 from pydantic import UUID4
 
 from game.agent import GenAgent
+from game.guardrail import GuardrailPrefilter
+from schema import AgentDef
 from schema.game import GameDef
 
+_T = TypeVar("_T")
+
+
+@dataclass
+class _AgentIndex:
+    """Lookups of agents by uuid or name. Names shared by several agents are
+    kept in `ambiguous_names` instead of resolving to one of them."""
+
+    by_uuid: Dict[str, GenAgent] = field(default_factory=dict)
+    by_name: Dict[str, GenAgent] = field(default_factory=dict)
+    defs_by_uuid: Dict[str, AgentDef] = field(default_factory=dict)
+    defs_by_name: Dict[str, AgentDef] = field(default_factory=dict)
+    ambiguous_names: Set[str] = field(default_factory=set)
+
 
 @dataclass
 class Session:
     uuid: UUID4
     game_def: GameDef
     agents: List[GenAgent]
+    guardrail_prefilter: Optional[GuardrailPrefilter] = None
+    _index: _AgentIndex = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.reindex()
+
+    def __setstate__(self, state: Dict[str, Any]):
+        # Sessions pickled before the index existed.
+        self.__dict__.update(state)
+        self.reindex()
+
+    def reindex(self) -> None:
+        """Rebuilds the agent lookups. Call after changing `agents`, `game_def` or
+        an agent's knowledge."""
+        index = _AgentIndex()
+        for gen_agent in self.agents:
+            index.by_uuid[str(gen_agent.uuid)] = gen_agent
+            _add_name(index.by_name, index.ambiguous_names, gen_agent.name, gen_agent)
+        for agent_def in self.game_def.agents:
+            index.defs_by_uuid[str(agent_def.uuid)] = agent_def
+            _add_name(
+                index.defs_by_name, index.ambiguous_names, agent_def.name, agent_def
+            )
+        self._index = index
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the agents' memory retrievers, by far the largest part
+        of a session."""
+        return sum(gen_agent.memory.nbytes for gen_agent in self.agents)
+
+    def get_agent(self, agent: str) -> Optional[GenAgent]:
+        """The GenAgent with `agent` as uuid or, failing that, as name.
+
+        Raises ValueError if several agents have that name."""
+        return _lookup(
+            agent, self._index.by_uuid, self._index.by_name, self._index.ambiguous_names
+        )
+
+    def get_agent_def(self, agent: str) -> Optional[AgentDef]:
+        """The AgentDef with `agent` as uuid or, failing that, as name.
+
+        Raises ValueError if several agents have that name."""
+        return _lookup(
+            agent,
+            self._index.defs_by_uuid,
+            self._index.defs_by_name,
+            self._index.ambiguous_names,
+        )
+
+
+def _add_name(by_name: Dict[str, _T], ambiguous: Set[str], name: str, value: _T):
+    if name in by_name and by_name[name] is not value:
+        ambiguous.add(name)
+    by_name[name] = value
+
+
+def _lookup(
+    agent: str,
+    by_uuid: Dict[str, _T],
+    by_name: Dict[str, _T],
+    ambiguous_names: Set[str],
+) -> Optional[_T]:
+    if agent in by_uuid:
+        return by_uuid[agent]
+    if agent in ambiguous_names:
+        raise ValueError(
+            f"Several agents are named {agent}. Refer to the agent by uuid instead."
+        )
+    return by_name.get(agent)
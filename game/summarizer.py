@@ -0,0 +1,40 @@
+from typing import List
+
+from game.prompt_helpers import get_summarize_messages
+from llm.base import LLMBase
+from schema import Conversation, Knowledge, Message
+
+
+class ConversationSummarizer:
+    """Bounds conversation history. Once history grows past `max_turns`, all but
+    the `window` most recent turns are folded into a running summary."""
+
+    def __init__(
+        self,
+        llm: LLMBase,
+        max_turns: int,
+        window: int,
+        remember_folded_turns: bool = False,
+    ):
+        if not 0 <= window < max_turns:
+            raise ValueError("window must be smaller than max_turns")
+        self._llm = llm
+        self._max_turns = max_turns
+        self._window = window
+        self.remember_folded_turns = remember_folded_turns
+
+    def turns_to_fold(self, history: List[Message]) -> List[Message]:
+        if len(history) <= self._max_turns:
+            return []
+        return history[: len(history) - self._window]
+
+    async def fold(
+        self,
+        knowledge: Knowledge,
+        conversation: Conversation,
+        summary: str,
+        turns: List[Message],
+    ) -> str:
+        messages = get_summarize_messages(knowledge, conversation, summary, turns)
+        completion = await self._llm.chat_completion(messages)
+        return completion.content.strip()
@@ -35,6 +35,11 @@ class TIRetriever:
         )
         self._memory_importances: NDArray[np.float64] = np.zeros(10)
 
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the embedding and importance matrices."""
+        return self._memory_embeddings.nbytes + self._memory_importances.nbytes
+
     def get_memory_of(self, index: int) -> Memory:
         return self._memories[index]
     
@@ -55,6 +60,16 @@ class TIRetriever:
             if i < len(self._memories)
         ]
 
+    def get_similarities(self, embeddings: NDArray[np.float64]) -> NDArray[np.float64]:
+        """Cosine similarity of each of `embeddings` (rows) to each memory, as a
+        (len(embeddings), number of memories) matrix."""
+        memory_embeddings = self._memory_embeddings[: len(self._memories)]
+        memory_norms = np.linalg.norm(memory_embeddings, axis=1)
+        memory_norms[memory_norms == 0] = 1
+        query_norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        query_norms[query_norms == 0] = 1
+        return (embeddings / query_norms) @ (memory_embeddings.T / memory_norms)
+
     def add_memory(self, memory: Memory) -> None:
         self._memories.append(memory)
 
@@ -73,5 +88,25 @@ class TIRetriever:
                 (self._memory_importances, np.zeros(len(self._memories)))
             )
 
-        self._memory_embeddings[len(self._memories) - 1] = memory.embedding
+        # Memories restored without an embedding keep a zero row.
+        if memory.embedding:
+            self._memory_embeddings[len(self._memories) - 1] = memory.embedding
         self._memory_importances[len(self._memories) - 1] = memory.importance
+
+    def remove_memories(self, memories: List[Memory]) -> None:
+        """Removes `memories` (the same objects that were added), keeping the
+        order of the others. The memory list is replaced rather than mutated."""
+        removed = {id(memory) for memory in memories}
+        kept = [
+            i for i, memory in enumerate(self._memories) if id(memory) not in removed
+        ]
+        if len(kept) == len(self._memories):
+            return
+
+        self._memories = [self._memories[i] for i in kept]
+        embeddings = np.zeros_like(self._memory_embeddings)
+        embeddings[: len(kept)] = self._memory_embeddings[kept]
+        importances = np.zeros_like(self._memory_importances)
+        importances[: len(kept)] = self._memory_importances[kept]
+        self._memory_embeddings = embeddings
+        self._memory_importances = importances
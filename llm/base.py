@@ -1,9 +1,31 @@
 from abc import abstractmethod
-from typing import Any, Dict, List, Optional, Union
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
 
 from schema import ActionCompletion, Message
 
 
+@dataclass
+class CompletionStats:
+    calls: int = 0
+    retries: int = 0
+    failures: int = 0
+
+
+@dataclass
+class LLMMetrics:
+    """Counts completions by kind (e.g. action, digit) and how often they had to
+    be retried or failed outright."""
+
+    stats: Dict[str, CompletionStats] = field(default_factory=dict)
+
+    def record(self, kind: str, retries: int, succeeded: bool) -> None:
+        stats = self.stats.setdefault(kind, CompletionStats())
+        stats.calls += 1
+        stats.retries += retries
+        stats.failures += 0 if succeeded else 1
+
+
 class LLMBase:
     @abstractmethod
     async def completion(
@@ -18,12 +40,27 @@ class LLMBase:
     ) -> Message:
         """Returns a chat completion from the LLM."""
 
+    async def chat_completion_stream(
+        self,
+        messages: List[Message],
+    ) -> AsyncIterator[str]:
+        """Yields a chat completion in pieces, as the LLM generates it. LLMs that
+        can't stream yield it in one piece."""
+        yield (await self.chat_completion(messages)).content
+
     @abstractmethod
     async def action_completion(
         self, messages: List[Message], functions: List[Dict[str, str]]
     ) -> Optional[ActionCompletion]:
         """Attempts to return a function call from the LLM."""
 
+    @abstractmethod
+    async def structured_completion(
+        self, messages: List[Message], tool: Dict[str, Any]
+    ) -> Optional[ActionCompletion]:
+        """Returns a call of `tool` in a single round-trip, by forcing the tool
+        choice up front rather than retrying. None if the LLM still refuses."""
+
     # TODO: make this return number 100% of time when OpenAI supports
     # JSONformer or logit masking or something similar.
     # Or massage this into action_completion for OpenAI and keep it for
@@ -39,7 +76,16 @@ class LLMBase:
     async def embed(self, query: str) -> List[float]:
         """Embeds a piece of text."""
 
+    @abstractmethod
+    async def embed_many(self, queries: List[str]) -> List[List[float]]:
+        """Embeds several pieces of text in one request. Order is preserved."""
+
     @property
     @abstractmethod
     def embedding_size(self) -> int:
         """Embedding size."""
+
+    @property
+    @abstractmethod
+    def metrics(self) -> LLMMetrics:
+        """Retry and failure counts of completions."""
@@ -0,0 +1,162 @@
+import math
+import re
+import zlib
+from collections import Counter
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from llm.base import LLMBase, LLMMetrics
+from schema import ActionCompletion, Message
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+# Hashing space for n-gram features before the random projection.
+_NUM_BUCKETS = 2**18
+# Non-zeros per row of the sparse random projection.
+_PROJECTION_DENSITY = 4
+_PROJECTION_SEED = 1337
+
+_projections: Dict[int, Tuple[NDArray[np.int32], NDArray[np.float32]]] = {}
+
+
+def _get_projection(dims: int) -> Tuple[NDArray[np.int32], NDArray[np.float32]]:
+    """A fixed very sparse random projection from the hashed feature space to
+    `dims`, stored as the output indices and signs of each bucket's non-zeros."""
+    if dims not in _projections:
+        rng = np.random.default_rng(_PROJECTION_SEED)
+        indices = rng.integers(
+            0, dims, size=(_NUM_BUCKETS, _PROJECTION_DENSITY), dtype=np.int32
+        )
+        signs = rng.choice(
+            np.array([-1.0, 1.0], dtype=np.float32),
+            size=(_NUM_BUCKETS, _PROJECTION_DENSITY),
+        )
+        _projections[dims] = (indices, signs)
+    return _projections[dims]
+
+
+def _features(text: str) -> Counter[int]:
+    """Hashed word unigrams, word bigrams and character trigrams of `text`."""
+    words = _TOKEN_PATTERN.findall(text.lower())
+    grams: List[str] = list(words)
+    grams += [f"{first} {second}" for first, second in zip(words, words[1:])]
+    for word in words:
+        padded = f"<{word}>"
+        grams += [f"#{padded[i : i + 3]}" for i in range(len(padded) - 2)]
+
+    return Counter(zlib.crc32(gram.encode()) % _NUM_BUCKETS for gram in grams)
+
+
+class HashedTfidfEmbedder:
+    """In-process text embedder. Hashes n-grams into a fixed feature space,
+    weights them by TF-IDF and projects down to `dims` with a fixed sparse random
+    projection. IDF weights are fitted on a corpus, typically one game's lore."""
+
+    def __init__(self, dims: int):
+        self._dims = dims
+        self._idf: NDArray[np.float32] = np.ones(_NUM_BUCKETS, dtype=np.float32)
+
+    @property
+    def dims(self) -> int:
+        return self._dims
+
+    def fit(self, corpus: List[str]) -> "HashedTfidfEmbedder":
+        document_frequency = np.zeros(_NUM_BUCKETS, dtype=np.float32)
+        for text in corpus:
+            document_frequency[list(_features(text).keys())] += 1
+
+        self._idf = (
+            np.log((1 + len(corpus)) / (1 + document_frequency)) + 1
+        ).astype(np.float32)
+        return self
+
+    def embed_many(self, texts: List[str]) -> NDArray[np.float32]:
+        rows: List[int] = []
+        buckets: List[int] = []
+        weights: List[float] = []
+        for row, text in enumerate(texts):
+            for bucket, count in _features(text).items():
+                rows.append(row)
+                buckets.append(bucket)
+                weights.append(1 + math.log(count))
+
+        bucket_array = np.array(buckets, dtype=np.int64)
+        row_array = np.array(rows, dtype=np.int64)
+        weight_array = np.array(weights, dtype=np.float32) * self._idf[bucket_array]
+
+        indices, signs = _get_projection(self._dims)
+        embeddings = np.zeros((len(texts), self._dims), dtype=np.float32)
+        for j in range(_PROJECTION_DENSITY):
+            np.add.at(
+                embeddings,
+                (row_array, indices[bucket_array, j]),
+                weight_array * signs[bucket_array, j],
+            )
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return embeddings / norms
+
+
+class LocalEmbeddingInterface(LLMBase):
+    """Embeds with a HashedTfidfEmbedder so retrieval never leaves the process.
+    Completions are delegated to `llm`."""
+
+    def __init__(self, llm: LLMBase, embedder: Optional[HashedTfidfEmbedder] = None):
+        self._llm = llm
+        self._embedder = embedder or HashedTfidfEmbedder(llm.embedding_size)
+
+    @classmethod
+    def fitted_on(cls, llm: LLMBase, corpus: List[str]) -> "LocalEmbeddingInterface":
+        return cls(llm, HashedTfidfEmbedder(llm.embedding_size).fit(corpus))
+
+    async def completion(
+        self, messages: List[Message], functions: List[Any]
+    ) -> Union[Message, ActionCompletion]:
+        return await self._llm.completion(messages, functions)
+
+    async def chat_completion(
+        self,
+        messages: List[Message],
+    ) -> Message:
+        return await self._llm.chat_completion(messages)
+
+    def chat_completion_stream(
+        self,
+        messages: List[Message],
+    ) -> AsyncIterator[str]:
+        return self._llm.chat_completion_stream(messages)
+
+    async def action_completion(
+        self, messages: List[Message], functions: List[Any]
+    ) -> Optional[ActionCompletion]:
+        return await self._llm.action_completion(messages, functions)
+
+    async def structured_completion(
+        self, messages: List[Message], tool: Dict[str, Any]
+    ) -> Optional[ActionCompletion]:
+        return await self._llm.structured_completion(messages, tool)
+
+    async def digit_completions(
+        self,
+        query_messages: List[List[Message]],
+    ) -> List[int]:
+        return await self._llm.digit_completions(query_messages)
+
+    async def embed(self, query: str) -> List[float]:
+        return self._embedder.embed_many([query])[0].tolist()
+
+    async def embed_many(self, queries: List[str]) -> List[List[float]]:
+        if not queries:
+            return []
+        return self._embedder.embed_many(queries).tolist()
+
+    @property
+    def embedding_size(self) -> int:
+        return self._embedder.dims
+
+    @property
+    def metrics(self) -> LLMMetrics:
+        return self._llm.metrics
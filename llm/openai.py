@@ -2,14 +2,14 @@ import asyncio
 import json
 import os
 import re
-from typing import Any, List, Optional, Union, Dict
+from typing import Any, AsyncIterator, List, Optional, Union, Dict
 
 from openai import AsyncOpenAI
 import httpx
 #from aiohttp import ClientSession
 
-from llm.base import LLMBase
-from schema import ActionCompletion, Message
+from llm.base import LLMBase, LLMMetrics
+from schema import ActionCompletion, ArgumentError, Message
 from abc import ABCMeta
 
 class Singleton(ABCMeta):
@@ -32,9 +32,12 @@ class OpenAIInterface(LLMBase, metaclass=Singleton):
         embedding_size: int = 1536,
         api_base: Optional[str] = None,
         client_session: Optional[httpx.AsyncClient] = None,
+        structured_output: bool = True,
     ) -> None:
         self._model = model
         self._embedding_size = embedding_size
+        self._structured_output = structured_output
+        self._metrics = LLMMetrics()
 
         if user_api_key == "":
             user_api_key = os.getenv("OPENAI_API_KEY")
@@ -71,19 +74,12 @@ class OpenAIInterface(LLMBase, metaclass=Singleton):
                 await self._client.chat.completions.create( # type: ignore
                     model=self._model,
                     messages=_parse_messages_arry(messages),
-                    tools=functions,
+                    tools=_as_tools(functions),
                 )
             ).choices[0].message
 
             if completion.tool_calls:
-                func_call = completion.tool_calls
-                # TODO: Sometimes the arguments are malformed.
-                try:
-                    args = json.loads(func_call.function.arguments)
-                except json.JSONDecodeError:
-                    args: Any = {}
-
-                return ActionCompletion(action=func_call.function.name, args=args)
+                return _parse_tool_call(completion.tool_calls[0])
             
             return Message(role="assistant", content=completion.content)
 
@@ -100,36 +96,47 @@ class OpenAIInterface(LLMBase, metaclass=Singleton):
 
         return Message(role="assistant", content=completion.content)
 
+    async def chat_completion_stream(
+        self,
+        messages: List[Message],
+    ) -> AsyncIterator[str]:
+        stream: Any = await self._client.chat.completions.create(  # type: ignore
+            messages=_parse_messages_arry(messages),
+            model=self._model,
+            stream=True,
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
     async def action_completion(
         self,
         messages: List[Message],
         functions: List[Any],
     ) -> Optional[ActionCompletion]:
-        retries = 3
+        tools = _as_tools(functions)
+        if self._structured_output:
+            return await self._forced_tool_completion("action", messages, tools)
 
-        for _ in range(retries):
+        # Don't mutate the caller's messages when asking the LLM to try again.
+        messages = list(messages)
+        for attempt in range(_MAX_ATTEMPTS):
             completion: Any = (
                 await self._client.chat.completions.create(  # type: ignore
                     model=self._model,
                     messages=_parse_messages_arry(messages),
-                    #change in openai 1.0.0 need to make it better
-                    #**chat_function_arguments,
-                    tools=functions,
+                    tools=tools,
                     tool_choice="auto",
                 )
             ).choices[0].message
 
             if completion.tool_calls:
-                func_call = completion.tool_calls
-                # TODO: Sometimes the arguments are malformed.
-                try:
-                    args = json.loads(func_call.function.arguments)
-                except json.JSONDecodeError:
-                    args: Any = {}
-
-                return ActionCompletion(action=func_call.function.name, args=args)
+                self._metrics.record("action", retries=attempt, succeeded=True)
+                return _parse_tool_call(completion.tool_calls[0])
 
-            messages.append(Message(role="assistant", content=completion["content"]))
+            messages.append(
+                Message(role="assistant", content=completion.content or "")
+            )
 
             messages.append(
                 Message(
@@ -138,8 +145,20 @@ class OpenAIInterface(LLMBase, metaclass=Singleton):
                 )
             )
 
+        self._metrics.record("action", retries=_MAX_ATTEMPTS - 1, succeeded=False)
         return None
 
+    async def structured_completion(
+        self,
+        messages: List[Message],
+        tool: Dict[str, Any],
+    ) -> Optional[ActionCompletion]:
+        if not self._structured_output:
+            return await self.action_completion(messages, [tool])
+        return await self._forced_tool_completion(
+            "structured", messages, _as_tools([tool])
+        )
+
     async def digit_completions(
         self,
         query_messages: List[List[Message]],
@@ -163,15 +182,64 @@ class OpenAIInterface(LLMBase, metaclass=Singleton):
             )
         ).data[0].embedding
 
+    async def embed_many(self, queries: List[str]) -> List[List[float]]:
+        if not queries:
+            return []
+
+        data = (
+            await self._client.embeddings.create(  # type: ignore
+                input=queries, model="text-embedding-ada-002"
+            )
+        ).data
+        data = sorted(data, key=lambda embedding: embedding.index)
+        return [embedding.embedding for embedding in data]
+
     @property
     def embedding_size(self) -> int:
         return self._embedding_size
+
+    @property
+    def metrics(self) -> LLMMetrics:
+        return self._metrics
     
     async def Close(self):
         await self._client.close()
 
+    async def _forced_tool_completion(
+        self,
+        kind: str,
+        messages: List[Message],
+        tools: List[Dict[str, Any]],
+    ) -> Optional[ActionCompletion]:
+        """Single round-trip tool call. The tool choice is forced up front instead
+        of asking again when the LLM answers with text."""
+        completion: Any = (
+            await self._client.chat.completions.create(  # type: ignore
+                model=self._model,
+                messages=_parse_messages_arry(messages),
+                tools=tools,
+                tool_choice=_forced_tool_choice(tools),
+            )
+        ).choices[0].message
+
+        if not completion.tool_calls:
+            self._metrics.record(kind, retries=0, succeeded=False)
+            return None
+
+        self._metrics.record(kind, retries=0, succeeded=True)
+        return _parse_tool_call(completion.tool_calls[0])
+
     async def _digit_completion_with_retries(self, messages: List[Message]) -> int:
-        for _ in range(3):
+        if self._structured_output:
+            completion = await self._forced_tool_completion(
+                "digit", messages, [_DIGIT_TOOL]
+            )
+            digit = completion.args.get("digit") if completion else None
+            return digit if isinstance(digit, int) and 0 <= digit <= 9 else -1
+
+        # Don't mutate the caller's messages when asking the LLM to try again.
+        messages = list(messages)
+        for attempt in range(_MAX_ATTEMPTS):
             text = str(
                 (
                     await self._client.chat.completions.create(  # type: ignore
@@ -183,9 +251,9 @@ class OpenAIInterface(LLMBase, metaclass=Singleton):
                 ).choices[0].message.content
             )
 
-            # TODO: error handle
             match = re.search(r"\d", text)
             if match:
+                self._metrics.record("digit", retries=attempt, succeeded=True)
                 return int(match.group())
 
             messages.append(Message(role="assistant", content=text))
@@ -197,9 +265,69 @@ class OpenAIInterface(LLMBase, metaclass=Singleton):
                 )
             )
 
+        self._metrics.record("digit", retries=_MAX_ATTEMPTS - 1, succeeded=False)
         return -1
 
 
+_MAX_ATTEMPTS = 3
+
+_DIGIT_TOOL: Dict[str, Any] = {
+    "type": "function",
+    "function": {
+        "name": "Digit",
+        "description": "Answers with a single digit.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "digit": {
+                    "type": "integer",
+                    "enum": list(range(10)),
+                }
+            },
+            "required": ["digit"],
+        },
+    },
+}
+
+
+def _as_tools(functions: List[Any]) -> List[Dict[str, Any]]:
+    """Accepts both tools and legacy function definitions."""
+    return [
+        function
+        if function.get("type") == "function"
+        else {"type": "function", "function": function}
+        for function in functions
+    ]
+
+
+def _forced_tool_choice(tools: List[Dict[str, Any]]) -> Any:
+    if len(tools) == 1:
+        name = tools[0]["function"]["name"]
+        return {"type": "function", "function": {"name": name}}
+    return "required"
+
+
+def _parse_tool_call(tool_call: Any) -> ActionCompletion:
+    # Sometimes the arguments are malformed.
+    try:
+        args = json.loads(tool_call.function.arguments)
+    except json.JSONDecodeError as e:
+        return ActionCompletion(
+            action=tool_call.function.name,
+            args={},
+            errors=[ArgumentError(kind="malformed", message=str(e))],
+        )
+
+    if not isinstance(args, dict):
+        return ActionCompletion(
+            action=tool_call.function.name,
+            args={},
+            errors=[ArgumentError(kind="malformed", message="Expected an object.")],
+        )
+
+    return ActionCompletion(action=tool_call.function.name, args=args)
+
+
 def _parse_messages_arry(
     messages: List[Message],
 ) -> Any:
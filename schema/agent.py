@@ -21,9 +21,20 @@ class Action(BaseModel):
     parameters: List[Parameter] = Field(default_factory=list)
 
 
+class ArgumentError(BaseModel):
+    parameter: str = ""
+    """The offending parameter. Empty if the error isn't about one parameter."""
+    kind: Literal[
+        "malformed", "unknown_action", "missing", "unexpected", "type", "enum"
+    ]
+    message: str
+
+
 class ActionCompletion(BaseModel):
     action: str
     args: Dict[str, Any]
+    errors: List[ArgumentError] = Field(default_factory=list)
+    """Why `args` don't match the Action's parameters. Empty if they're valid."""
 
 
 class AgentDef(BaseModel):
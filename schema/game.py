@@ -10,6 +10,11 @@ from schema.memory import Lore
 class Message(BaseModel):
     role: Literal["user", "system", "assistant"]
     content: str
+    memory_ids: List[str] = Field(default_factory=list)
+    """IDs of the memories the agent cited in this message, if any."""
+    lore_ids: List[str] = Field(default_factory=list)
+    """Client IDs of the lore this message is about, found by comparing the
+    embeddings of its sentences with the agent's memories."""
 
 
 class Conversation(BaseModel):
@@ -38,6 +43,30 @@ class Conversation(BaseModel):
     conversation, you may want to set this higher than default."""
 
 
+class GuardrailConfig(BaseModel):
+    """Configures the local first stage of the guardrail. Player lines it can't
+    confidently rate are sent to the LLM."""
+
+    in_tone_examples: List[str] = Field(default_factory=list)
+    """Lines that fit the tone and time period of the game."""
+
+    out_of_tone_examples: List[str] = Field(default_factory=list)
+    """Anachronistic, out of character or jailbreaking lines.
+    e.g. "Can I borrow your phone?" in a medieval game."""
+
+    blocklist: List[str] = Field(default_factory=list)
+    """Words or phrases that are always inappropriate. Case insensitive, and only
+    matched as whole words: "gun" doesn't block "begun"."""
+
+    pass_margin: float = 0.15
+    """Lines this much more similar to the closest in-tone example than to the closest
+    out-of-tone example are rated 5 without asking the LLM."""
+
+    block_margin: float = 0.15
+    """Lines this much more similar to the closest out-of-tone example than to the
+    closest in-tone example are rated 1 without asking the LLM."""
+
+
 class GameDef(BaseModel):
     uuid: UUID4 = Field(default_factory=uuid.uuid4)
     name: str
@@ -51,5 +80,7 @@ class GameDef(BaseModel):
     shared_lore: List[Lore] = Field(default_factory=list)
     """Lore/events/memories that more than one characters remember."""
 
+    guardrail: GuardrailConfig = Field(default_factory=GuardrailConfig)
+
     # TODO: add communities
     # communities:
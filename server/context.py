@@ -1,35 +1,87 @@
 from configparser import ConfigParser
+from typing import AsyncIterator, Optional
 
-from fastapi import Request
+from fastapi import Depends, HTTPException
 from fastapi_sso.sso.github import GithubSSO  # type: ignore
 from fastapi_sso.sso.google import GoogleSSO  # type: ignore
 from pydantic import UUID4
+from starlette.requests import HTTPConnection
 
 from game.session import Session
 from llm.base import LLMBase
+from server.util.agent_mailbox import AgentMailboxes
+from server.util.lore_ingest import LoreIngester
+from server.util.session_channel import SessionChannels
+from server.util.session_pool import SessionPool
+from server.util.session_store import SessionStore
+from server.util.session_warmup import SessionWarmups
+from server.util.sharding import ShardRouter
 
-SessionsType = dict[UUID4, Session]
+# Getters take an HTTPConnection so that WebSocket endpoints can use them too.
 
 
-def get_redis(request: Request):
+def get_redis(request: HTTPConnection):
     return request.state.redis_client
 
 
-def get_sessions(request: Request) -> SessionsType:
-    return request.state.sessions
+def get_session_store(request: HTTPConnection) -> SessionStore:
+    return request.state.session_store
 
 
-def get_config_parser(request: Request) -> ConfigParser:
+async def get_session(
+    session_uuid: str, store: SessionStore = Depends(get_session_store)
+) -> AsyncIterator[Session]:
+    """The session at the `session_uuid` path parameter. 404 if there is none.
+    Whatever the request changed in the session is saved once it's handled."""
+    try:
+        session_key = UUID4(session_uuid)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    async with store.checkout(session_key) as session:
+        if session is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        yield session
+
+
+def get_agent_mailboxes(request: HTTPConnection) -> AgentMailboxes:
+    return request.state.agent_mailboxes
+
+
+def get_session_channels(request: HTTPConnection) -> SessionChannels:
+    return request.state.session_channels
+
+
+def get_session_warmups(request: HTTPConnection) -> SessionWarmups:
+    return request.state.session_warmups
+
+
+def get_shard_router(request: HTTPConnection) -> Optional[ShardRouter]:
+    # Only set when running as a cluster.
+    return getattr(request.state, "shard_router", None)
+
+
+def get_lore_ingester(request: HTTPConnection) -> Optional[LoreIngester]:
+    # Only set when lore is precomputed.
+    return getattr(request.state, "lore_ingester", None)
+
+
+def get_session_pool(request: HTTPConnection) -> Optional[SessionPool]:
+    # Only set when some games have a pool.
+    return getattr(request.state, "session_pool", None)
+
+
+def get_config_parser(request: HTTPConnection) -> ConfigParser:
     return request.state.parser
 
 
-def get_llm(request: Request) -> LLMBase:
+def get_llm(request: HTTPConnection) -> LLMBase:
     return request.state.llm
 
 
-def get_google_sso(request: Request) -> GoogleSSO:
+def get_google_sso(request: HTTPConnection) -> GoogleSSO:
     return request.state.google_sso
 
 
-def get_github_sso(request: Request) -> GithubSSO:
+def get_github_sso(request: HTTPConnection) -> GithubSSO:
     return request.state.github_sso
@@ -1,30 +1,44 @@
+import asyncio
 import configparser
 import logging
 import os
-import pickle
 from contextlib import asynccontextmanager
-from typing import List
+from typing import List, Optional
 
 #from aiohttp import ClientSession
 import httpx
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi_limiter import FastAPILimiter  # type: ignore
+from pydantic import UUID4
 from redis.asyncio import Redis
 
 from llm.openai import OpenAIInterface
 from schema import GameDef
-from server.context import SessionsType
 from server.router import (
     agent_def_handlers,
     authorization_handlers,
+    channel_handlers,
     game_def_handlers,
     llm_handlers,
     session_handlers,
     util_handlers,
 )
 from server.typecheck_fighter import pipeline_exec
+from server.util.agent_mailbox import AgentMailboxes
 from server.util.json_loader import load_games_from_path
+from server.util.lore_ingest import LoreIngester
+from server.util.session_channel import SessionChannels
+from server.util.session_builder import build_session
+from server.util.session_pool import SessionPool, parse_pool_sizes
+from server.util.session_store import (
+    RedisSessionStore,
+    SessionStore,
+    StatelessSessionStore,
+    register_unindexed_sessions,
+)
+from server.util.session_warmup import SessionWarmups
+from server.util.sharding import ShardRouter, route_to_owner
 from server.util.sso import generate_github_sso, generate_google_sso
 
 GAMES_DEFS_SET = "GAME_DEFS"
@@ -38,7 +52,6 @@ async def lifespan(app: FastAPI):
         host="localhost",
         port=6379,
     )
-    sessions: SessionsType = {}
     parser = configparser.ConfigParser()
     parser.read("config.ini")
 
@@ -48,6 +61,10 @@ async def lifespan(app: FastAPI):
     key = parser.get("llm", "openai_api_key", fallback="Dummy key")
     chat_model = parser.get("llm", "chat_model")
     embedding_size = parser.getint("llm", "embedding_size")
+    # Local models may not support forcing a tool choice, so they keep retrying.
+    structured_output = parser.getboolean(
+        "llm", "structured_output", fallback=not use_local_llm
+    )
 
     google_sso = generate_google_sso(parser=parser)
     github_sso = generate_github_sso(parser=parser)
@@ -60,8 +77,98 @@ async def lifespan(app: FastAPI):
         api_base=api_base,
         embedding_size=embedding_size,
         client_session=openai_http_client,
+        structured_output=structured_output,
     )
 
+    async def load_session(session_uuid: UUID4, game_def: GameDef):
+        return await build_session(
+            game_def, llm, parser, session_uuid, fill_memories=False
+        )
+
+    idle_minutes = parser.getfloat("sessions", "idle_ttl_minutes", fallback=0)
+    memory_budget_mb = parser.getfloat("sessions", "memory_budget_mb", fallback=0)
+    memory_budget = int(memory_budget_mb * 2**20) if memory_budget_mb else None
+    stateless = parser.getboolean("sessions", "stateless", fallback=False)
+    session_store: SessionStore
+    if stateless:
+        session_store = StatelessSessionStore(
+            redis_client, load_session, memory_budget=memory_budget
+        )
+    else:
+        session_store = RedisSessionStore(
+            redis_client,
+            load_session,
+            idle_ttl=idle_minutes * 60 if idle_minutes else None,
+            memory_budget=memory_budget,
+        )
+    registered = await register_unindexed_sessions(redis_client)
+    if registered:
+        logging.info("Registered %d sessions saved before the registry", registered)
+    eviction_task = asyncio.create_task(
+        session_store.run_eviction(
+            parser.getfloat("sessions", "eviction_interval_seconds", fallback=60)
+        )
+    )
+
+    agent_mailboxes = AgentMailboxes(
+        parser.getint("sessions", "agent_mailbox_size", fallback=8)
+    )
+    session_warmups = SessionWarmups(
+        parser.getint("sessions", "warmup_concurrency", fallback=4)
+    )
+
+    shard_router: Optional[ShardRouter] = None
+    shard_task: Optional["asyncio.Task[None]"] = None
+    if parser.getboolean("cluster", "enabled", fallback=False):
+        if not isinstance(session_store, RedisSessionStore):
+            raise ValueError("[cluster] can't be enabled with stateless sessions")
+        # Each worker process advertises its own address, so it's read from the
+        # environment before the shared config.
+        address = os.environ.get(
+            "EASTWORLD_ADVERTISE_ADDRESS", parser.get("cluster", "advertise_address")
+        )
+        heartbeat_interval = parser.getfloat(
+            "cluster", "heartbeat_interval_seconds", fallback=5
+        )
+        secret = os.environ.get(
+            "EASTWORLD_CLUSTER_SECRET", parser.get("cluster", "secret", fallback="")
+        )
+        if not secret:
+            raise ValueError("[cluster] needs a secret to sign forwarded requests")
+        shard_router = ShardRouter(
+            redis_client,
+            session_store,
+            worker_id=address,
+            address=address,
+            secret=secret,
+            redirect=parser.getboolean("cluster", "redirect", fallback=False),
+            heartbeat_ttl=3 * heartbeat_interval,
+        )
+        await shard_router.join()
+        shard_task = asyncio.create_task(shard_router.run(heartbeat_interval))
+
+    lore_ingester: Optional[LoreIngester] = None
+    if parser.getboolean("embedding", "precompute_lore", fallback=True):
+        lore_ingester = LoreIngester(redis_client, llm, parser)
+
+    session_pool: Optional[SessionPool] = None
+    pool_task: Optional["asyncio.Task[None]"] = None
+    pool_sizes = parse_pool_sizes(parser.get("session_pool", "games", fallback=""))
+    if pool_sizes:
+        session_pool = SessionPool(
+            redis_client,
+            llm,
+            parser,
+            pool_sizes,
+            ingester=lore_ingester,
+            concurrency=parser.getint("session_pool", "refill_concurrency", fallback=2),
+        )
+        pool_task = asyncio.create_task(
+            session_pool.run(
+                parser.getfloat("session_pool", "refill_interval_seconds", fallback=30)
+            )
+        )
+
     await FastAPILimiter.init(redis_client)  # type: ignore
 
     dev_mode = parser.getboolean("server", "dev_mode", fallback=False)
@@ -73,9 +180,6 @@ async def lifespan(app: FastAPI):
         handler = logging.StreamHandler()
         logger.addHandler(handler)
 
-        resp = await redis_client.get("sessions")
-        if resp:
-            sessions = pickle.loads(resp)
         game_defs = load_existing_game_defs_from_json(
             parser.get("server", "game_defs_path", fallback="")
         )
@@ -84,22 +188,40 @@ async def lifespan(app: FastAPI):
             pipe.set(str(game.uuid), game.json(), nx=True)
             pipe.sadd(GAMES_DEFS_SET, str(game.uuid))
         await pipeline_exec(pipe)
+        if lore_ingester:
+            for game in game_defs:
+                lore_ingester.schedule(str(game.uuid))
 
     yield {
         "redis_client": redis_client,
-        "sessions": sessions,
+        "session_store": session_store,
+        "agent_mailboxes": agent_mailboxes,
+        "session_warmups": session_warmups,
+        "session_channels": SessionChannels(),
+        "shard_router": shard_router,
+        "lore_ingester": lore_ingester,
+        "session_pool": session_pool,
         "parser": parser,
         "llm": llm,
         "google_sso": google_sso,
         "github_sso": github_sso,
     }
     
+    eviction_task.cancel()
+    await session_warmups.close()
+    if pool_task:
+        pool_task.cancel()
+    if shard_task:
+        shard_task.cancel()
+    await session_store.close()
+    if lore_ingester:
+        await lore_ingester.close()
+    if shard_router:
+        await shard_router.leave()
+
     #await openai_http_client.aclose()
     await llm.Close()
 
-    if dev_mode:
-        await redis_client.set("sessions", pickle.dumps(sessions))
-
     await redis_client.close()
 
 def get_redis(request: Request):
@@ -120,6 +242,8 @@ app = FastAPI(
     lifespan=lifespan,
 )
 
+app.middleware("http")(route_to_owner)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -133,4 +257,5 @@ app.include_router(llm_handlers.router)
 app.include_router(game_def_handlers.router)
 app.include_router(agent_def_handlers.router)
 app.include_router(session_handlers.router)
+app.include_router(channel_handlers.router)
 app.include_router(authorization_handlers.router)
@@ -1,26 +1,39 @@
-from typing import List
+from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import UUID4
 
 from schema import AgentDef
-from server.context import get_redis
+from server.context import get_lore_ingester, get_redis, get_session_pool
 from server.router.game_def_handlers import get_game_def, update_game_def
 from server.typecheck_fighter import RedisType
+from server.util.lore_ingest import LoreIngester
+from server.util.session_pool import SessionPool
 
 router = APIRouter(prefix="/game/{game_uuid}/agent", tags=["Agent Definitions"])
 
 
 @router.post("/create", operation_id="create_agent", response_model=AgentDef)
 async def create_agent_def(
-    game_uuid: str, agent_name: str, redis: RedisType = Depends(get_redis)
+    game_uuid: str,
+    agent_name: str,
+    redis: RedisType = Depends(get_redis),
+    ingester: Optional[LoreIngester] = Depends(get_lore_ingester),
+    pool: Optional[SessionPool] = Depends(get_session_pool),
 ):
     game = await get_game_def(game_uuid, redis)
 
     agent = AgentDef(name=agent_name)
     game.agents.append(agent)
 
-    await update_game_def(game_uuid, game=game, overwrite_agents=True, redis=redis)
+    await update_game_def(
+        game_uuid,
+        game=game,
+        overwrite_agents=True,
+        redis=redis,
+        ingester=ingester,
+        pool=pool,
+    )
 
     return agent
 
@@ -54,6 +67,8 @@ async def update_agent_def(
     agent_uuid: str,
     agent: AgentDef,
     redis: RedisType = Depends(get_redis),
+    ingester: Optional[LoreIngester] = Depends(get_lore_ingester),
+    pool: Optional[SessionPool] = Depends(get_session_pool),
 ):
     game = await get_game_def(game_uuid, redis)
 
@@ -67,7 +82,14 @@ async def update_agent_def(
 
     game.agents[index] = agent
 
-    await update_game_def(game_uuid, game=game, overwrite_agents=True, redis=redis)
+    await update_game_def(
+        game_uuid,
+        game=game,
+        overwrite_agents=True,
+        redis=redis,
+        ingester=ingester,
+        pool=pool,
+    )
 
     return agent
 
@@ -77,9 +99,18 @@ async def delete_agent_def(
     game_uuid: str,
     agent_uuid: str,
     redis: RedisType = Depends(get_redis),
+    ingester: Optional[LoreIngester] = Depends(get_lore_ingester),
+    pool: Optional[SessionPool] = Depends(get_session_pool),
 ):
     game = await get_game_def(game_uuid, redis)
 
     game.agents = [agent for agent in game.agents if str(agent.uuid) != agent_uuid]
 
-    await update_game_def(game_uuid, game=game, overwrite_agents=True, redis=redis)
+    await update_game_def(
+        game_uuid,
+        game=game,
+        overwrite_agents=True,
+        redis=redis,
+        ingester=ingester,
+        pool=pool,
+    )
@@ -0,0 +1,145 @@
+import json
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, WebSocket
+from pydantic import UUID4, ValidationError
+
+from server.context import (
+    get_agent_mailboxes,
+    get_session_channels,
+    get_session_store,
+    get_session_warmups,
+    get_shard_router,
+)
+from server.router.session_handlers import get_gen_agent, run_operation, run_turn
+from server.schema.batch import BatchResult
+from server.schema.channel import (
+    ChannelEvent,
+    ChannelRequest,
+    ChannelResult,
+    ChannelToken,
+)
+from server.security.auth import authenticate_websocket
+from server.util.agent_mailbox import AgentMailboxes
+from server.util.session_channel import SessionChannel, SessionChannels
+from server.util.session_store import SessionStore
+from server.util.session_warmup import SessionWarmups
+from server.util.sharding import ShardRouter
+
+router = APIRouter(prefix="/session", tags=["Game Sessions"])
+
+# Close code sent when another worker serves the session. The reason is its
+# address, to reconnect to.
+SESSION_MOVED = 4307
+
+# Operations that change the conversation, which other channels are told about.
+_EVENT_OPS = {"start_chat", "chat", "interact", "act"}
+
+
+@router.websocket("/{session_uuid}/channel")
+async def session_channel(
+    websocket: WebSocket,
+    session_uuid: str,
+    store: SessionStore = Depends(get_session_store),
+    mailboxes: AgentMailboxes = Depends(get_agent_mailboxes),
+    warmups: SessionWarmups = Depends(get_session_warmups),
+    channels: SessionChannels = Depends(get_session_channels),
+    shard_router: Optional[ShardRouter] = Depends(get_shard_router),
+    _: None = Depends(authenticate_websocket),
+):
+    """A WebSocket for every operation of a session, authenticated once when it
+    opens.
+
+    The client sends ChannelRequests: a BatchOperation with an `id` of its
+    choosing. Requests are handled concurrently, and those for the same agent in
+    the order they were sent. Each gets a ChannelResult with its `id` when it's
+    done, preceded by ChannelTokens if it was a chat with `stream` set. Other
+    channels of the session receive a ChannelEvent whenever a request changes an
+    agent's conversation."""
+    await websocket.accept()
+    try:
+        session_key = UUID4(session_uuid)
+    except ValueError:
+        await websocket.close(code=1008, reason="Session not found")
+        return
+    if not await store.exists(session_key):
+        await websocket.close(code=1008, reason="Session not found")
+        return
+
+    channel = SessionChannel(websocket)
+
+    async def handle(raw: str):
+        try:
+            request = ChannelRequest.parse_raw(raw)
+        except ValidationError as e:
+            await channel.send(
+                ChannelResult(id=_request_id(raw), status_code=422, error=str(e))
+            )
+            return
+
+        if shard_router:
+            address = await shard_router.route(session_key)
+            if address is not None:
+                await channel.close(SESSION_MOVED, address)
+                return
+
+        result = await run_request(request)
+        await channel.send(
+            ChannelResult(
+                id=request.id,
+                status_code=result.status_code,
+                result=result.result,
+                error=result.error,
+            )
+        )
+
+    async def run_request(request: ChannelRequest) -> BatchResult:
+        async def on_token(token: str):
+            await channel.send(ChannelToken(id=request.id, token=token))
+
+        async with store.checkout(session_key) as session:
+            if session is None:
+                return BatchResult(index=0, status_code=404, error="Session not found")
+            try:
+                gen_agent = get_gen_agent(request.agent, session)
+                result = await run_turn(
+                    mailboxes,
+                    warmups,
+                    store,
+                    session,
+                    gen_agent,
+                    lambda session, gen_agent: run_operation(
+                        0,
+                        request,
+                        session,
+                        store,
+                        gen_agent,
+                        on_token if request.stream else None,
+                    ),
+                )
+            except HTTPException as e:
+                return BatchResult(index=0, status_code=e.status_code, error=e.detail)
+
+        if result.status_code == 200 and request.op in _EVENT_OPS:
+            channels.push(
+                session_key,
+                ChannelEvent(op=request.op, agent=gen_agent.name, result=result.result),
+                sender=channel,
+            )
+        return result
+
+    channels.add(session_key, channel)
+    try:
+        await channel.serve(handle)
+    finally:
+        channels.remove(session_key, channel)
+
+
+def _request_id(raw: str) -> Optional[str]:
+    """The id of a request that isn't valid, if it has one."""
+    try:
+        request = json.loads(raw)
+    except ValueError:
+        return None
+    request_id = request.get("id") if isinstance(request, dict) else None
+    return request_id if isinstance(request_id, str) else None
@@ -1,14 +1,16 @@
-from typing import List, Union
+from typing import List, Optional, Union
 
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.encoders import jsonable_encoder
 from pydantic import UUID4
 
 from schema import GameDef, Lore
-from server.context import get_redis
+from server.context import get_lore_ingester, get_redis, get_session_pool
 from server.schema.summary import GameDefSummary
 from server.security.auth import authenticate, password_protected
 from server.typecheck_fighter import RedisType, pipeline_exec
+from server.util.lore_ingest import LoreIngester, lore_key
+from server.util.session_pool import SessionPool
 
 router = APIRouter(
     prefix="/game",
@@ -102,9 +104,18 @@ async def get_game_def_json(
 async def update_game_def_json(
     jsoned_game: str,
     redis: RedisType = Depends(get_redis),
+    ingester: Optional[LoreIngester] = Depends(get_lore_ingester),
+    pool: Optional[SessionPool] = Depends(get_session_pool),
 ):
     game: GameDef = GameDef.parse_raw(jsoned_game)
-    await update_game_def(str(game.uuid), game, overwrite_agents=True, redis=redis)
+    await update_game_def(
+        str(game.uuid),
+        game,
+        overwrite_agents=True,
+        redis=redis,
+        ingester=ingester,
+        pool=pool,
+    )
 
 
 @router.put(
@@ -118,28 +129,26 @@ async def update_game_def(
     game: GameDef,
     overwrite_agents: bool = False,
     redis: RedisType = Depends(get_redis),
+    ingester: Optional[LoreIngester] = Depends(get_lore_ingester),
+    pool: Optional[SessionPool] = Depends(get_session_pool),
 ):
     game.uuid = UUID4(uuid)
-    pipe = redis.pipeline()
-    if overwrite_agents:
-        pipe.set(uuid, game.json())
-        pipe.sadd(GAME_DEFS_SET, uuid)
-        await pipeline_exec(pipe)
-        return game
+    if not overwrite_agents:
+        jsoned = await redis.get(uuid)
+        if jsoned:
+            old_game = GameDef.parse_raw(jsoned)
+            if old_game.agents:
+                game.agents = old_game.agents
 
-    jsoned = await redis.get(uuid)
-    if not jsoned:
-        pipe.set(uuid, game.json())
-        pipe.sadd(GAME_DEFS_SET, uuid)
-        await pipeline_exec(pipe)
-        return game
-
-    old_game = GameDef.parse_raw(jsoned)
-    if old_game.agents:
-        game.agents = old_game.agents
+    pipe = redis.pipeline()
     pipe.set(uuid, game.json())
     pipe.sadd(GAME_DEFS_SET, uuid)
     await pipeline_exec(pipe)
+    if ingester:
+        # Embeds new lore now, rather than when a session starts.
+        ingester.schedule(uuid)
+    if pool:
+        pool.invalidate(uuid)
     return game
 
 
@@ -151,8 +160,11 @@ async def update_game_def(
 async def delete_game_def(
     uuid: str,
     redis: RedisType = Depends(get_redis),
+    pool: Optional[SessionPool] = Depends(get_session_pool),
 ):
     pipe = redis.pipeline()
-    pipe.delete(uuid)
+    pipe.delete(uuid, lore_key(uuid))
     pipe.srem(GAME_DEFS_SET, uuid)
     await pipeline_exec(pipe)
+    if pool:
+        pool.invalidate(uuid)
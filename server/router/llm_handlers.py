@@ -1,4 +1,5 @@
-from typing import List
+from dataclasses import asdict
+from typing import Dict, List
 
 from fastapi import APIRouter, Depends
 
@@ -28,14 +29,24 @@ async def rate(
     question: str,
     llm: LLMBase = Depends(get_llm),
 ) -> int:
-    rating = await llm.action_completion(
+    rating = await llm.structured_completion(
         [
             Message(
                 role="system",
                 content=question + " Please use the provided Rate() function.",
             )
         ],
-        [get_rate_function()],
+        get_rate_function(),
     )
 
     return rating_to_int(rating)
+
+
+@router.get(
+    "/metrics", operation_id="llm_metrics", response_model=Dict[str, Dict[str, int]]
+)
+async def metrics(
+    llm: LLMBase = Depends(get_llm),
+) -> Dict[str, Dict[str, int]]:
+    """Number of completions, retries and failures by kind of completion."""
+    return {kind: asdict(stats) for kind, stats in llm.metrics.stats.items()}
@@ -1,89 +1,159 @@
 import asyncio
+import logging
 import uuid
 from configparser import ConfigParser
+from dataclasses import asdict
 from typing import (
-    Awaitable, 
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
     List, 
     Optional,
+    Tuple,
+    TypeVar,
+    Union,
 )
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from pydantic import UUID4
 
 from game.agent import GenAgent
-from game.memory import GenAgentMemory
 from game.session import Session
-from game.ti_retriever import TIRetriever
 from llm.base import LLMBase
 from schema import (
     AgentDef,
     Conversation,
     GameDef,
-    Knowledge,
-    Lore,
-    MemoryConfig,
     Message,
 )
 from server.context import (
-    SessionsType,
+    get_agent_mailboxes,
     get_config_parser,
     get_llm,
+    get_lore_ingester,
     get_redis,
-    get_sessions,
+    get_session,
+    get_session_pool,
+    get_session_store,
+    get_session_warmups,
+    get_shard_router,
 )
 from server.router.game_def_handlers import get_game_def
+from server.schema.batch import BatchOperation, BatchResult
 from server.schema.debug import (
     ActionCompletionWithDebug,
     InteractWithDebug,
     MessageWithDebug,
+    Suggestion,
+    SuggestionsWithDebug,
 )
+from server.schema.readiness import AgentReadiness, SessionReadiness
+from server.schema.registry import GameSessionStats
+from server.schema.sync import SessionSync
 from server.security.auth import authenticate
 from server.typecheck_fighter import RedisType
+from server.util.agent_mailbox import AgentMailboxes, MailboxFull
+from server.util.embedding_backend import get_game_llm
+from server.util.lore_ingest import LoreIngester
 from server.util.rate_limit import rate_limiter
+from server.util.session_builder import build_session
+from server.util.session_pool import SessionPool
+from server.util.session_store import (
+    SessionConflict,
+    SessionStore,
+    StatelessSessionStore,
+)
+from server.util.session_sync import LoreVectors, sync_session
+from server.util.session_warmup import SessionWarmups, WarmupFailed
+from server.util.sharding import ShardRouter, is_forwarded
 
 router = APIRouter(prefix="/session", tags=["Game Sessions"])
 
+T = TypeVar("T")
 
-def get_gen_agent(agent: str, session: Session):
-    gen_agent = next(
-        (gen_agent for gen_agent in session.agents if str(gen_agent.uuid) == agent),
-        None,
-    )
+
+def get_gen_agent(agent: str, session: Session) -> GenAgent:
+    try:
+        gen_agent = session.get_agent(agent)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if not gen_agent:
-        gen_agent = next(
-            (gen_agent for gen_agent in session.agents if gen_agent.name == agent),
-            None,
-        )
-        if not gen_agent:
-            raise HTTPException(status_code=404, detail="Agent not found")
+        raise HTTPException(status_code=404, detail="Agent not found")
 
     return gen_agent
 
 
 def get_agent_def(agent: str, session: Session) -> AgentDef:
-    agent_def = next(
-        (
-            gen_agent
-            for gen_agent in session.game_def.agents
-            if str(gen_agent.uuid) == agent
-        ),
-        None,
-    )
+    try:
+        agent_def = session.get_agent_def(agent)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if not agent_def:
-        agent_def = next(
-            (
-                gen_agent
-                for gen_agent in session.game_def.agents
-                if gen_agent.name == agent
-            ),
-            None,
-        )
-        if not agent_def:
-            raise HTTPException(status_code=404, detail="Agent not found")
+        raise HTTPException(status_code=404, detail="Agent not found")
 
     return agent_def
 
 
+async def commit_session(session: Session, store: SessionStore) -> None:
+    """Saves a turn before responding, so that losing a race with a concurrent
+    request for the same session is reported instead of silently dropped."""
+    try:
+        await store.save(session)
+    except SessionConflict:
+        raise HTTPException(
+            status_code=409,
+            detail="Session was changed by a concurrent request, retry",
+        )
+
+
+async def run_turn(
+    mailboxes: AgentMailboxes,
+    warmups: SessionWarmups,
+    store: SessionStore,
+    session: Session,
+    gen_agent: GenAgent,
+    turn: Callable[[Session, GenAgent], Awaitable[T]],
+) -> T:
+    """Runs `turn` on the session and agent once the agent is warmed up and its
+    earlier turns are done. 429 if too many are already waiting, 503 if the
+    agent failed to warm up.
+
+    If other turns saved the session while this one waited, e.g. with a
+    StatelessSessionStore, it runs on a fresh checkout of the session instead
+    of the request's, which has fallen behind."""
+    try:
+        await warmups.wait(session.uuid, gen_agent.uuid)
+    except WarmupFailed as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"{gen_agent.name} failed to warm up: {e}",
+            headers={"Retry-After": "1"},
+        )
+
+    async def job() -> T:
+        if await store.is_current(session):
+            return await turn(session, gen_agent)
+        async with store.checkout(session.uuid) as current:
+            if current is None:
+                raise HTTPException(status_code=404, detail="Session not found")
+            current_agent = current.get_agent(str(gen_agent.uuid))
+            if current_agent is None:
+                raise HTTPException(status_code=404, detail="Agent not found")
+            return await turn(current, current_agent)
+
+    try:
+        return await mailboxes.send(session.uuid, gen_agent.uuid, job)
+    except MailboxFull:
+        raise HTTPException(
+            status_code=429,
+            detail=f"{gen_agent.name} is busy, retry later",
+            headers={"Retry-After": "1"},
+        )
+
+
 @router.post(
     "/create",
     operation_id="create_session",
@@ -91,109 +161,228 @@ def get_agent_def(agent: str, session: Session) -> AgentDef:
     dependencies=[Depends(authenticate)],
 )
 async def create_session(
+    request: Request,
     game_uuid: str,
-    sessions: SessionsType = Depends(get_sessions),
+    warm_up: bool = False,
+    first_agent: Optional[str] = None,
+    store: SessionStore = Depends(get_session_store),
+    warmups: SessionWarmups = Depends(get_session_warmups),
+    shard_router: Optional[ShardRouter] = Depends(get_shard_router),
     config_parser: ConfigParser = Depends(get_config_parser),
     redis: RedisType = Depends(get_redis),
     llm: LLMBase = Depends(get_llm),
+    ingester: Optional[LoreIngester] = Depends(get_lore_ingester),
+    pool: Optional[SessionPool] = Depends(get_session_pool),
 ):
     """Given a Game, creates a game session and populates the Agents
-    with their lore and knowledge.
+    with their lore and knowledge. Games with a session pool hand out one of
+    its sessions instead, if it has any.
 
     <h3>Args:</h3>
 
     - **game_uuid** (uuid4 as str): The uuid of the GameDef that this session will
     populate from.
+    - **warm_up** (bool): return right away and populate the Agents in the
+    background. Turns of an Agent wait until it's populated; see
+    /session/{session_uuid}/active for progress. Ignored with stateless sessions
+    or when another worker owns the session.
+    - **first_agent** (str): uuid or name of the Agent to populate first when
+    warming up, e.g. the one the player talks to first.
 
     <h3>Returns:</h3>
     - **session_uuid** (uuid4 as str): the uuid of the session created
     """
+    # Set by authenticate when auth is required.
+    owner = getattr(request.state, "email", None)
     game_def = await get_game_def(game_uuid, redis)
-
-    memory_config = MemoryConfig(
-        max_memories=config_parser.getint(
-            "memory_config", "max_memories", fallback=1024
-        ),
-        memories_returned=config_parser.getint(
-            "memory_config", "default_memories_returned", fallback=5
-        ),
-        embedding_dims=llm.embedding_size,
+    session = pool.take(game_def) if pool else None
+    if session:
+        await store.add(session, owner)
+        if shard_router:
+            await shard_router.adopt(session.uuid)
+        return str(session.uuid)
+
+    if ingester:
+        await ingester.apply(game_def)
+
+    session_uuid = uuid.uuid4()
+    # Warming up needs the session to stay in this worker's memory.
+    warm_up = (
+        warm_up
+        and not isinstance(store, StatelessSessionStore)
+        and not (shard_router and not shard_router.owns(session_uuid))
     )
-
-    # TODO: embed personal lore at the same time as this
-    async def lore_task(lore: Lore):
-        lore.memory.embedding = await llm.embed(lore.memory.description)
-
-    set_lore_coroutines: List[Awaitable[None]] = []
-    for shared_lore in game_def.shared_lore:
-        #shared_lore.memory.embedding = await llm.embed(shared_lore.memory.description)
-        set_lore_coroutines.append(lore_task(shared_lore))
-
-    await asyncio.gather(*set_lore_coroutines)
-
-    #agents : List[GenAgent] = []
-    awaitable_agents: List[Awaitable[GenAgent]] = []
-    for agent_def in game_def.agents:
-        knowledge = Knowledge(
-            game_description=game_def.description,
-            agent_def=agent_def,
-            shared_lore=game_def.shared_lore,
-        )
-
-        memory = GenAgentMemory(
-            memory_config.memories_returned,
-            TIRetriever(memory_config),
-        )
-
-        awaitable_agents.append(GenAgent.create(knowledge, memory))
-        #agents.append(await GenAgent.create(knowledge, llm, memory))
-
-    agents = await asyncio.gather(*awaitable_agents)
-    session = Session(uuid=uuid.uuid4(), game_def=game_def, agents=agents)
-    sessions[session.uuid] = session
+    session = await build_session(
+        game_def, llm, config_parser, session_uuid, fill_memories=not warm_up
+    )
+    await store.add(session, owner)
+    if shard_router:
+        await shard_router.adopt(session.uuid)
+    if warm_up:
+        warmups.start(session, store, first_agent)
 
     return str(session.uuid)
 
 
 @router.get("/list", operation_id="list_sessions", response_model=List[str])
-def get_sessions_list(
-    game_uuid: str,
-    sessions: SessionsType = Depends(get_sessions),
+async def get_sessions_list(
+    game_uuid: Optional[str] = None,
+    owner: Optional[str] = None,
+    after: Optional[UUID4] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    store: SessionStore = Depends(get_session_store),
 ):
-    """Lists all active sessions for a given Game.
+    """Lists the active sessions of a given Game and/or owner, ordered by uuid.
 
     <h3>Args:</h3>
 
     - **game_uuid** (uuid4 as str): The uuid of the GameDef
+    - **owner** (str): The email of the user the sessions were created for
+    - **after** (uuid4 as str): Only list the sessions after this one, e.g. the
+    last session of the previous page
+    - **limit** (int): The most sessions to list
 
     <h3>Returns:</h3>
     - **session_uuids** (List[uuid4] as List[str]): the uuids of the sessions
     """
-    return [
-        str(session.uuid)
-        for session in sessions.values()
-        if str(session.game_def.uuid) == game_uuid
-    ]
+    session_uuids = await store.list_uuids(game_uuid, owner, after, limit)
+    return [str(session_uuid) for session_uuid in session_uuids]
+
+
+@router.get("/stats", operation_id="session_stats", response_model=GameSessionStats)
+async def session_stats(
+    game_uuid: str,
+    store: SessionStore = Depends(get_session_store),
+):
+    """Counts of the active sessions of a given Game, their agents and the
+    memory they hold, and when one last changed."""
+    return await store.stats(game_uuid)
 
 @router.get(
         "/Clear", operation_id="clear_sessions", dependencies=[Depends(authenticate)]
 )
-def clear_sessions(
-    sessions: SessionsType = Depends(get_sessions),
+async def clear_sessions(
+    request: Request,
+    store: SessionStore = Depends(get_session_store),
+    shard_router: Optional[ShardRouter] = Depends(get_shard_router),
 ):
     """Clears all active sessions for a given Game."""
     
-    sessions.clear()
+    await store.clear()
+    if shard_router and not is_forwarded(request):
+        await shard_router.broadcast(request)
     
 
+@router.delete(
+    "/clear", operation_id="clear_game_sessions", dependencies=[Depends(authenticate)]
+)
+async def clear_game_sessions(
+    request: Request,
+    game_uuid: str,
+    store: SessionStore = Depends(get_session_store),
+    shard_router: Optional[ShardRouter] = Depends(get_shard_router),
+):
+    """Deletes every session of a given Game, in memory and in storage.
+
+    <h3>Args:</h3>
+
+    - **game_uuid** (uuid4 as str): The uuid of the GameDef
+
+    <h3>Returns:</h3>
+    - **session_uuids** (List[uuid4] as List[str]): the uuids of the deleted sessions
+    """
+    deleted = await store.delete_game(game_uuid)
+    if shard_router and not is_forwarded(request):
+        await shard_router.broadcast(request)
+    return [str(session_uuid) for session_uuid in deleted]
+
+
+@router.delete(
+    "/{session_uuid}", operation_id="delete_session", dependencies=[Depends(authenticate)]
+)
+async def delete_session(
+    session_uuid: str,
+    store: SessionStore = Depends(get_session_store),
+    warmups: SessionWarmups = Depends(get_session_warmups),
+):
+    """Deletes a session, in memory and in storage. 404 if there is none."""
+    try:
+        session_key = UUID4(session_uuid)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if not await store.exists(session_key):
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    warmups.discard(session_key)
+    await store.delete(session_key)
+
+
 @router.get(
-    "/{session_uuid}/active", operation_id="is_session_active", response_model=bool
+    "/{session_uuid}/active",
+    operation_id="is_session_active",
+    response_model=Union[SessionReadiness, bool],
 )
-def is_session_active(
+async def is_session_active(
     session_uuid: str,
-    sessions: SessionsType = Depends(get_sessions),
+    agents: bool = False,
+    store: SessionStore = Depends(get_session_store),
+    warmups: SessionWarmups = Depends(get_session_warmups),
 ):
-    return uuid.UUID(session_uuid, version=4) in sessions.keys()
+    """Whether the session exists. With `agents`, also whether each of its Agents
+    is warmed up, as a SessionReadiness."""
+    session_key = uuid.UUID(session_uuid, version=4)
+    active = await store.exists(session_key)
+    if not agents:
+        return active
+
+    session = await store.get(session_key) if active else None
+    if session is None:
+        return SessionReadiness(active=False, ready=False, agents=[])
+
+    warmup = warmups.get(session_key)
+    readiness = [
+        AgentReadiness(
+            uuid=gen_agent.uuid,
+            name=gen_agent.name,
+            ready=warmup.is_ready(gen_agent.uuid) if warmup else True,
+            error=warmup.error(gen_agent.uuid) if warmup else None,
+        )
+        for gen_agent in session.agents
+    ]
+    return SessionReadiness(
+        active=True,
+        ready=all(agent.ready for agent in readiness),
+        agents=readiness,
+    )
+
+
+@router.get("/metrics", operation_id="mailbox_metrics", response_model=Dict[str, float])
+async def mailbox_metrics(
+    mailboxes: AgentMailboxes = Depends(get_agent_mailboxes),
+) -> Dict[str, float]:
+    """How many turns the agent mailboxes accepted, rejected with a 429 and
+    completed, how long turns waited for the agent, and how many are waiting or
+    in flight right now."""
+    return {
+        **asdict(mailboxes.metrics),
+        "queued": mailboxes.queued,
+        "busy_agents": mailboxes.busy_agents,
+    }
+
+
+@router.get(
+    "/pool/metrics", operation_id="session_pool_metrics", response_model=Dict[str, float]
+)
+async def session_pool_metrics(
+    pool: Optional[SessionPool] = Depends(get_session_pool),
+) -> Dict[str, float]:
+    """How many sessions the session pool handed out and how many creations
+    found it empty, how many pooled sessions were dropped because their GameDef
+    changed, how long building pooled sessions took, and how many are pooled
+    right now. Empty when no game has a pool."""
+    if pool is None:
+        return {}
+    return {**asdict(pool.metrics), "pooled": pool.pooled}
 
 
 @router.post(
@@ -202,12 +391,14 @@ def is_session_active(
     dependencies=[Depends(authenticate)],
 )
 async def start_conversation(
-    session_uuid: str,
     agent: str,
     history: Optional[List[Message]] = None,
     correspondent: Optional[str] = None,
     conversation: Optional[Conversation] = None,
-    sessions: SessionsType = Depends(get_sessions),
+    session: Session = Depends(get_session),
+    store: SessionStore = Depends(get_session_store),
+    mailboxes: AgentMailboxes = Depends(get_agent_mailboxes),
+    warmups: SessionWarmups = Depends(get_session_warmups),
 ):
     """Starts a chat with the given agent. Clears previous conversation
     history.
@@ -224,15 +415,36 @@ async def start_conversation(
     <h3>Returns:</h3>
     - none
     """
-    session = sessions[UUID4(session_uuid)]
     gen_agent = get_gen_agent(agent, session)
+
+    await run_turn(
+        mailboxes,
+        warmups,
+        store,
+        session,
+        gen_agent,
+        lambda session, gen_agent: start_chat_turn(
+            session, store, gen_agent, history, correspondent, conversation
+        ),
+    )
+
+
+async def start_chat_turn(
+    session: Session,
+    store: SessionStore,
+    gen_agent: GenAgent,
+    history: Optional[List[Message]],
+    correspondent: Optional[str],
+    conversation: Optional[Conversation],
+) -> None:
     if not conversation:
         conversation = Conversation()
 
     if correspondent:
         conversation = Conversation(correspondent=get_agent_def(correspondent, session))
 
-    return gen_agent.startConversation(conversation, history or [])
+    gen_agent.startConversation(conversation, history or [])
+    await commit_session(session, store)
 
 
 @router.post(
@@ -242,11 +454,13 @@ async def start_conversation(
     dependencies=[Depends(authenticate), Depends(rate_limiter)],
 )
 async def chat(
-    session_uuid: str,
     agent: str,
     message: str,
     send_debug: bool = False,
-    sessions: SessionsType = Depends(get_sessions),
+    session: Session = Depends(get_session),
+    store: SessionStore = Depends(get_session_store),
+    mailboxes: AgentMailboxes = Depends(get_agent_mailboxes),
+    warmups: SessionWarmups = Depends(get_session_warmups),
 ) -> MessageWithDebug:
     """Sends `message` to the given agent. They will respond with text.
 
@@ -262,10 +476,30 @@ async def chat(
     message_with_debug.message.content. Optional debug information in
     message_with_debug.debug.
     """
-    session = sessions[UUID4(session_uuid)]
     gen_agent = get_gen_agent(agent, session)
 
-    response, debug = await gen_agent.chat(message)
+    return await run_turn(
+        mailboxes,
+        warmups,
+        store,
+        session,
+        gen_agent,
+        lambda session, gen_agent: chat_turn(
+            session, store, gen_agent, message, send_debug
+        ),
+    )
+
+
+async def chat_turn(
+    session: Session,
+    store: SessionStore,
+    gen_agent: GenAgent,
+    message: str,
+    send_debug: bool,
+    on_token: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> MessageWithDebug:
+    response, debug = await gen_agent.chat(message, on_token)
+    await commit_session(session, store)
 
     msg_with_debug = MessageWithDebug(message=response)
     if send_debug:
@@ -274,6 +508,79 @@ async def chat(
     return msg_with_debug
 
 
+@router.post(
+    "/{session_uuid}/suggest",
+    operation_id="suggest",
+    response_model=SuggestionsWithDebug,
+    dependencies=[Depends(authenticate), Depends(rate_limiter)],
+)
+async def suggest(
+    agent: str,
+    message: Optional[str] = None,
+    count: int = Query(default=4, ge=1, le=16),
+    guardrail: bool = False,
+    send_debug: bool = False,
+    session: Session = Depends(get_session),
+    store: SessionStore = Depends(get_session_store),
+    mailboxes: AgentMailboxes = Depends(get_agent_mailboxes),
+    warmups: SessionWarmups = Depends(get_session_warmups),
+) -> SuggestionsWithDebug:
+    """Suggests `count` alternative lines the agent could say next, e.g. dialogue
+    options for a playable character, with a single completion. The conversation
+    history is left untouched; send the chosen line through /chat or /interact.
+
+    <h3>Args:</h3>
+
+    - **session_uuid** (str): the uuid of the session
+    - **agent** (str): either the uuid or the name of the agent.
+    - **message** (Optional[str]): what was just said to the agent, if anything
+    - **count** (int): how many lines to suggest, from 1 to 16
+    - **guardrail** (bool): also rate each suggestion like /guardrail_many
+    - **send_debug** (bool): sends optional debugging information
+
+    <h3>Returns:</h3>
+    - **suggestions_with_debug** (SuggestionsWithDebug): at most `count` distinct
+    lines in suggestions_with_debug.suggestions, with their guardrail rating if
+    requested. Optional debug information in suggestions_with_debug.debug.
+    """
+    gen_agent = get_gen_agent(agent, session)
+
+    return await run_turn(
+        mailboxes,
+        warmups,
+        store,
+        session,
+        gen_agent,
+        lambda session, gen_agent: suggest_turn(
+            gen_agent, message, count, guardrail, send_debug
+        ),
+    )
+
+
+async def suggest_turn(
+    gen_agent: GenAgent,
+    message: Optional[str],
+    count: int,
+    guardrail: bool,
+    send_debug: bool,
+) -> SuggestionsWithDebug:
+    suggestions, ratings, debug = await gen_agent.suggest(message, count, guardrail)
+
+    suggestions_with_debug = SuggestionsWithDebug(
+        suggestions=[
+            Suggestion(
+                message=suggestion,
+                appropriateness=ratings[index] if ratings else None,
+            )
+            for index, suggestion in enumerate(suggestions)
+        ]
+    )
+    if send_debug:
+        suggestions_with_debug.debug = debug
+
+    return suggestions_with_debug
+
+
 @router.post(
     "/{session_uuid}/interact",
     operation_id="interact",
@@ -281,11 +588,13 @@ async def chat(
     dependencies=[Depends(authenticate), Depends(rate_limiter)],
 )
 async def interact(
-    session_uuid: str,
     agent: str,
     message: str,
     send_debug: bool = False,
-    sessions: SessionsType = Depends(get_sessions),
+    session: Session = Depends(get_session),
+    store: SessionStore = Depends(get_session_store),
+    mailboxes: AgentMailboxes = Depends(get_agent_mailboxes),
+    warmups: SessionWarmups = Depends(get_session_warmups),
 ):
     """Sends message to the given agent. They will respond with
     an Action or text.
@@ -303,10 +612,29 @@ async def interact(
     ActionCompletion
     Optional debug information in message_with_debug.debug.
     """
-    session = sessions[UUID4(session_uuid)]
     gen_agent = get_gen_agent(agent, session)
 
+    return await run_turn(
+        mailboxes,
+        warmups,
+        store,
+        session,
+        gen_agent,
+        lambda session, gen_agent: interact_turn(
+            session, store, gen_agent, message, send_debug
+        ),
+    )
+
+
+async def interact_turn(
+    session: Session,
+    store: SessionStore,
+    gen_agent: GenAgent,
+    message: str,
+    send_debug: bool,
+) -> InteractWithDebug:
     response, debug = await gen_agent.interact(message)
+    await commit_session(session, store)
 
     response_with_debug = InteractWithDebug(response=response)
 
@@ -323,11 +651,13 @@ async def interact(
     dependencies=[Depends(authenticate), Depends(rate_limiter)],
 )
 async def act(
-    session_uuid: str,
     agent: str,
     message: Optional[str],
     send_debug: bool = False,
-    sessions: SessionsType = Depends(get_sessions),
+    session: Session = Depends(get_session),
+    store: SessionStore = Depends(get_session_store),
+    mailboxes: AgentMailboxes = Depends(get_agent_mailboxes),
+    warmups: SessionWarmups = Depends(get_session_warmups),
 ):
     """Asks the given agent to perform an action. Optionally
     after sending a message.
@@ -344,10 +674,30 @@ async def act(
     in response_with_debug.action.
     Optional debug information in message_with_debug.debug.
     """
-    session = sessions[UUID4(session_uuid)]
     gen_agent = get_gen_agent(agent, session)
 
+    return await run_turn(
+        mailboxes,
+        warmups,
+        store,
+        session,
+        gen_agent,
+        lambda session, gen_agent: act_turn(
+            session, store, gen_agent, message, send_debug
+        ),
+    )
+
+
+async def act_turn(
+    session: Session,
+    store: SessionStore,
+    gen_agent: GenAgent,
+    message: Optional[str],
+    send_debug: bool,
+) -> ActionCompletionWithDebug:
     action, debug = await gen_agent.act(message)
+    await commit_session(session, store)
+
     action_with_debug = ActionCompletionWithDebug(action=action)
 
     if send_debug:
@@ -363,10 +713,9 @@ async def act(
     dependencies=[Depends(authenticate)],
 )
 async def guardrail(
-    session_uuid: str,
     agent: str,
     message: str,
-    sessions: SessionsType = Depends(get_sessions),
+    session: Session = Depends(get_session),
 ):
     """Asks whether or not what the player is saying is appropriate given
     the time period, tone, and intent of the game.
@@ -379,14 +728,43 @@ async def guardrail(
 
     <h3>Returns:</h3>
     - **appropriateness** (int): number from 1-5. 1 = very inappropriate,
-    5 = very appropriate. Return -1 on LLM error
+    5 = very appropriate. Return -1 on LLM error. Lines that match the
+    GameDef's guardrail blocklist or examples are rated without the LLM.
     """
-    session = sessions[UUID4(session_uuid)]
     gen_agent = get_gen_agent(agent, session)
 
     return await gen_agent.guardrail(message)
 
 
+@router.post(
+    "/{session_uuid}/guardrail_many",
+    operation_id="guardrail_many",
+    response_model=List[int],
+    dependencies=[Depends(authenticate)],
+)
+async def guardrail_many(
+    agent: str,
+    messages: List[str],
+    session: Session = Depends(get_session),
+):
+    """Like guardrail, but rates several candidate lines at once, e.g. the
+    options of a dialogue menu, with a single LLM completion.
+
+    <h3>Args:</h3>
+
+    - **session_uuid** (str): the uuid of the session
+    - **agent** (str): either the uuid or the name of the agent.
+    - **messages** (List[str]): the lines the player could say to the agent
+
+    <h3>Returns:</h3>
+    - **appropriateness** (List[int]): one number from 1-5 per message, in the
+    same order. 1 = very inappropriate, 5 = very appropriate. -1 on LLM error
+    """
+    gen_agent = get_gen_agent(agent, session)
+
+    return await gen_agent.guardrail_many(messages)
+
+
 @router.post(
     "/{session_uuid}/query",
     operation_id="query",
@@ -394,10 +772,13 @@ async def guardrail(
     dependencies=[Depends(authenticate)],
 )
 async def query(
-    session_uuid: str,
     agent: str,
     queries: List[str],
-    sessions: SessionsType = Depends(get_sessions),
+    batched: bool = True,
+    session: Session = Depends(get_session),
+    store: SessionStore = Depends(get_session_store),
+    mailboxes: AgentMailboxes = Depends(get_agent_mailboxes),
+    warmups: SessionWarmups = Depends(get_session_warmups),
 ):
     """Responds to queries into how the Agent is feeling during conversation
     with the player. Write in second person. You can use {player} to refer
@@ -416,54 +797,251 @@ async def query(
     - **session_uuid** (str): the uuid of the session
     - **agent** (str): either the uuid or the name of the agent.
     - **queries** (List[str]): list of queries you want to know about agent
+    - **batched** (bool): answer all queries with a single LLM completion. Queries
+    it fails to answer are retried individually.
 
     <h3>Returns:</h3>
     - **appropriateness** (List[int]): number from 1-5. 1 = not at all,
     5 = extremely. Returns -1 on LLM error
     """
-    session = sessions[UUID4(session_uuid)]
     gen_agent = get_gen_agent(agent, session)
 
-    return await gen_agent.query(queries)
+    return await run_turn(
+        mailboxes,
+        warmups,
+        store,
+        session,
+        gen_agent,
+        lambda session, gen_agent: gen_agent.query(queries, batched),
+    )
+
+
+@router.post(
+    "/{session_uuid}/batch",
+    operation_id="batch",
+    response_model=List[BatchResult],
+    dependencies=[Depends(authenticate), Depends(rate_limiter)],
+)
+async def batch(
+    operations: List[BatchOperation],
+    stream: bool = False,
+    session: Session = Depends(get_session),
+    store: SessionStore = Depends(get_session_store),
+    mailboxes: AgentMailboxes = Depends(get_agent_mailboxes),
+    warmups: SessionWarmups = Depends(get_session_warmups),
+):
+    """Runs several calls to the endpoints of a session (start_chat, chat,
+    interact, act, query, guardrail, guardrail_many and suggest) in one request,
+    e.g. everything a game tick needs. Operations for different agents
+    run concurrently; those for the same agent run in the order given, as one
+    turn of that agent.
+
+    <h3>Args:</h3>
+
+    - **session_uuid** (str): the uuid of the session
+    - **operations** (List[BatchOperation]): `op` names the endpoint, and the
+    other fields are its arguments.
+    - **stream** (bool): send each result as soon as it's done, as one JSON
+    object per line, instead of all of them at the end
+
+    <h3>Returns:</h3>
+    - **results** (List[BatchResult]): one per operation, in order. Each has the
+    status code the endpoint would have returned, and either its result or an
+    error.
+    """
+    results = run_batch(operations, session, store, mailboxes, warmups)
+    if stream:
+        return StreamingResponse(
+            (result.json() + "\n" async for result in results),
+            media_type="application/x-ndjson",
+        )
+
+    return sorted([result async for result in results], key=lambda r: r.index)
+
+
+async def run_batch(
+    operations: List[BatchOperation],
+    session: Session,
+    store: SessionStore,
+    mailboxes: AgentMailboxes,
+    warmups: SessionWarmups,
+) -> AsyncIterator[BatchResult]:
+    """Yields the result of each operation as soon as it's done."""
+    operations_by_agent: Dict[UUID4, List[Tuple[int, BatchOperation]]] = {}
+    gen_agents: Dict[UUID4, GenAgent] = {}
+    for index, operation in enumerate(operations):
+        try:
+            gen_agent = get_gen_agent(operation.agent, session)
+        except HTTPException as e:
+            yield BatchResult(index=index, status_code=e.status_code, error=e.detail)
+            continue
+        gen_agents[gen_agent.uuid] = gen_agent
+        operations_by_agent.setdefault(gen_agent.uuid, []).append((index, operation))
+
+    done: "asyncio.Queue[BatchResult]" = asyncio.Queue()
+
+    async def agent_turn(gen_agent: GenAgent, indexed: List[Tuple[int, BatchOperation]]):
+        async def turn(session: Session, gen_agent: GenAgent):
+            for index, operation in indexed:
+                done.put_nowait(
+                    await run_operation(index, operation, session, store, gen_agent)
+                )
+
+        try:
+            await run_turn(mailboxes, warmups, store, session, gen_agent, turn)
+        except HTTPException as e:
+            for index, _ in indexed:
+                done.put_nowait(
+                    BatchResult(index=index, status_code=e.status_code, error=e.detail)
+                )
+
+    tasks = [
+        asyncio.create_task(agent_turn(gen_agents[agent_uuid], indexed))
+        for agent_uuid, indexed in operations_by_agent.items()
+    ]
+    try:
+        for _ in range(sum(len(indexed) for indexed in operations_by_agent.values())):
+            yield await done.get()
+    finally:
+        # The client went away. Turns already running finish in their mailbox.
+        for task in tasks:
+            task.cancel()
+
+
+async def run_operation(
+    index: int,
+    operation: BatchOperation,
+    session: Session,
+    store: SessionStore,
+    gen_agent: GenAgent,
+    on_token: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> BatchResult:
+    """Runs one operation of a batch. With `on_token`, chat responses are
+    streamed to it as they're generated."""
+    message = operation.message or ""
+    try:
+        if operation.op == "start_chat":
+            result: Any = await start_chat_turn(
+                session,
+                store,
+                gen_agent,
+                operation.history,
+                operation.correspondent,
+                operation.conversation,
+            )
+        elif operation.op == "chat":
+            result = await chat_turn(
+                session, store, gen_agent, message, operation.send_debug, on_token
+            )
+        elif operation.op == "interact":
+            result = await interact_turn(
+                session, store, gen_agent, message, operation.send_debug
+            )
+        elif operation.op == "act":
+            result = await act_turn(
+                session, store, gen_agent, operation.message, operation.send_debug
+            )
+        elif operation.op == "query":
+            result = await gen_agent.query(operation.queries, operation.batched)
+        elif operation.op == "guardrail_many":
+            result = await gen_agent.guardrail_many(operation.messages)
+        elif operation.op == "suggest":
+            result = await suggest_turn(
+                gen_agent,
+                operation.message,
+                operation.count,
+                operation.guardrail,
+                operation.send_debug,
+            )
+        else:
+            result = await gen_agent.guardrail(message)
+    except HTTPException as e:
+        return BatchResult(index=index, status_code=e.status_code, error=e.detail)
+    except Exception as e:
+        logging.exception("Batch operation %d (%s) failed", index, operation.op)
+        return BatchResult(index=index, status_code=500, error=str(e))
+    return BatchResult(index=index, result=result)
+
+
+# Sessions synced at the same time on this worker.
+_SYNC_CONCURRENCY = 16
 
 
 @router.put(
     "/sync",
     operation_id="sync_sessions_to_game_defs",
+    response_model=List[SessionSync],
     dependencies=[Depends(authenticate)],
 )
 async def updateSessions(
+    request: Request,
     game_uuid: str,
-    sessions: SessionsType = Depends(get_sessions),
+    store: SessionStore = Depends(get_session_store),
+    warmups: SessionWarmups = Depends(get_session_warmups),
+    shard_router: Optional[ShardRouter] = Depends(get_shard_router),
+    config_parser: ConfigParser = Depends(get_config_parser),
     redis: RedisType = Depends(get_redis),
+    llm: LLMBase = Depends(get_llm),
+    ingester: Optional[LoreIngester] = Depends(get_lore_ingester),
 ):
+    """Applies the changes made to a GameDef to its sessions: agents that were
+    added or removed, and lore that was added, removed, changed or is known by
+    other agents. Only lore an agent didn't already know is embedded; the rest
+    of its memories and its conversation are kept.
+
+    <h3>Returns:</h3>
+    - What changed, per session synced by this worker. With several workers,
+    each syncs the sessions it holds.
+    """
     jsoned = await redis.get(game_uuid)
     if not jsoned:
         raise HTTPException(status_code=404, detail="Game not found")
 
     updated_game = GameDef.parse_raw(jsoned)
-
-    matching_sessions = [
-        session
-        for session in sessions.values()
-        if str(session.game_def.uuid) == game_uuid
+    if ingester:
+        await ingester.apply(updated_game)
+    game_llm = get_game_llm(updated_game, llm, config_parser)
+    lore_vectors = LoreVectors(game_llm)
+
+    if shard_router and not is_forwarded(request):
+        # Every worker updates the sessions it holds.
+        await shard_router.broadcast(request)
+
+    syncing = asyncio.Semaphore(_SYNC_CONCURRENCY)
+
+    async def sync(session_uuid: UUID4) -> Optional[SessionSync]:
+        async with syncing:
+            while True:
+                async with store.checkout(session_uuid) as session:
+                    if not session:
+                        return None
+                    warmup = warmups.get(session.uuid)
+                    cold_agents = [
+                        gen_agent.uuid
+                        for gen_agent in session.agents
+                        if warmup and not warmup.is_ready(gen_agent.uuid)
+                    ]
+                    diff = await sync_session(
+                        session,
+                        updated_game.copy(deep=True),
+                        game_llm,
+                        config_parser,
+                        lore_vectors,
+                        cold_agents,
+                    )
+                    try:
+                        await store.save(session)
+                        return SessionSync(session_uuid=session.uuid, diff=diff)
+                    except SessionConflict:
+                        # A turn was saved in between; apply the update to it.
+                        continue
+
+    session_uuids = [
+        session_uuid
+        for session_uuid in await store.list_uuids(game_uuid)
+        if not (shard_router and await shard_router.route(session_uuid) is not None)
     ]
-
-    for session in matching_sessions:
-        session.game_def = updated_game
-        for gen_agent in session.agents:
-            matching_agent_def = next(
-                (
-                    agent_def
-                    for agent_def in updated_game.agents
-                    if agent_def.uuid == gen_agent.uuid
-                ),
-                None,
-            )
-            if matching_agent_def:
-                knowledge = Knowledge(
-                    game_description=updated_game.description,
-                    agent_def=matching_agent_def,
-                    shared_lore=updated_game.shared_lore,
-                )
-                gen_agent.updateKnowledge(knowledge)
+    synced = await asyncio.gather(
+        *[sync(session_uuid) for session_uuid in session_uuids]
+    )
+    return [session_sync for session_sync in synced if session_sync]
@@ -0,0 +1,71 @@
+from typing import List, Literal, Optional, Union
+
+from pydantic import BaseModel, Field, root_validator
+
+from schema import Conversation, Message
+from server.schema.debug import (
+    ActionCompletionWithDebug,
+    InteractWithDebug,
+    MessageWithDebug,
+    SuggestionsWithDebug,
+)
+
+
+class BatchOperation(BaseModel):
+    """One call to a session endpoint, with the same arguments as the endpoint
+    of that name."""
+
+    op: Literal[
+        "start_chat",
+        "chat",
+        "interact",
+        "act",
+        "query",
+        "guardrail",
+        "guardrail_many",
+        "suggest",
+    ]
+    agent: str
+    message: Optional[str] = None
+    messages: List[str] = Field(default_factory=list)
+    queries: List[str] = Field(default_factory=list)
+    batched: bool = True
+    count: int = Field(default=4, ge=1, le=16)
+    guardrail: bool = False
+    conversation: Optional[Conversation] = None
+    history: Optional[List[Message]] = None
+    correspondent: Optional[str] = None
+    send_debug: bool = False
+
+    @root_validator(skip_on_failure=True)
+    def check_arguments(cls, values):
+        op = values["op"]
+        if op in ("chat", "interact", "guardrail") and values["message"] is None:
+            raise ValueError(f"{op} needs a message")
+        if op == "query" and not values["queries"]:
+            raise ValueError("query needs queries")
+        if op == "guardrail_many" and not values["messages"]:
+            raise ValueError("guardrail_many needs messages")
+        return values
+
+
+# Models with required fields first, so each result keeps its own type.
+OperationResult = Optional[
+    Union[
+        SuggestionsWithDebug,
+        MessageWithDebug,
+        InteractWithDebug,
+        ActionCompletionWithDebug,
+        List[int],
+        int,
+    ]
+]
+
+
+class BatchResult(BaseModel):
+    index: int
+    """Position of the operation in the batch."""
+    status_code: int = 200
+    """What the endpoint of the operation would have returned."""
+    result: OperationResult = None
+    error: Optional[str] = None
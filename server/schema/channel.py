@@ -0,0 +1,39 @@
+from typing import Literal, Optional
+
+from pydantic import BaseModel
+
+from server.schema.batch import BatchOperation, OperationResult
+
+
+class ChannelRequest(BatchOperation):
+    """A BatchOperation sent over a session channel."""
+
+    id: str
+    """Chosen by the client, and sent back with everything about this request."""
+    stream: bool = False
+    """Send the tokens of a chat response as they're generated."""
+
+
+class ChannelResult(BaseModel):
+    type: Literal["result"] = "result"
+    id: Optional[str]
+    """None if the request isn't valid JSON or has no id."""
+    status_code: int = 200
+    result: OperationResult = None
+    error: Optional[str] = None
+
+
+class ChannelToken(BaseModel):
+    type: Literal["token"] = "token"
+    id: str
+    token: str
+
+
+class ChannelEvent(BaseModel):
+    """Sent to every other channel of the session when a request changed the
+    conversation of an agent, e.g. for other players to see."""
+
+    type: Literal["event"] = "event"
+    op: str
+    agent: str
+    result: OperationResult = None
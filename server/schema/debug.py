@@ -18,3 +18,14 @@ class ActionCompletionWithDebug(BaseModel):
 class InteractWithDebug(BaseModel):
     response: Union[Message, ActionCompletion]
     debug: List[Message] = Field(default_factory=list)
+
+
+class Suggestion(BaseModel):
+    message: Message
+    appropriateness: Optional[int] = None
+    """Guardrail rating from 1-5, or -1 on LLM error. None if not requested."""
+
+
+class SuggestionsWithDebug(BaseModel):
+    suggestions: List[Suggestion]
+    debug: List[Message] = Field(default_factory=list)
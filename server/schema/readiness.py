@@ -0,0 +1,20 @@
+from typing import List, Optional
+
+from pydantic import UUID4, BaseModel
+
+
+class AgentReadiness(BaseModel):
+    uuid: UUID4
+    name: str
+    ready: bool
+    """Whether the agent's memories are filled. Turns of an agent that isn't
+    ready wait until it is."""
+    error: Optional[str] = None
+    """Why the agent failed to warm up. It's tried again on its next turn."""
+
+
+class SessionReadiness(BaseModel):
+    active: bool
+    ready: bool
+    """Whether every agent is ready."""
+    agents: List[AgentReadiness]
@@ -0,0 +1,14 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class GameSessionStats(BaseModel):
+    game_uuid: str
+    sessions: int = 0
+    agents: int = 0
+    memory_bytes: int = 0
+    """Bytes held by the agents' memory retrievers, as of each session's last
+    save."""
+    last_activity: Optional[float] = None
+    """Unix time of the last save that changed one of the game's sessions."""
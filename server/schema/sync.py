@@ -0,0 +1,27 @@
+from typing import List
+
+from pydantic import UUID4, BaseModel, Field
+
+
+class GameDefDiff(BaseModel):
+    """What changed between the GameDef a session was running and the one it was
+    synced to. Lore is listed by description."""
+
+    agents_added: List[UUID4] = Field(default_factory=list)
+    agents_removed: List[UUID4] = Field(default_factory=list)
+    agents_changed: List[UUID4] = Field(default_factory=list)
+    lore_added: List[str] = Field(default_factory=list)
+    lore_removed: List[str] = Field(default_factory=list)
+    lore_changed: List[str] = Field(default_factory=list)
+    """Shared lore with the same client_id, or description, whose content
+    changed."""
+    known_by_changed: List[str] = Field(default_factory=list)
+    """Shared lore now known by other agents."""
+    personal_lore_added: List[str] = Field(default_factory=list)
+    personal_lore_removed: List[str] = Field(default_factory=list)
+    personal_lore_changed: List[str] = Field(default_factory=list)
+
+
+class SessionSync(BaseModel):
+    session_uuid: UUID4
+    diff: GameDefDiff
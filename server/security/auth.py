@@ -1,7 +1,7 @@
 from configparser import ConfigParser
 from typing import Optional
 
-from fastapi import Depends, Header, HTTPException
+from fastapi import Depends, Header, HTTPException, WebSocket, WebSocketException, status
 from fastapi.security import (
     HTTPAuthorizationCredentials,
     HTTPBearer,
@@ -58,6 +58,31 @@ class OAuth2Bearer(HTTPBearer):
 authenticate = OAuth2Bearer(bearerFormat="bearerToken")
 
 
+async def authenticate_websocket(
+    websocket: WebSocket, parser: ConfigParser = Depends(get_config_parser)
+):
+    """Like authenticate, for WebSockets. The token cookie is only verified once,
+    when the connection opens."""
+    if not parser.getboolean("server", "auth_required", fallback=False):
+        return
+    token: Optional[str] = websocket.cookies.get("token")
+    if not token:
+        raise WebSocketException(
+            code=status.WS_1008_POLICY_VIOLATION,
+            reason="No token provided in cookies",
+        )
+    try:
+        user = verify_token(token, parser)
+    except HTTPException as e:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+    if "email" not in user:
+        raise WebSocketException(
+            code=status.WS_1008_POLICY_VIOLATION, reason="No email provided."
+        )
+
+    websocket.state.email = user["email"]
+
+
 def password_protected(
     password: str = Header(None), parser: ConfigParser = Depends(get_config_parser)
 ):
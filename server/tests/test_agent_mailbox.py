@@ -0,0 +1,85 @@
+import asyncio
+import uuid
+
+import pytest
+
+from server.util.agent_mailbox import AgentMailboxes, MailboxFull
+
+
+async def test_turns_for_one_agent_run_one_at_a_time():
+    mailboxes = AgentMailboxes(capacity=8)
+    session_uuid, king, serf = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    running = {king: 0, serf: 0}
+    most_running = {king: 0, serf: 0}
+    order = []
+
+    async def turn(agent_uuid, index):
+        running[agent_uuid] += 1
+        most_running[agent_uuid] = max(most_running[agent_uuid], running[agent_uuid])
+        await asyncio.sleep(0.01)
+        order.append((agent_uuid, index))
+        running[agent_uuid] -= 1
+        return index
+
+    results = await asyncio.gather(
+        *[
+            mailboxes.send(
+                session_uuid, agent_uuid, lambda a=agent_uuid, i=index: turn(a, i)
+            )
+            for index in range(3)
+            for agent_uuid in (king, serf)
+        ]
+    )
+
+    assert results == [0, 0, 1, 1, 2, 2]
+    assert most_running == {king: 1, serf: 1}
+    assert [index for agent_uuid, index in order if agent_uuid == king] == [0, 1, 2]
+    # The two agents took turns in parallel.
+    assert order[:2] == [(king, 0), (serf, 0)]
+    assert mailboxes.metrics.completed == 6
+    assert mailboxes.busy_agents == 0
+
+
+async def test_full_mailbox_rejects_turns():
+    mailboxes = AgentMailboxes(capacity=1)
+    session_uuid, agent_uuid = uuid.uuid4(), uuid.uuid4()
+    release = asyncio.Event()
+
+    async def slow_turn():
+        await release.wait()
+        return "done"
+
+    in_flight = asyncio.create_task(mailboxes.send(session_uuid, agent_uuid, slow_turn))
+    waiting = asyncio.create_task(mailboxes.send(session_uuid, agent_uuid, slow_turn))
+    await asyncio.sleep(0)
+
+    with pytest.raises(MailboxFull):
+        await mailboxes.send(session_uuid, agent_uuid, slow_turn)
+    assert mailboxes.queued == 1
+
+    release.set()
+    assert await asyncio.gather(in_flight, waiting) == ["done", "done"]
+    assert mailboxes.metrics.accepted == 2
+    assert mailboxes.metrics.rejected == 1
+    assert mailboxes.metrics.max_depth == 1
+    assert mailboxes.metrics.max_wait_ms > 0
+
+
+async def test_failed_turn_does_not_stop_the_mailbox():
+    mailboxes = AgentMailboxes(capacity=8)
+    session_uuid, agent_uuid = uuid.uuid4(), uuid.uuid4()
+
+    async def failing_turn():
+        raise RuntimeError("LLM error")
+
+    async def turn():
+        return 5
+
+    failed, succeeded = await asyncio.gather(
+        mailboxes.send(session_uuid, agent_uuid, failing_turn),
+        mailboxes.send(session_uuid, agent_uuid, turn),
+        return_exceptions=True,
+    )
+
+    assert isinstance(failed, RuntimeError)
+    assert succeeded == 5
@@ -0,0 +1,118 @@
+import configparser
+import uuid
+from typing import Any
+from unittest import TestCase
+from unittest.mock import AsyncMock, MagicMock
+
+from starlette.testclient import TestClient
+
+from game.session import Session
+from schema import AgentDef, GameDef, Message
+from server.context import (
+    get_agent_mailboxes,
+    get_config_parser,
+    get_session_channels,
+    get_session_store,
+    get_session_warmups,
+)
+from server.main import app
+from server.util.agent_mailbox import AgentMailboxes
+from server.util.session_channel import SessionChannels
+from server.util.session_store import InMemorySessionStore
+from server.util.session_warmup import SessionWarmups
+
+
+def create_gen_agent(agent_def: AgentDef) -> Any:
+    gen_agent = MagicMock()
+    gen_agent.uuid = agent_def.uuid
+    gen_agent.name = agent_def.name
+    gen_agent.guardrail = AsyncMock(return_value=5)
+    return gen_agent
+
+
+async def streamed_chat(message: str, on_token=None):
+    for token in ["Well", " met."]:
+        if on_token:
+            await on_token(token)
+    return Message(role="assistant", content="Well met."), []
+
+
+class ChannelHandlerTest(TestCase):
+    def setUp(self):
+        parser = configparser.ConfigParser()
+        parser.read("example_config.ini")
+
+        agent_defs = [AgentDef(name="King"), AgentDef(name="Serf")]
+        self._session = Session(
+            uuid=uuid.uuid4(),
+            game_def=GameDef(name="Game", agents=agent_defs),
+            agents=[create_gen_agent(agent_def) for agent_def in agent_defs],
+        )
+        self._session.agents[0].chat = streamed_chat
+        store = InMemorySessionStore({self._session.uuid: self._session})
+        mailboxes = AgentMailboxes()
+        channels = SessionChannels()
+
+        app.dependency_overrides[get_config_parser] = lambda: parser
+        app.dependency_overrides[get_session_store] = lambda: store
+        app.dependency_overrides[get_agent_mailboxes] = lambda: mailboxes
+        app.dependency_overrides[get_session_channels] = lambda: channels
+        app.dependency_overrides[get_session_warmups] = lambda: SessionWarmups()
+        self._client = TestClient(app)
+        self._path = f"/session/{self._session.uuid}/channel"
+
+    def tearDown(self):
+        for dependency in (
+            get_session_store,
+            get_agent_mailboxes,
+            get_session_channels,
+            get_session_warmups,
+        ):
+            app.dependency_overrides.pop(dependency)
+
+    def test_multiplexed_requests(self):
+        with self._client.websocket_connect(self._path) as websocket:
+            websocket.send_json(
+                {"id": "a", "op": "guardrail", "agent": "King", "message": "Hail!"}
+            )
+            websocket.send_json(
+                {"id": "b", "op": "guardrail", "agent": "Serf", "message": "Hey!"}
+            )
+            websocket.send_json({"id": "c", "op": "guardrail", "agent": "Queen"})
+            websocket.send_text("not json")
+
+            results = [websocket.receive_json() for _ in range(4)]
+
+        by_id = {result["id"]: result for result in results}
+        assert by_id["a"]["result"] == 5 and by_id["b"]["result"] == 5
+        assert by_id["c"]["status_code"] == 422
+        assert by_id[None]["status_code"] == 422
+        self._session.agents[1].guardrail.assert_awaited_once_with("Hey!")
+
+    def test_streamed_chat_and_events(self):
+        with self._client.websocket_connect(self._path) as observer:
+            with self._client.websocket_connect(self._path) as player:
+                player.send_json(
+                    {
+                        "id": "1",
+                        "op": "chat",
+                        "agent": "King",
+                        "message": "Hail!",
+                        "stream": True,
+                    }
+                )
+                messages = [player.receive_json() for _ in range(3)]
+
+                event = observer.receive_json()
+
+        assert [message["type"] for message in messages] == ["token", "token", "result"]
+        assert "".join(message.get("token", "") for message in messages) == "Well met."
+        assert messages[2]["result"]["message"]["content"] == "Well met."
+        assert event["type"] == "event"
+        assert event["op"] == "chat" and event["agent"] == "King"
+
+    def test_unknown_session(self):
+        with self._client.websocket_connect(f"/session/{uuid.uuid4()}/channel") as ws:
+            message = ws.receive()
+        assert message["type"] == "websocket.close"
+        assert message["code"] == 1008
@@ -0,0 +1,92 @@
+import asyncio
+import configparser
+from typing import Any, List
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, MagicMock
+
+from fakeredis import aioredis
+
+from schema import AgentDef, GameDef, Lore, Memory
+from server.util.lore_ingest import LoreIngester, lore_key
+
+
+async def embed_many(queries: List[str]) -> List[List[float]]:
+    return [[float(len(query)), 1.0, 0.0] for query in queries]
+
+
+async def rate(messages, tool):
+    ratings = [4] * tool["function"]["parameters"]["properties"]["ratings"]["minItems"]
+    return MagicMock(args={"ratings": ratings})
+
+
+class LoreIngesterTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._redis_fake: Any = aioredis.FakeRedis()
+        parser = configparser.ConfigParser()
+        parser.read("example_config.ini")
+
+        self._llm: Any = AsyncMock()
+        self._llm.embedding_size = 3
+        self._llm.embed_many.side_effect = embed_many
+        self._llm.structured_completion.side_effect = rate
+        self._ingester = LoreIngester(self._redis_fake, self._llm, parser)
+
+        self._game_def = GameDef(
+            name="Game",
+            shared_lore=[Lore(memory=Memory(description="The king is old."))],
+            agents=[
+                AgentDef(
+                    name="King",
+                    personal_lore=[Memory(description="I am tired.", importance=7)],
+                )
+            ],
+        )
+        await self.save(self._game_def)
+
+    async def asyncTearDown(self):
+        await self._redis_fake.flushall()
+
+    async def save(self, game_def: GameDef):
+        await self._redis_fake.set(str(game_def.uuid), game_def.json())
+
+    async def test_ingests_lore_once(self):
+        game_uuid = str(self._game_def.uuid)
+        assert await self._ingester.ingest(game_uuid) == 2
+        # Only the lore without an importance is rated.
+        assert self._llm.structured_completion.await_count == 1
+
+        assert await self._ingester.ingest(game_uuid) == 0
+        assert self._llm.embed_many.await_count == 2
+        self._llm.embed_many.assert_awaited_with([])
+
+        game_def = self._game_def.copy(deep=True)
+        await self._ingester.apply(game_def)
+        shared = game_def.shared_lore[0].memory
+        personal = game_def.agents[0].personal_lore[0]
+        assert shared.embedding == [16.0, 1.0, 0.0]
+        assert shared.importance == 5
+        assert personal.embedding == [11.0, 1.0, 0.0]
+        assert personal.importance == 7
+
+    async def test_ingests_only_changed_lore(self):
+        game_uuid = str(self._game_def.uuid)
+        await self._ingester.ingest(game_uuid)
+
+        self._game_def.shared_lore[0].memory.description = "The king is dead."
+        await self.save(self._game_def)
+        assert await self._ingester.ingest(game_uuid) == 1
+        self._llm.embed_many.assert_awaited_with(["The king is dead."])
+        # The record of the old text is dropped.
+        assert await self._redis_fake.hlen(lore_key(game_uuid)) == 2
+
+    async def test_scheduled_saves_are_caught_up(self):
+        game_uuid = str(self._game_def.uuid)
+        self._ingester.schedule(game_uuid)
+        self._game_def.shared_lore.append(Lore(memory=Memory(description="War.")))
+        await self.save(self._game_def)
+        self._ingester.schedule(game_uuid)
+
+        while self._ingester._tasks:
+            await asyncio.sleep(0)
+
+        assert await self._redis_fake.hlen(lore_key(game_uuid)) == 3
@@ -0,0 +1,318 @@
+import asyncio
+import configparser
+import json
+import uuid
+from typing import Any, Optional
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from fakeredis import aioredis
+from httpx import AsyncClient
+from pydantic import UUID4
+
+from game.agent import GenAgent
+from game.session import Session
+from schema import AgentDef, GameDef, Message
+from server.context import (
+    get_agent_mailboxes,
+    get_config_parser,
+    get_session_store,
+    get_session_warmups,
+)
+from server.main import app
+from server.util.agent_mailbox import AgentMailboxes
+from server.util.session_builder import build_session
+from server.util.session_store import InMemorySessionStore, StatelessSessionStore
+from server.util.session_warmup import SessionWarmups
+
+
+def create_gen_agent(agent_def: AgentDef) -> Any:
+    gen_agent = MagicMock()
+    gen_agent.uuid = agent_def.uuid
+    gen_agent.name = agent_def.name
+    gen_agent.guardrail = AsyncMock(return_value=5)
+    return gen_agent
+
+
+class SessionHandlerTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        parser = configparser.ConfigParser()
+        parser.read("example_config.ini")
+
+        agent_defs = [
+            AgentDef(name="Guard"),
+            AgentDef(name="Guard"),
+            AgentDef(name="King"),
+        ]
+        self._session = Session(
+            uuid=uuid.uuid4(),
+            game_def=GameDef(name="Game", agents=agent_defs),
+            agents=[create_gen_agent(agent_def) for agent_def in agent_defs],
+        )
+        self._store = InMemorySessionStore({self._session.uuid: self._session})
+
+        app.dependency_overrides[get_config_parser] = lambda: parser
+        app.dependency_overrides[get_session_store] = lambda: self._store
+        self._mailboxes = AgentMailboxes(capacity=0)
+        app.dependency_overrides[get_agent_mailboxes] = lambda: self._mailboxes
+        self._warmups = SessionWarmups()
+        app.dependency_overrides[get_session_warmups] = lambda: self._warmups
+        self._client = AsyncClient(app=app, base_url="http://test")
+
+    async def asyncTearDown(self):
+        app.dependency_overrides.pop(get_session_store)
+        app.dependency_overrides.pop(get_agent_mailboxes)
+        app.dependency_overrides.pop(get_session_warmups)
+
+    async def guardrail(self, session_uuid: str, agent: str):
+        return await self._client.post(
+            f"/session/{session_uuid}/guardrail",
+            params={"agent": agent, "message": "Hail!"},
+        )
+
+    async def test_agent_lookup(self):
+        response = await self.guardrail(str(self._session.uuid), "King")
+        assert response.status_code == 200
+        assert response.json() == 5
+
+        guard = self._session.agents[1]
+        response = await self.guardrail(str(self._session.uuid), str(guard.uuid))
+        assert response.status_code == 200
+        guard.guardrail.assert_awaited_once_with("Hail!")
+
+    async def test_unknown_session_or_agent(self):
+        response = await self.guardrail(str(uuid.uuid4()), "King")
+        assert response.status_code == 404
+
+        response = await self.guardrail("not-a-uuid", "King")
+        assert response.status_code == 404
+
+        response = await self.guardrail(str(self._session.uuid), "Queen")
+        assert response.status_code == 404
+
+    async def test_ambiguous_agent_name(self):
+        response = await self.guardrail(str(self._session.uuid), "Guard")
+        assert response.status_code == 409
+        assert "Guard" in response.json()["detail"]
+
+    async def test_delete_session(self):
+        response = await self._client.delete(f"/session/{self._session.uuid}")
+        assert response.status_code == 200
+
+        response = await self.guardrail(str(self._session.uuid), "King")
+        assert response.status_code == 404
+
+        response = await self._client.delete(f"/session/{self._session.uuid}")
+        assert response.status_code == 404
+
+    async def test_clear_game_sessions(self):
+        response = await self._client.delete(
+            "/session/clear", params={"game_uuid": str(uuid.uuid4())}
+        )
+        assert response.json() == []
+
+        response = await self._client.delete(
+            "/session/clear", params={"game_uuid": str(self._session.game_def.uuid)}
+        )
+        assert response.json() == [str(self._session.uuid)]
+        assert not await self._store.exists(self._session.uuid)
+
+    async def test_list_and_stats(self):
+        game_uuid = str(self._session.game_def.uuid)
+        other = Session(
+            uuid=uuid.uuid4(),
+            game_def=self._session.game_def,
+            agents=self._session.agents,
+        )
+        await self._store.add(other)
+        session_uuids = sorted([str(self._session.uuid), str(other.uuid)])
+
+        response = await self._client.get(
+            "/session/list", params={"game_uuid": game_uuid, "limit": 1}
+        )
+        assert response.json() == session_uuids[:1]
+        response = await self._client.get(
+            "/session/list",
+            params={"game_uuid": game_uuid, "after": session_uuids[0]},
+        )
+        assert response.json() == session_uuids[1:]
+
+        response = await self._client.get(
+            "/session/stats", params={"game_uuid": game_uuid}
+        )
+        assert response.json()["sessions"] == 2
+        assert response.json()["agents"] == 6
+
+    async def test_busy_agent(self):
+        release = asyncio.Event()
+
+        async def slow_chat(message: str, on_token=None):
+            await release.wait()
+            return Message(role="assistant", content="Well met."), []
+
+        king = self._session.agents[2]
+        king.chat = slow_chat
+        chat = {"agent": "King", "message": "Hail!"}
+
+        first = asyncio.create_task(
+            self._client.post(f"/session/{self._session.uuid}/chat", params=chat)
+        )
+        while not self._mailboxes.busy_agents:
+            await asyncio.sleep(0)
+
+        response = await self._client.post(
+            f"/session/{self._session.uuid}/chat", params=chat
+        )
+        assert response.status_code == 429
+        assert "King" in response.json()["detail"]
+
+        release.set()
+        assert (await first).json()["message"]["content"] == "Well met."
+
+        response = await self._client.get("/session/metrics")
+        assert response.json()["rejected"] == 1
+        assert response.json()["completed"] == 1
+
+    async def test_batch(self):
+        king = self._session.agents[2]
+        king.chat = AsyncMock(
+            return_value=(Message(role="assistant", content="Well met."), [])
+        )
+        serf = self._session.agents[0]
+        serf.query = AsyncMock(side_effect=RuntimeError("LLM error"))
+        operations = [
+            {"op": "chat", "agent": "King", "message": "Hail!"},
+            {"op": "guardrail", "agent": "King", "message": "Hail!"},
+            {"op": "query", "agent": str(serf.uuid), "queries": ["Happy?"]},
+            {"op": "act", "agent": "Queen"},
+        ]
+
+        response = await self._client.post(
+            f"/session/{self._session.uuid}/batch", json=operations
+        )
+
+        assert response.status_code == 200
+        results = response.json()
+        assert [result["index"] for result in results] == [0, 1, 2, 3]
+        assert results[0]["result"]["message"]["content"] == "Well met."
+        assert results[1]["result"] == 5
+        assert results[2]["status_code"] == 500
+        assert results[3]["status_code"] == 404
+
+        response = await self._client.post(
+            f"/session/{self._session.uuid}/batch",
+            params={"stream": True},
+            json=operations[:2],
+        )
+        lines = response.text.splitlines()
+        assert sorted(json.loads(line)["index"] for line in lines) == [0, 1]
+
+        response = await self._client.post(
+            f"/session/{self._session.uuid}/batch",
+            json=[{"op": "chat", "agent": "King"}],
+        )
+        assert response.status_code == 422
+
+    async def test_warming_up_agent(self):
+        release = asyncio.Event()
+        king = self._session.agents[2]
+        king.fill_memories = AsyncMock(side_effect=release.wait)
+        for guard in self._session.agents[:2]:
+            guard.fill_memories = AsyncMock()
+        king.chat = AsyncMock(
+            return_value=(Message(role="assistant", content="Well met."), [])
+        )
+        self._mailboxes = AgentMailboxes()
+        self._warmups.start(self._session, self._store, first_agent="King")
+
+        chat = asyncio.create_task(
+            self._client.post(
+                f"/session/{self._session.uuid}/chat",
+                params={"agent": "King", "message": "Hail!"},
+            )
+        )
+        while not king.fill_memories.await_count:
+            await asyncio.sleep(0)
+
+        response = await self._client.get(
+            f"/session/{self._session.uuid}/active", params={"agents": True}
+        )
+        readiness = response.json()
+        assert readiness["active"] and not readiness["ready"]
+        assert [agent["ready"] for agent in readiness["agents"]][2] is False
+        king.chat.assert_not_awaited()
+
+        release.set()
+        assert (await chat).json()["message"]["content"] == "Well met."
+
+        response = await self._client.get(f"/session/{self._session.uuid}/active")
+        assert response.json() is True
+
+
+class StatelessSessionHandlerTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._redis_fake: Any = aioredis.FakeRedis()
+        self._parser = configparser.ConfigParser()
+        self._parser.read("example_config.ini")
+
+        self._llm: Any = AsyncMock()
+        self._llm.embedding_size = 3
+        self._llm.embed_many.return_value = []
+
+        self._store = StatelessSessionStore(self._redis_fake, self.load_session)
+        self._session = await self.load_session(
+            None, GameDef(name="Game", agents=[AgentDef(name="King")])
+        )
+        await self._store.add(self._session)
+
+        app.dependency_overrides[get_session_store] = lambda: self._store
+        self._mailboxes = AgentMailboxes()
+        app.dependency_overrides[get_agent_mailboxes] = lambda: self._mailboxes
+        app.dependency_overrides[get_session_warmups] = lambda: SessionWarmups()
+        self._client = AsyncClient(app=app, base_url="http://test")
+
+    async def asyncTearDown(self):
+        app.dependency_overrides.pop(get_session_store)
+        app.dependency_overrides.pop(get_agent_mailboxes)
+        app.dependency_overrides.pop(get_session_warmups)
+        await self._redis_fake.flushall()
+
+    async def load_session(
+        self, session_uuid: Optional[UUID4], game_def: GameDef
+    ) -> Session:
+        return await build_session(
+            game_def, self._llm, self._parser, session_uuid, fill_memories=False
+        )
+
+    async def test_queued_chats_see_each_other(self):
+        release = asyncio.Event()
+
+        async def chat(gen_agent: GenAgent, message: str, on_token=None):
+            await release.wait()
+            gen_agent.conversation_history.append(Message(role="user", content=message))
+            return Message(role="assistant", content="Well met."), []
+
+        with patch.object(GenAgent, "chat", chat):
+            chats = [
+                asyncio.create_task(
+                    self._client.post(
+                        f"/session/{self._session.uuid}/chat",
+                        params={"agent": "King", "message": message},
+                    )
+                )
+                for message in ["Hail!", "Farewell!"]
+            ]
+            # Both requests checked the session out before either turn ran.
+            while self._mailboxes.metrics.accepted < 2:
+                await asyncio.sleep(0)
+            release.set()
+            responses = await asyncio.gather(*chats)
+
+        assert [response.status_code for response in responses] == [200, 200]
+        async with self._store.checkout(self._session.uuid) as session:
+            assert session
+            history = session.agents[0].conversation_history
+            assert sorted(message.content for message in history) == [
+                "Farewell!",
+                "Hail!",
+            ]
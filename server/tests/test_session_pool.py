@@ -0,0 +1,76 @@
+import asyncio
+import configparser
+from typing import Any
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock
+
+from fakeredis import aioredis
+
+from schema import AgentDef, GameDef
+from server.util.session_pool import SessionPool, parse_pool_sizes
+
+
+class SessionPoolTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._redis_fake: Any = aioredis.FakeRedis()
+        parser = configparser.ConfigParser()
+        parser.read("example_config.ini")
+
+        llm: Any = AsyncMock()
+        llm.embedding_size = 3
+        llm.embed_many.return_value = []
+
+        self._game_def = GameDef(name="Game", agents=[AgentDef(name="King")])
+        await self.save(self._game_def)
+        self._pool = SessionPool(
+            self._redis_fake, llm, parser, {str(self._game_def.uuid): 2}
+        )
+        self._task = asyncio.create_task(self._pool.run(interval=60))
+
+    async def asyncTearDown(self):
+        self._task.cancel()
+        await self._redis_fake.flushall()
+
+    async def save(self, game_def: GameDef):
+        await self._redis_fake.set(str(game_def.uuid), game_def.json())
+
+    async def filled(self, size: int):
+        while self._pool.pooled < size:
+            await asyncio.sleep(0)
+
+    async def test_hands_out_and_refills(self):
+        await self.filled(2)
+
+        first = self._pool.take(self._game_def)
+        second = self._pool.take(self._game_def)
+        assert first and second and first.uuid != second.uuid
+        assert first.agents[0].name == "King"
+        assert self._pool.take(self._game_def) is None
+
+        await self.filled(2)
+        assert self._pool.metrics.hits == 2
+        assert self._pool.metrics.misses == 1
+        assert self._pool.metrics.refills == 4
+        assert self._pool.metrics.max_refill_ms > 0
+
+    async def test_game_def_change_invalidates(self):
+        await self.filled(2)
+
+        self._game_def.agents.append(AgentDef(name="Serf"))
+        await self.save(self._game_def)
+        # Saved through another worker, so only noticed on take.
+        assert self._pool.take(self._game_def) is None
+        assert self._pool.metrics.invalidated == 2
+
+        await self.filled(2)
+        session = self._pool.take(self._game_def)
+        assert session and len(session.agents) == 2
+
+    async def test_games_without_a_pool(self):
+        assert self._pool.take(GameDef(name="Other")) is None
+        assert self._pool.metrics.misses == 0
+
+
+def test_parse_pool_sizes():
+    assert parse_pool_sizes("") == {}
+    assert parse_pool_sizes("a:4, b") == {"a": 4, "b": 1}
@@ -0,0 +1,48 @@
+import uuid
+from typing import Any
+from unittest.mock import MagicMock
+
+from game.session import Session
+from schema import AgentDef, GameDef
+from server.util.session_registry import InMemorySessionRegistry
+
+
+def create_session(game_def: GameDef, nbytes: int = 100) -> Any:
+    agents = []
+    for agent_def in game_def.agents:
+        gen_agent = MagicMock()
+        gen_agent.uuid = agent_def.uuid
+        gen_agent.name = agent_def.name
+        gen_agent.memory.nbytes = nbytes
+        agents.append(gen_agent)
+    return Session(uuid=uuid.uuid4(), game_def=game_def, agents=agents)
+
+
+def test_indexes_and_stats_follow_sessions():
+    game_def = GameDef(name="Game", agents=[AgentDef(name="King")])
+    other_game = GameDef(name="Other")
+    registry = InMemorySessionRegistry()
+    sessions = [create_session(game_def) for _ in range(3)]
+    for session in sessions:
+        registry.record(session, "ada@example.com")
+    registry.record(create_session(other_game))
+    game_uuid = str(game_def.uuid)
+    session_uuids = sorted((session.uuid for session in sessions), key=str)
+
+    assert registry.list_uuids(game_uuid) == session_uuids
+    assert registry.list_uuids(game_uuid, after=session_uuids[0], limit=1) == [
+        session_uuids[1]
+    ]
+    assert registry.list_uuids(owner="ada@example.com") == session_uuids
+    assert len(registry.list_uuids()) == 4
+
+    sessions[0].agents[0].memory.nbytes = 300
+    # The owner is only set when the session is registered.
+    registry.record(sessions[0], "bob@example.com")
+    registry.remove(sessions[1].uuid)
+
+    stats = registry.stats(game_uuid)
+    assert (stats.sessions, stats.agents, stats.memory_bytes) == (2, 2, 400)
+    assert stats.last_activity
+    assert registry.list_uuids(owner="bob@example.com") == []
+    assert registry.stats(str(uuid.uuid4())).sessions == 0
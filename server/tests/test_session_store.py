@@ -0,0 +1,378 @@
+import configparser
+import time
+from typing import Any, Optional
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock
+
+import pytest
+from fakeredis import aioredis
+from pydantic import UUID4
+
+from game.session import Session
+from schema import AgentDef, Conversation, GameDef, Memory, Message
+from server.util.session_builder import build_session
+from server.util.session_store import (
+    RedisSessionStore,
+    SessionConflict,
+    StatelessSessionStore,
+    register_unindexed_sessions,
+)
+
+
+class RedisSessionStoreTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._redis_fake: Any = aioredis.FakeRedis()
+        self._parser = configparser.ConfigParser()
+        self._parser.read("example_config.ini")
+
+        self._llm: Any = AsyncMock()
+        self._llm.embedding_size = 3
+        self._llm.embed_many.return_value = []
+
+        self._game_def = GameDef(
+            name="Game", agents=[AgentDef(name="King"), AgentDef(name="Serf")]
+        )
+
+    async def asyncTearDown(self):
+        await self._redis_fake.flushall()
+
+    async def load_session(
+        self, session_uuid: Optional[UUID4], game_def: GameDef
+    ) -> Session:
+        return await build_session(
+            game_def, self._llm, self._parser, session_uuid, fill_memories=False
+        )
+
+    def create_store(self) -> RedisSessionStore:
+        return RedisSessionStore(self._redis_fake, self.load_session)
+
+    async def create_session(self, store: RedisSessionStore) -> Session:
+        session = await self.load_session(None, self._game_def)
+        await store.add(session)
+        return session
+
+    async def history_in_redis(self, session: Session, agent: Any):
+        key = f"session:{session.uuid}:agent:{agent.uuid}:history"
+        return [
+            Message.parse_raw(message)
+            for message in await self._redis_fake.lrange(key, 0, -1)
+        ]
+
+    async def test_restores_session(self):
+        store = self.create_store()
+        session = await self.create_session(store)
+        king = session.get_agent("King")
+        assert king
+
+        await king.memory.add_memories(
+            [Memory(description="I am king", importance=7, embedding=[0.5, 0.25, 1])]
+        )
+        conversation = Conversation(scene_description="The throne room")
+        history = [Message(role="user", content="Hail!")]
+        king.restore_conversation(conversation, history, "The serf bowed.")
+        await store.save(session)
+
+        restored = await self.create_store().get(session.uuid)
+
+        assert restored
+        restored_king = restored.get_agent("King")
+        assert restored_king
+        assert restored_king.conversation_context == conversation
+        assert restored_king.conversation_history == history
+        assert restored_king.conversation_summary == "The serf bowed."
+        assert restored_king.memory.get_all_memory() == [
+            Memory(description="I am king", importance=7, embedding=[0.5, 0.25, 1])
+        ]
+        self._llm.embed.assert_not_called()
+
+    async def test_restoring_never_calls_the_llm(self):
+        store = self.create_store()
+        session = await self.create_session(store)
+        king = session.agents[0]
+        # Saved as they are, e.g. before they were rated and embedded.
+        unrated = Memory(description="I am king", keywords=["king"])
+        king.memory.restore_memories([unrated])
+        await store.save(session)
+        self._llm.reset_mock()
+
+        restored = await self.create_store().get(session.uuid)
+
+        assert restored
+        assert restored.agents[0].memory.get_all_memory() == [unrated]
+        assert restored.agents[0].memory.keyword_annotator.find("the king") == [
+            (4, 8, "king")
+        ]
+        assert self._llm.mock_calls == []
+
+    async def test_history_is_written_incrementally(self):
+        store = self.create_store()
+        session = await self.create_session(store)
+        serf = session.agents[1]
+
+        serf.conversation_history.append(Message(role="user", content="One"))
+        await store.save(session)
+        serf.conversation_history.append(Message(role="assistant", content="Two"))
+        await self._redis_fake.rpush(
+            f"session:{session.uuid}:agent:{serf.uuid}:history",
+            Message(role="system", content="Marker").json(),
+        )
+        await store.save(session)
+
+        # Only the new turn was pushed, after the marker.
+        history = await self.history_in_redis(session, serf)
+        assert [message.content for message in history] == ["One", "Marker", "Two"]
+
+        # Folding turns rewrites the list.
+        del serf.conversation_history[:1]
+        await store.save(session)
+        assert await self.history_in_redis(session, serf) == [
+            Message(role="assistant", content="Two")
+        ]
+
+        serf.resetConversation()
+        await store.save(session)
+        assert await self.history_in_redis(session, serf) == []
+
+    async def test_forgotten_memories_and_removed_agents_are_rewritten(self):
+        store = self.create_store()
+        session = await self.create_session(store)
+        king, serf = session.agents
+        old, kept = [
+            Memory(description=description, importance=5, embedding=[1, 0, 0])
+            for description in ["The king is old.", "The king is wise."]
+        ]
+        await king.memory.add_memories([old, kept])
+        await store.save(session)
+
+        king.memory.remove_memories([old])
+        session.agents.remove(serf)
+        session.game_def = session.game_def.copy(
+            update={"agents": session.game_def.agents[:1]}
+        )
+        session.reindex()
+        await store.save(session)
+
+        restored = await self.create_store().get(session.uuid)
+        assert restored
+        assert [agent.name for agent in restored.agents] == ["King"]
+        assert restored.agents[0].memory.get_all_memory() == [kept]
+        assert not await self._redis_fake.keys(
+            f"session:{session.uuid}:agent:{serf.uuid}*"
+        )
+
+    async def test_unchanged_session_is_not_written(self):
+        store = self.create_store()
+        session = await self.create_session(store)
+        await self._redis_fake.flushall()
+
+        await store.save(session)
+
+        assert await self._redis_fake.keys() == []
+
+    async def test_list_and_delete(self):
+        store = self.create_store()
+        session = await self.create_session(store)
+        other_game = await self.load_session(None, GameDef(name="Other"))
+        await store.add(other_game)
+
+        assert await store.list_uuids(str(self._game_def.uuid)) == [session.uuid]
+        assert len(await store.list_uuids()) == 2
+
+        await store.delete(session.uuid)
+
+        assert await store.list_uuids() == [other_game.uuid]
+        assert not await store.exists(session.uuid)
+        assert await self.create_store().get(session.uuid) is None
+        assert await self._redis_fake.keys(f"session:{session.uuid}*") == []
+
+    async def test_registry_pages_and_counts_sessions(self):
+        store = self.create_store()
+        game_uuid = str(self._game_def.uuid)
+        sessions = [await self.create_session(store) for _ in range(3)]
+        owned = await self.load_session(None, self._game_def)
+        await store.add(owned, owner="ada@example.com")
+        session_uuids = sorted(
+            [session.uuid for session in sessions] + [owned.uuid], key=str
+        )
+
+        first_page = await store.list_uuids(game_uuid, limit=3)
+        assert first_page == session_uuids[:3]
+        assert await store.list_uuids(game_uuid, after=first_page[-1]) == (
+            session_uuids[3:]
+        )
+        assert await store.list_uuids(owner="ada@example.com") == [owned.uuid]
+        assert await store.list_uuids(game_uuid, "bob@example.com") == []
+
+        await sessions[0].agents[0].memory.add_memories(
+            [
+                Memory(description=str(i), importance=5, embedding=[1, 0, 0])
+                for i in range(20)
+            ]
+        )
+        await store.save(sessions[0])
+        # Reloading on another worker doesn't count the session twice.
+        reloaded = await self.create_store().get(owned.uuid)
+        assert reloaded
+        await store.delete(sessions[1].uuid)
+
+        stats = await store.stats(game_uuid)
+        assert stats.sessions == 3
+        assert stats.agents == 6
+        assert stats.memory_bytes == sum(
+            session.nbytes for session in [sessions[0], sessions[2], owned]
+        )
+        assert stats.last_activity and stats.last_activity <= time.time()
+
+    async def test_sessions_saved_before_the_registry_are_registered(self):
+        store = self.create_store()
+        session = await self.create_session(store)
+        await self._redis_fake.delete(*await self._redis_fake.keys("sessions:*"))
+        await self._redis_fake.hdel(f"session:{session.uuid}", "agents", "memory_bytes")
+
+        assert await register_unindexed_sessions(self._redis_fake) == 1
+        assert await register_unindexed_sessions(self._redis_fake) == 0
+        assert await store.list_uuids(str(self._game_def.uuid)) == [session.uuid]
+        assert (await store.stats(str(self._game_def.uuid))).agents == 2
+
+    async def test_idle_sessions_are_evicted_and_reloaded(self):
+        store = RedisSessionStore(self._redis_fake, self.load_session, idle_ttl=60)
+        session = await self.create_session(store)
+        session.agents[0].conversation_history.append(
+            Message(role="user", content="Hail!")
+        )
+
+        assert await store.evict(time.monotonic() + 30) == []
+        assert await store.evict(time.monotonic() + 90) == [session.uuid]
+        assert not store.is_resident(session.uuid)
+
+        reloaded = await store.get(session.uuid)
+        assert reloaded and reloaded is not session
+        assert reloaded.agents[0].conversation_history == [
+            Message(role="user", content="Hail!")
+        ]
+
+    async def test_least_recently_used_sessions_are_evicted_over_budget(self):
+        session_bytes = (await self.load_session(None, self._game_def)).nbytes
+        store = RedisSessionStore(
+            self._redis_fake, self.load_session, memory_budget=2 * session_bytes
+        )
+        first = await self.create_session(store)
+        second = await self.create_session(store)
+        await store.get(first.uuid)
+
+        third = await self.create_session(store)
+
+        assert not store.is_resident(second.uuid)
+        assert store.is_resident(first.uuid) and store.is_resident(third.uuid)
+        assert store.resident_bytes == 2 * session_bytes
+
+    async def test_checked_out_sessions_are_not_evicted(self):
+        store = RedisSessionStore(self._redis_fake, self.load_session, idle_ttl=0)
+        session = await self.create_session(store)
+
+        async with store.checkout(session.uuid) as checked_out:
+            assert checked_out is session
+            assert await store.evict(time.monotonic() + 1) == []
+
+        assert await store.evict(time.monotonic() + 1) == [session.uuid]
+
+
+class StatelessSessionStoreTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._redis_fake: Any = aioredis.FakeRedis()
+        self._parser = configparser.ConfigParser()
+        self._parser.read("example_config.ini")
+
+        self._llm: Any = AsyncMock()
+        self._llm.embedding_size = 3
+        self._llm.embed_many.return_value = []
+        self._loads = 0
+
+        self._game_def = GameDef(name="Game", agents=[AgentDef(name="King")])
+
+    async def asyncTearDown(self):
+        await self._redis_fake.flushall()
+
+    async def load_session(
+        self, session_uuid: Optional[UUID4], game_def: GameDef
+    ) -> Session:
+        self._loads += 1
+        return await build_session(
+            game_def, self._llm, self._parser, session_uuid, fill_memories=False
+        )
+
+    def create_store(self) -> StatelessSessionStore:
+        return StatelessSessionStore(self._redis_fake, self.load_session)
+
+    async def create_session(self, store: StatelessSessionStore) -> Session:
+        session = await build_session(
+            self._game_def, self._llm, self._parser, fill_memories=False
+        )
+        await store.add(session)
+        return session
+
+    async def say(self, store: StatelessSessionStore, session_uuid: UUID4, line: str):
+        async with store.checkout(session_uuid) as session:
+            assert session
+            session.agents[0].conversation_history.append(
+                Message(role="user", content=line)
+            )
+
+    async def test_any_worker_serves_the_latest_version(self):
+        first = self.create_store()
+        second = self.create_store()
+        session = await self.create_session(first)
+
+        await self.say(first, session.uuid, "One")
+        await self.say(second, session.uuid, "Two")
+        await self.say(first, session.uuid, "Three")
+
+        async with second.checkout(session.uuid) as latest:
+            assert latest
+            assert [
+                message.content for message in latest.agents[0].conversation_history
+            ] == ["One", "Two", "Three"]
+
+    async def test_unchanged_sessions_are_served_from_the_cache(self):
+        store = self.create_store()
+        session = await self.create_session(store)
+        version = await self._redis_fake.hget(f"session:{session.uuid}", "version")
+
+        async with store.checkout(session.uuid) as checked_out:
+            assert checked_out is session
+        assert await store.get(session.uuid) is session
+
+        assert self._loads == 0
+        assert await self._redis_fake.hget(f"session:{session.uuid}", "version") == (
+            version
+        )
+
+    async def test_concurrent_turns_conflict(self):
+        first = self.create_store()
+        second = self.create_store()
+        session = await self.create_session(first)
+
+        async with first.checkout(session.uuid) as winner:
+            async with second.checkout(session.uuid) as loser:
+                assert winner and loser
+                winner.agents[0].conversation_history.append(
+                    Message(role="user", content="Won")
+                )
+                loser.agents[0].conversation_history.append(
+                    Message(role="user", content="Lost")
+                )
+                await first.save(winner)
+                with pytest.raises(SessionConflict):
+                    await second.save(loser)
+
+        history = await self._redis_fake.lrange(
+            f"session:{session.uuid}:agent:{session.agents[0].uuid}:history", 0, -1
+        )
+        assert [Message.parse_raw(message).content for message in history] == ["Won"]
+
+        # The loser's copy isn't reused.
+        async with second.checkout(session.uuid) as reloaded:
+            assert reloaded and reloaded is not loser
+            assert reloaded.agents[0].conversation_history == [
+                Message(role="user", content="Won")
+            ]
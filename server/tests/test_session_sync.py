@@ -0,0 +1,136 @@
+import configparser
+from typing import Any, List
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, MagicMock
+
+from schema import AgentDef, GameDef, Lore, Memory
+from server.util.game_def_diff import diff_game_defs
+from server.util.session_builder import build_session
+from server.util.session_sync import LoreVectors, sync_session
+
+
+async def embed_many(queries: List[str]) -> List[List[float]]:
+    return [[float(len(query)), 1.0, 0.0] for query in queries]
+
+
+async def rate(messages, tool):
+    ratings = [4] * tool["function"]["parameters"]["properties"]["ratings"]["minItems"]
+    return MagicMock(args={"ratings": ratings})
+
+
+def create_game_def() -> GameDef:
+    king = AgentDef(
+        name="King", personal_lore=[Memory(description="I am tired.", importance=7)]
+    )
+    serf = AgentDef(name="Serf")
+    return GameDef(
+        name="Game",
+        shared_lore=[
+            Lore(
+                known_by={king.uuid, serf.uuid},
+                memory=Memory(client_id="king", description="The king is old."),
+            ),
+            Lore(
+                known_by={king.uuid}, memory=Memory(description="The vault is empty.")
+            ),
+        ],
+        agents=[king, serf],
+    )
+
+
+def descriptions(gen_agent: Any) -> List[str]:
+    return sorted(memory.description for memory in gen_agent.memory.get_all_memory())
+
+
+class SessionSyncTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._parser = configparser.ConfigParser()
+        self._parser.read("example_config.ini")
+
+        self._llm: Any = AsyncMock()
+        self._llm.embedding_size = 3
+        self._llm.embed.return_value = [1.0, 1.0, 0.0]
+        self._llm.embed_many.side_effect = embed_many
+        self._llm.structured_completion.side_effect = rate
+
+        self._game_def = create_game_def()
+        self._session = await build_session(
+            self._game_def.copy(deep=True), self._llm, self._parser
+        )
+        self._llm.reset_mock()
+
+    async def sync(self, updated_game: GameDef, **kwargs):
+        return await sync_session(
+            self._session,
+            updated_game,
+            self._llm,
+            self._parser,
+            LoreVectors(self._llm),
+            **kwargs,
+        )
+
+    async def test_applies_only_the_changes(self):
+        king, serf = self._session.agents
+        king.restore_conversation(king.conversation_context, [], "The serf bowed.")
+
+        updated = self._game_def.copy(deep=True)
+        updated.shared_lore[0].memory.description = "The king is dead."
+        updated.shared_lore[1].known_by.add(serf.uuid)
+        updated.agents[0].personal_lore = []
+        queen = AgentDef(name="Queen")
+        updated.agents.append(queen)
+        updated.shared_lore[0].known_by.add(queen.uuid)
+
+        diff = await self.sync(updated)
+
+        assert diff.lore_changed == ["The king is dead."]
+        assert diff.known_by_changed == ["The king is dead.", "The vault is empty."]
+        assert diff.personal_lore_removed == ["I am tired."]
+        assert diff.agents_added == [queen.uuid]
+        # The new text is embedded and rated once for all three agents.
+        embedded = [call.args[0] for call in self._llm.embed_many.await_args_list]
+        assert [queries for queries in embedded if queries] == [["The king is dead."]]
+        assert self._llm.structured_completion.await_count == 1
+
+        assert [agent.name for agent in self._session.agents] == [
+            "King",
+            "Serf",
+            "Queen",
+        ]
+        assert descriptions(king) == ["The king is dead.", "The vault is empty."]
+        assert descriptions(serf) == ["The king is dead.", "The vault is empty."]
+        assert descriptions(self._session.get_agent("Queen")) == ["The king is dead."]
+        assert king.conversation_summary == "The serf bowed."
+        assert self._session.game_def is updated
+
+    async def test_removes_agents_and_skips_cold_ones(self):
+        king, serf = self._session.agents
+        updated = self._game_def.copy(deep=True)
+        updated.agents.pop()
+        updated.shared_lore.append(
+            Lore(known_by={king.uuid}, memory=Memory(description="War."))
+        )
+
+        diff = await self.sync(updated, cold_agents=[king.uuid])
+
+        assert diff.agents_removed == [serf.uuid]
+        assert diff.lore_added == ["War."]
+        assert self._session.agents == [king]
+        assert self._session.get_agent("Serf") is None
+        # The King gets his lore when warmed up, from his updated knowledge.
+        assert "War." not in descriptions(king)
+        assert not any(call.args[0] for call in self._llm.embed_many.await_args_list)
+
+
+def test_unrated_lore_is_unchanged():
+    game_def = create_game_def()
+    game_def.shared_lore[0].memory.importance = 5
+    updated = create_game_def()
+    updated.agents = game_def.agents
+    for lore, updated_lore in zip(game_def.shared_lore, updated.shared_lore):
+        updated_lore.known_by = lore.known_by
+
+    diff = diff_game_defs(game_def, updated)
+
+    assert diff.lore_changed == []
+    assert diff.known_by_changed == []
@@ -0,0 +1,104 @@
+import asyncio
+import uuid
+from typing import Any, List
+from unittest.mock import MagicMock
+
+import pytest
+
+from game.session import Session
+from schema import AgentDef, GameDef
+from server.util.session_store import InMemorySessionStore
+from server.util.session_warmup import SessionWarmups, WarmupFailed
+
+
+def create_session(names: List[str]) -> Any:
+    agent_defs = [AgentDef(name=name) for name in names]
+    agents = []
+    for agent_def in agent_defs:
+        gen_agent = MagicMock()
+        gen_agent.uuid = agent_def.uuid
+        gen_agent.name = agent_def.name
+        agents.append(gen_agent)
+    return Session(
+        uuid=uuid.uuid4(),
+        game_def=GameDef(name="Game", agents=agent_defs),
+        agents=agents,
+    )
+
+
+async def test_warms_up_in_priority_order():
+    session = create_session(["Guard", "Serf", "Queen", "King"])
+    store = InMemorySessionStore({session.uuid: session})
+    warmups = SessionWarmups(concurrency=1)
+    release = asyncio.Event()
+    filled = []
+
+    for gen_agent in session.agents:
+
+        async def fill_memories(name=gen_agent.name):
+            filled.append(name)
+            await release.wait()
+
+        gen_agent.fill_memories = fill_memories
+
+    warmup = warmups.start(session, store, first_agent="Queen")
+    while not filled:
+        await asyncio.sleep(0)
+    # The King is waited for, so he goes right after the Queen.
+    king = asyncio.create_task(
+        warmups.wait(session.uuid, session.get_agent("King").uuid)
+    )
+    await asyncio.sleep(0)
+    release.set()
+    await king
+
+    assert filled[:2] == ["Queen", "King"]
+
+    await warmups.wait(session.uuid, session.get_agent("Serf").uuid)
+    assert filled == ["Queen", "King", "Guard", "Serf"]
+    while warmup.running:
+        await asyncio.sleep(0)
+    assert warmups.get(session.uuid) is None
+
+
+async def test_failed_agent_is_retried_on_wait():
+    session = create_session(["King"])
+    store = InMemorySessionStore({session.uuid: session})
+    warmups = SessionWarmups()
+    king = session.agents[0]
+    errors = [RuntimeError("LLM error")]
+
+    async def fill_memories():
+        if errors:
+            raise errors.pop()
+
+    king.fill_memories = fill_memories
+
+    warmup = warmups.start(session, store)
+    with pytest.raises(WarmupFailed):
+        await warmups.wait(session.uuid, king.uuid)
+    assert warmup.error(king.uuid) == "LLM error"
+
+    await warmups.wait(session.uuid, king.uuid)
+    assert warmup.is_ready(king.uuid)
+
+
+async def test_deleted_session_stops_warm_up():
+    session = create_session(["King", "Serf"])
+    store = InMemorySessionStore({session.uuid: session})
+    warmups = SessionWarmups(concurrency=1)
+    release = asyncio.Event()
+
+    async def fill_memories():
+        await release.wait()
+
+    for gen_agent in session.agents:
+        gen_agent.fill_memories = fill_memories
+
+    warmups.start(session, store)
+    await asyncio.sleep(0)
+    await store.delete(session.uuid)
+    release.set()
+
+    with pytest.raises(WarmupFailed):
+        await warmups.wait(session.uuid, session.agents[1].uuid)
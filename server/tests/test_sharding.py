@@ -0,0 +1,219 @@
+import configparser
+import hashlib
+import hmac
+import uuid
+from typing import Any, List, Optional
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock
+
+import httpx
+import pytest
+from fakeredis import aioredis
+from fastapi import Request
+from pydantic import UUID4
+
+from game.session import Session
+from schema import GameDef
+from server.util.session_builder import build_session
+from server.util.session_store import RedisSessionStore
+from server.util.sharding import (
+    FORWARDED_HEADER,
+    SIGNATURE_HEADER,
+    HashRing,
+    SessionMoving,
+    ShardRouter,
+)
+
+SECRET = "cluster secret"
+
+
+def test_hash_ring_moves_few_keys():
+    keys = [str(uuid.uuid4()) for _ in range(1000)]
+    ring = HashRing(["a", "b", "c"])
+    grown = HashRing(["a", "b", "c", "d"])
+
+    owners = [ring.owner(key) for key in keys]
+    assert owners == [HashRing(["c", "b", "a"]).owner(key) for key in keys]
+    assert {"a", "b", "c"} == set(owners)
+
+    moved = [key for key in keys if ring.owner(key) != grown.owner(key)]
+    assert all(grown.owner(key) == "d" for key in moved)
+    assert 100 < len(moved) < 400
+
+
+class ShardRouterTest(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._redis_fake: Any = aioredis.FakeRedis()
+        self._parser = configparser.ConfigParser()
+        self._parser.read("example_config.ini")
+
+        self._llm: Any = AsyncMock()
+        self._llm.embedding_size = 3
+        self._llm.embed_many.return_value = []
+
+    async def asyncTearDown(self):
+        await self._redis_fake.flushall()
+
+    async def load_session(
+        self, session_uuid: Optional[UUID4], game_def: GameDef
+    ) -> Session:
+        return await build_session(
+            game_def, self._llm, self._parser, session_uuid, fill_memories=False
+        )
+
+    async def create_router(self, name: str, **kwargs: Any) -> ShardRouter:
+        store = RedisSessionStore(self._redis_fake, self.load_session)
+        router = ShardRouter(
+            self._redis_fake, store, name, f"http://{name}", SECRET, **kwargs
+        )
+        await router.join()
+        return router
+
+    def session_uuid_owned_by(self, router: ShardRouter) -> UUID4:
+        while True:
+            session_uuid = uuid.uuid4()
+            if router.owns(session_uuid):
+                return session_uuid
+
+    async def test_routes_to_owner_then_holder(self):
+        first = await self.create_router("first")
+        second = await self.create_router("second")
+        await first.refresh()
+
+        session_uuid = self.session_uuid_owned_by(second)
+
+        assert await first.route(session_uuid) == "http://second"
+        assert await second.route(session_uuid) is None
+        assert await first.route(session_uuid) == "http://second"
+        with pytest.raises(SessionMoving):
+            await first.route(session_uuid, forwarded=True)
+
+    async def test_sessions_move_when_a_worker_joins(self):
+        first = await self.create_router("first")
+        sessions: List[Session] = []
+        for _ in range(8):
+            session = await self.load_session(None, GameDef(name="Game"))
+            await first._store.add(session)
+            await first.adopt(session.uuid)
+            sessions.append(session)
+
+        second = await self.create_router("second")
+        await first.refresh()
+
+        for session in sessions:
+            held_by_first = first._store.is_resident(session.uuid)
+            assert held_by_first == first.owns(session.uuid)
+            expected = None if held_by_first else "http://second"
+            assert await first.route(session.uuid) == expected
+            if not held_by_first:
+                assert await second.route(session.uuid) is None
+                assert await second._store.get(session.uuid)
+
+    async def test_dead_worker_sessions_are_taken_over(self):
+        first = await self.create_router("first", heartbeat_ttl=0.001)
+        second = await self.create_router("second")
+        session_uuid = self.session_uuid_owned_by(first)
+        assert await first.route(session_uuid) is None
+
+        await self._redis_fake.delete("worker:first")
+        await second.refresh()
+
+        assert await second.route(session_uuid) is None
+
+    async def test_only_one_worker_takes_over_a_dead_holder(self):
+        first = await self.create_router("first", heartbeat_ttl=0.001)
+        second = await self.create_router("second")
+        third = await self.create_router("third")
+        session_uuid = self.session_uuid_owned_by(first)
+        assert await first.route(session_uuid) is None
+
+        await self._redis_fake.delete("worker:first")
+        await second.refresh()
+        await third.refresh()
+
+        # Both saw `first` holding it; only the one to claim it first wins.
+        assert await second._claim(session_uuid, "first")
+        assert not await third._claim(session_uuid, "first")
+        owner = await self._redis_fake.get(f"session:{session_uuid}:owner")
+        assert owner == b"second"
+        with pytest.raises(SessionMoving):
+            await third.route(session_uuid, forwarded=True)
+
+    async def test_forward(self):
+        received: List[httpx.Request] = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            received.append(request)
+            return httpx.Response(200, json=5)
+
+        router = await self.create_router(
+            "first",
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        )
+        session_uuid = uuid.uuid4()
+        path = f"/session/{session_uuid}/guardrail"
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        request = Request(
+            {
+                "type": "http",
+                "method": "POST",
+                "path": path,
+                "query_string": b"agent=King&message=Hail",
+                "headers": [(b"host", b"first"), (b"cookie", b"token=abc")],
+            },
+            receive,
+        )
+        response = await router.forward(request, "http://second")
+
+        assert response.status_code == 200
+        assert str(received[0].url) == f"http://second{path}?agent=King&message=Hail"
+        assert received[0].headers["cookie"] == "token=abc"
+        assert received[0].headers[FORWARDED_HEADER] == "first"
+
+        second = await self.create_router("second")
+        forwarded = Request(
+            {
+                "type": "http",
+                "method": "POST",
+                "path": path,
+                "query_string": b"",
+                "headers": [
+                    (key.encode(), value.encode())
+                    for key, value in received[0].headers.items()
+                ],
+            },
+            receive,
+        )
+        assert second.is_forwarded(forwarded)
+
+        redirect = await router.forward(request, "http://second", redirect=True)
+        assert redirect.status_code == 307
+        assert redirect.headers["location"].startswith(f"http://second{path}")
+
+
+def test_unsigned_or_forged_requests_are_not_forwarded():
+    router = ShardRouter(AsyncMock(), AsyncMock(), "first", "http://first", SECRET)
+
+    def request(signature: Optional[str]) -> Request:
+        headers = [(FORWARDED_HEADER.encode(), b"second")]
+        if signature is not None:
+            headers.append((SIGNATURE_HEADER.encode(), signature.encode()))
+        return Request(
+            {
+                "type": "http",
+                "method": "POST",
+                "path": "/session/sync",
+                "headers": headers,
+            }
+        )
+
+    message = b"second\nPOST\n/session/sync"
+    signed = hmac.new(SECRET.encode(), message, hashlib.sha256).hexdigest()
+    forged = hmac.new(b"guess", message, hashlib.sha256).hexdigest()
+
+    assert router.is_forwarded(request(signed))
+    assert not router.is_forwarded(request(None))
+    assert not router.is_forwarded(request(forged))
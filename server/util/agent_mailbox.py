@@ -0,0 +1,149 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+from pydantic import UUID4
+
+T = TypeVar("T")
+
+Turn = Callable[[], Awaitable[T]]
+
+
+class MailboxFull(Exception):
+    """The agent already has as many turns waiting as its mailbox holds."""
+
+
+@dataclass
+class MailboxMetrics:
+    """Turns sent to every agent mailbox since startup."""
+
+    accepted: int = 0
+    rejected: int = 0
+    completed: int = 0
+    # How long turns waited for the ones before them.
+    total_wait_ms: float = 0
+    max_wait_ms: float = 0
+    # The most turns that were ever waiting for one agent.
+    max_depth: int = 0
+
+
+@dataclass
+class _Letter:
+    turn: Turn[Any]
+    future: "asyncio.Future[Any]"
+    sent_at: float
+
+
+class AgentMailbox:
+    """Runs the turns sent to one agent one at a time, in the order they were
+    sent, so that they never interleave their changes to its conversation.
+
+    The actor task that runs them only exists while there are turns to run. At
+    most `capacity` turns wait behind the one in flight; more are rejected with
+    MailboxFull. A turn whose sender stopped waiting (e.g. the client
+    disconnected) is skipped if it hasn't started, and otherwise runs to the end
+    so the conversation is left whole."""
+
+    def __init__(
+        self,
+        capacity: int,
+        metrics: MailboxMetrics,
+        on_idle: Optional[Callable[["AgentMailbox"], None]] = None,
+    ):
+        self._capacity = capacity
+        self._metrics = metrics
+        self._on_idle = on_idle
+        self._letters: Deque[_Letter] = deque()
+        self._in_flight = 0
+        self._actor: Optional["asyncio.Task[None]"] = None
+
+    @property
+    def depth(self) -> int:
+        """Turns waiting, not counting the one in flight."""
+        return max(len(self._letters) + self._in_flight - 1, 0)
+
+    @property
+    def busy(self) -> bool:
+        return self._actor is not None
+
+    async def send(self, turn: Turn[T]) -> T:
+        """Runs `turn` once the turns sent before it are done."""
+        if self.busy and self.depth >= self._capacity:
+            self._metrics.rejected += 1
+            raise MailboxFull()
+
+        future: "asyncio.Future[T]" = asyncio.get_running_loop().create_future()
+        self._letters.append(_Letter(turn, future, time.monotonic()))
+        self._metrics.accepted += 1
+        self._metrics.max_depth = max(self._metrics.max_depth, self.depth)
+        if self._actor is None:
+            self._actor = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self) -> None:
+        try:
+            while self._letters:
+                letter = self._letters.popleft()
+                if letter.future.done():
+                    continue
+
+                wait_ms = (time.monotonic() - letter.sent_at) * 1000
+                self._metrics.total_wait_ms += wait_ms
+                self._metrics.max_wait_ms = max(self._metrics.max_wait_ms, wait_ms)
+
+                self._in_flight = 1
+                try:
+                    result = await letter.turn()
+                except Exception as e:
+                    if not letter.future.done():
+                        letter.future.set_exception(e)
+                else:
+                    if not letter.future.done():
+                        letter.future.set_result(result)
+                finally:
+                    self._in_flight = 0
+                self._metrics.completed += 1
+        except asyncio.CancelledError:
+            for letter in self._letters:
+                letter.future.cancel()
+            self._letters.clear()
+            raise
+        finally:
+            self._actor = None
+            if self._on_idle:
+                self._on_idle(self)
+
+
+class AgentMailboxes:
+    """One AgentMailbox per agent of every session, created on the first turn
+    and dropped once the agent is idle. Turns for different agents run in
+    parallel."""
+
+    def __init__(self, capacity: int = 8):
+        self._capacity = capacity
+        self._mailboxes: Dict[Tuple[UUID4, UUID4], AgentMailbox] = {}
+        self.metrics = MailboxMetrics()
+
+    @property
+    def busy_agents(self) -> int:
+        return sum(mailbox.busy for mailbox in self._mailboxes.values())
+
+    @property
+    def queued(self) -> int:
+        """Turns waiting across every agent."""
+        return sum(mailbox.depth for mailbox in self._mailboxes.values())
+
+    async def send(self, session_uuid: UUID4, agent_uuid: UUID4, turn: Turn[T]) -> T:
+        key = (session_uuid, agent_uuid)
+        mailbox = self._mailboxes.get(key)
+        if mailbox is None:
+
+            def on_idle(idle: AgentMailbox):
+                if self._mailboxes.get(key) is idle:
+                    del self._mailboxes[key]
+
+            mailbox = AgentMailbox(self._capacity, self.metrics, on_idle)
+            self._mailboxes[key] = mailbox
+        return await mailbox.send(turn)
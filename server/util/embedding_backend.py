@@ -0,0 +1,52 @@
+import hashlib
+from configparser import ConfigParser
+from typing import Dict, List, Tuple
+
+from llm.base import LLMBase
+from llm.local_embedding import LocalEmbeddingInterface
+from schema import GameDef
+
+# game uuid -> (fingerprint of the lore it was fitted on, fitted interface)
+_local_interfaces: Dict[str, Tuple[str, LocalEmbeddingInterface]] = {}
+
+
+def uses_local_embeddings(game_uuid: str, parser: ConfigParser) -> bool:
+    local_games = _parse_list(parser.get("embedding", "local_games", fallback=""))
+    remote_games = _parse_list(parser.get("embedding", "remote_games", fallback=""))
+    if game_uuid in local_games:
+        return True
+    if game_uuid in remote_games:
+        return False
+    return parser.get("embedding", "backend", fallback="remote") == "local"
+
+
+def get_game_llm(game_def: GameDef, llm: LLMBase, parser: ConfigParser) -> LLMBase:
+    """Returns the LLM sessions of `game_def` should use. For games configured
+    with the local embedding backend, this embeds in-process with a model fitted
+    on the game's lore and delegates completions to `llm`."""
+    game_uuid = str(game_def.uuid)
+    if not uses_local_embeddings(game_uuid, parser):
+        return llm
+
+    corpus = get_lore_corpus(game_def)
+    fingerprint = hashlib.sha256("\n".join(corpus).encode()).hexdigest()
+
+    cached = _local_interfaces.get(game_uuid)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+
+    interface = LocalEmbeddingInterface.fitted_on(llm, corpus)
+    _local_interfaces[game_uuid] = (fingerprint, interface)
+    return interface
+
+
+def get_lore_corpus(game_def: GameDef) -> List[str]:
+    corpus = [game_def.description]
+    corpus += [lore.memory.description for lore in game_def.shared_lore]
+    for agent_def in game_def.agents:
+        corpus += [memory.description for memory in agent_def.personal_lore]
+    return corpus
+
+
+def _parse_list(value: str) -> List[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
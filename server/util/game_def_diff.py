@@ -0,0 +1,106 @@
+from typing import Dict, List, Tuple
+
+from pydantic import UUID4
+
+from schema import GameDef, Lore, Memory
+from server.schema.sync import GameDefDiff
+
+# Whether the lore is personal, and its client_id or else its description.
+LoreKey = Tuple[bool, str]
+
+
+def lore_key(memory: Memory, personal: bool = False) -> LoreKey:
+    return personal, memory.client_id or memory.description
+
+
+def lore_changed(old: Memory, new: Memory) -> bool:
+    """Whether the content of the lore changed. Unrated lore keeps the
+    importance it was rated."""
+    exclude = {"embedding", "isPersenal"}
+    if new.importance == 0:
+        exclude.add("importance")
+    return old.dict(exclude=exclude) != new.dict(exclude=exclude)
+
+
+def diff_game_defs(old: GameDef, new: GameDef) -> GameDefDiff:
+    diff = GameDefDiff()
+
+    old_agents = {agent_def.uuid: agent_def for agent_def in old.agents}
+    new_agents = {agent_def.uuid: agent_def for agent_def in new.agents}
+    diff.agents_added = [uuid for uuid in new_agents if uuid not in old_agents]
+    diff.agents_removed = [uuid for uuid in old_agents if uuid not in new_agents]
+    diff.agents_changed = [
+        uuid
+        for uuid, agent_def in new_agents.items()
+        if uuid in old_agents and old_agents[uuid] != agent_def
+    ]
+
+    old_lore = _shared_lore(old)
+    new_lore = _shared_lore(new)
+    for key, lore in new_lore.items():
+        if key not in old_lore:
+            diff.lore_added.append(lore.memory.description)
+            continue
+        if lore_changed(old_lore[key].memory, lore.memory):
+            diff.lore_changed.append(lore.memory.description)
+        if old_lore[key].known_by != lore.known_by:
+            diff.known_by_changed.append(lore.memory.description)
+    diff.lore_removed = [
+        lore.memory.description for key, lore in old_lore.items() if key not in new_lore
+    ]
+
+    for uuid, agent_def in new_agents.items():
+        old_personal = _personal_lore(
+            old_agents[uuid].personal_lore if uuid in old_agents else []
+        )
+        new_personal = _personal_lore(agent_def.personal_lore)
+        for key, memory in new_personal.items():
+            if key not in old_personal:
+                diff.personal_lore_added.append(memory.description)
+            elif lore_changed(old_personal[key], memory):
+                diff.personal_lore_changed.append(memory.description)
+        diff.personal_lore_removed += [
+            memory.description
+            for key, memory in old_personal.items()
+            if key not in new_personal
+        ]
+    return diff
+
+
+def agent_lore(game_def: GameDef, agent_uuid: UUID4) -> Dict[LoreKey, Memory]:
+    """The lore the agent starts with: the shared lore it knows and its
+    personal lore."""
+    lore = {
+        key: shared.memory
+        for key, shared in _shared_lore(game_def).items()
+        if agent_uuid in shared.known_by
+    }
+    for agent_def in game_def.agents:
+        if agent_def.uuid == agent_uuid:
+            lore.update(_personal_lore(agent_def.personal_lore))
+    return lore
+
+
+def lore_delta(
+    old: Dict[LoreKey, Memory], new: Dict[LoreKey, Memory]
+) -> Tuple[Dict[LoreKey, Memory], Dict[LoreKey, Memory]]:
+    """The lore to forget and the lore to learn to go from `old` to `new`. Lore
+    whose content changed is in both."""
+    changed = {
+        key for key in old.keys() & new.keys() if lore_changed(old[key], new[key])
+    }
+    forgotten = {
+        key: memory for key, memory in old.items() if key not in new or key in changed
+    }
+    learned = {
+        key: memory for key, memory in new.items() if key not in old or key in changed
+    }
+    return forgotten, learned
+
+
+def _shared_lore(game_def: GameDef) -> Dict[LoreKey, Lore]:
+    return {lore_key(lore.memory): lore for lore in game_def.shared_lore}
+
+
+def _personal_lore(memories: List[Memory]) -> Dict[LoreKey, Memory]:
+    return {lore_key(memory, personal=True): memory for memory in memories}
@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import logging
+from configparser import ConfigParser
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from game.memory import rate_importances
+from llm.base import LLMBase
+from schema import GameDef, Memory
+from server.typecheck_fighter import RedisType, pipeline_exec
+from server.util.embedding_backend import get_game_llm, uses_local_embeddings
+from server.util.session_store import pack_embedding, unpack_embedding
+
+# Packed records start with the importance as an int32, followed by the float32
+# embedding. An importance of 0 means the lore wasn't rated.
+_IMPORTANCE_BYTES = 4
+
+
+def lore_key(game_uuid: str) -> str:
+    """Hash of the ingested lore of a game, by text hash."""
+    return f"{game_uuid}:lore"
+
+
+def lore_hash(description: str) -> str:
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def get_lore_memories(game_def: GameDef) -> List[Memory]:
+    memories = [lore.memory for lore in game_def.shared_lore]
+    for agent_def in game_def.agents:
+        memories += agent_def.personal_lore
+    return memories
+
+
+def pack_lore(importance: int, embedding: Optional[List[float]]) -> bytes:
+    return np.int32(importance).tobytes() + pack_embedding(embedding)
+
+
+def unpack_lore(packed: bytes) -> Tuple[int, Optional[List[float]]]:
+    importance = int(np.frombuffer(packed[:_IMPORTANCE_BYTES], dtype=np.int32)[0])
+    return importance, unpack_embedding(packed[_IMPORTANCE_BYTES:])
+
+
+class LoreIngester:
+    """Embeds and rates the lore of game definitions when they are saved, so
+    that sessions start without waiting on the LLM.
+
+    Records are kept in Redis by the hash of the lore's text, so only lore that
+    is new or changed costs LLM calls. Games on the local embedding backend are
+    skipped: their embeddings are computed in-process and change with the rest
+    of their lore."""
+
+    def __init__(self, redis: RedisType, llm: LLMBase, parser: ConfigParser):
+        self._redis = redis
+        self._llm = llm
+        self._parser = parser
+        self._tasks: Dict[str, "asyncio.Task[None]"] = {}
+        # Games saved again while their lore was being ingested.
+        self._pending: Set[str] = set()
+
+    def schedule(self, game_uuid: str) -> None:
+        """Ingests the lore of the game in the background. Saves made while an
+        ingest runs are caught up on by one more ingest once it's done."""
+        if game_uuid in self._tasks:
+            self._pending.add(game_uuid)
+            return
+        self._tasks[game_uuid] = asyncio.create_task(self._run(game_uuid))
+
+    async def _run(self, game_uuid: str) -> None:
+        try:
+            while True:
+                self._pending.discard(game_uuid)
+                try:
+                    await self.ingest(game_uuid)
+                except Exception:
+                    logging.exception("Ingesting the lore of game %s failed", game_uuid)
+                if game_uuid not in self._pending:
+                    break
+        finally:
+            del self._tasks[game_uuid]
+
+    async def ingest(self, game_uuid: str) -> int:
+        """Embeds and rates the lore of the game that isn't yet, and drops the
+        records of lore it no longer has. Returns how many texts were ingested."""
+        jsoned = await self._redis.get(game_uuid)
+        if not jsoned or uses_local_embeddings(game_uuid, self._parser):
+            return 0
+        game_def = GameDef.parse_raw(jsoned)
+        llm = get_game_llm(game_def, self._llm, self._parser)
+
+        records = await self._load_records(game_uuid, llm.embedding_size)
+        memories = get_lore_memories(game_def)
+
+        to_embed: Dict[str, Memory] = {}
+        to_rate: Dict[str, Memory] = {}
+        for memory in memories:
+            text_hash = lore_hash(memory.description)
+            importance, embedding = records.get(text_hash, (0, None))
+            if embedding is None:
+                to_embed.setdefault(text_hash, memory)
+            if memory.importance == 0 and importance == 0:
+                to_rate.setdefault(text_hash, memory)
+
+        embeddings, importances = await asyncio.gather(
+            llm.embed_many([memory.description for memory in to_embed.values()]),
+            rate_importances(llm, list(to_rate.values())),
+        )
+
+        changed = set(to_embed) | set(to_rate)
+        new_records = {
+            text_hash: records.get(text_hash, (0, None)) for text_hash in changed
+        }
+        for text_hash, embedding in zip(to_embed, embeddings):
+            new_records[text_hash] = (new_records[text_hash][0], embedding)
+        for text_hash, importance in zip(to_rate, importances):
+            new_records[text_hash] = (importance, new_records[text_hash][1])
+
+        stale = set(records) - {lore_hash(memory.description) for memory in memories}
+
+        pipe = self._redis.pipeline()
+        if new_records:
+            pipe.hset(
+                lore_key(game_uuid),
+                mapping={
+                    text_hash: pack_lore(importance, embedding)
+                    for text_hash, (importance, embedding) in new_records.items()
+                },
+            )
+        if stale:
+            pipe.hdel(lore_key(game_uuid), *stale)
+        await pipeline_exec(pipe)
+        return len(changed)
+
+    async def apply(self, game_def: GameDef) -> None:
+        """Gives the lore of `game_def` its ingested embeddings and importances.
+        Lore that wasn't ingested yet is left for the session to embed and rate."""
+        game_uuid = str(game_def.uuid)
+        if uses_local_embeddings(game_uuid, self._parser):
+            return
+        records = await self._load_records(game_uuid, self._llm.embedding_size)
+        for memory in get_lore_memories(game_def):
+            text_hash = lore_hash(memory.description)
+            importance, embedding = records.get(text_hash, (0, None))
+            if not memory.embedding:
+                memory.embedding = embedding
+            if memory.importance == 0:
+                memory.importance = importance
+
+    async def close(self) -> None:
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def _load_records(
+        self, game_uuid: str, embedding_size: int
+    ) -> Dict[str, Tuple[int, Optional[List[float]]]]:
+        """Ingested records of the game. Embeddings of another size, from a
+        previous embedding model, count as missing."""
+        packed: Dict[bytes, bytes] = await self._redis.hgetall(lore_key(game_uuid))
+        records: Dict[str, Tuple[int, Optional[List[float]]]] = {}
+        for text_hash, record in packed.items():
+            importance, embedding = unpack_lore(record)
+            if embedding is not None and len(embedding) != embedding_size:
+                embedding = None
+            records[text_hash.decode()] = (importance, embedding)
+        return records
@@ -0,0 +1,122 @@
+import asyncio
+import uuid
+from configparser import ConfigParser
+from typing import Optional
+
+from pydantic import UUID4
+
+from game.agent import GenAgent
+from game.guardrail import GuardrailPrefilter
+from game.memory import GenAgentMemory
+from game.session import Session
+from game.summarizer import ConversationSummarizer
+from game.ti_retriever import TIRetriever
+from llm.base import LLMBase
+from schema import AgentDef, GameDef, Knowledge, Lore, MemoryConfig
+from server.util.embedding_backend import get_game_llm
+
+
+async def build_session(
+    game_def: GameDef,
+    llm: LLMBase,
+    parser: ConfigParser,
+    session_uuid: Optional[UUID4] = None,
+    fill_memories: bool = True,
+) -> Session:
+    """Creates a Session for `game_def` with one GenAgent per AgentDef.
+
+    When `fill_memories`, agents start with their lore and knowledge, which costs
+    embedding and importance rating calls for lore that wasn't ingested when the
+    GameDef was saved. Otherwise their memories are left empty, for a
+    SessionStore to restore."""
+    llm = get_game_llm(game_def, llm, parser)
+
+    if fill_memories:
+        # TODO: embed personal lore at the same time as this
+        async def lore_task(lore: Lore):
+            lore.memory.embedding = await llm.embed(lore.memory.description)
+
+        # Lore ingested when the GameDef was saved is already embedded.
+        await asyncio.gather(
+            *[
+                lore_task(lore)
+                for lore in game_def.shared_lore
+                if not lore.memory.embedding
+            ]
+        )
+
+    guardrail_prefilter = GuardrailPrefilter(llm, game_def.guardrail)
+
+    agents = await asyncio.gather(
+        *[
+            build_agent(
+                game_def, agent_def, llm, parser, guardrail_prefilter, fill_memories
+            )
+            for agent_def in game_def.agents
+        ]
+    )
+    return Session(
+        uuid=session_uuid or uuid.uuid4(),
+        game_def=game_def,
+        agents=list(agents),
+        guardrail_prefilter=guardrail_prefilter,
+    )
+
+
+async def build_agent(
+    game_def: GameDef,
+    agent_def: AgentDef,
+    llm: LLMBase,
+    parser: ConfigParser,
+    guardrail_prefilter: Optional[GuardrailPrefilter] = None,
+    fill_memories: bool = True,
+) -> GenAgent:
+    """Creates the GenAgent for `agent_def`, one of the agents of `game_def`.
+    `llm` is the one get_game_llm() returns for the game."""
+    memory_config = MemoryConfig(
+        max_memories=parser.getint("memory_config", "max_memories", fallback=1024),
+        memories_returned=parser.getint(
+            "memory_config", "default_memories_returned", fallback=5
+        ),
+        embedding_dims=llm.embedding_size,
+    )
+
+    summarize_after_turns = parser.getint(
+        "memory_config", "summarize_after_turns", fallback=0
+    )
+    verbatim_turns = parser.getint("memory_config", "verbatim_turns", fallback=16)
+    remember_summarized_turns = parser.getboolean(
+        "memory_config", "remember_summarized_turns", fallback=False
+    )
+
+    knowledge = Knowledge(
+        game_description=game_def.description,
+        agent_def=agent_def,
+        shared_lore=game_def.shared_lore,
+    )
+
+    memory = GenAgentMemory(
+        llm,
+        memory_config.memories_returned,
+        TIRetriever(memory_config),
+    )
+
+    summarizer = (
+        ConversationSummarizer(
+            llm,
+            summarize_after_turns,
+            verbatim_turns,
+            remember_summarized_turns,
+        )
+        if summarize_after_turns
+        else None
+    )
+
+    return await GenAgent.create(
+        knowledge,
+        llm,
+        memory,
+        summarizer,
+        guardrail_prefilter,
+        fill_memories=fill_memories,
+    )
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import UUID4, BaseModel
+
+
+class SessionChannel:
+    """One client's WebSocket to a session, which carries many requests at once.
+
+    Requests are handled concurrently, up to `max_in_flight` of them; past that
+    the channel stops reading, so a client that sends faster than its requests
+    are answered is slowed down by the socket. Everything sent to the client
+    goes through an outbox of `outbox_size` messages. Results and tokens wait
+    for room in it, which in turn slows down reading the LLM stream. Events are
+    dropped instead, so that one slow client doesn't hold up the others."""
+
+    def __init__(
+        self, websocket: WebSocket, max_in_flight: int = 32, outbox_size: int = 256
+    ):
+        self._websocket = websocket
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._outbox: "asyncio.Queue[BaseModel]" = asyncio.Queue(outbox_size)
+        self.dropped_events = 0
+
+    async def send(self, message: BaseModel) -> None:
+        """Queues `message` for the client, waiting while the outbox is full."""
+        await self._outbox.put(message)
+
+    def push(self, event: BaseModel) -> None:
+        """Queues `event` for the client, unless the outbox is full."""
+        try:
+            self._outbox.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped_events += 1
+
+    async def serve(self, handle: Callable[[str], Awaitable[None]]) -> None:
+        """Calls `handle` with each message from the client, until it
+        disconnects."""
+        sender = asyncio.create_task(self._send_outbox())
+        handlers: Set["asyncio.Task[None]"] = set()
+        try:
+            while True:
+                await self._in_flight.acquire()
+                try:
+                    raw = await self._websocket.receive_text()
+                except WebSocketDisconnect:
+                    break
+                handler = asyncio.create_task(self._handle(handle, raw))
+                handlers.add(handler)
+                handler.add_done_callback(handlers.discard)
+        finally:
+            # Turns already running finish in their mailbox.
+            for handler in handlers:
+                handler.cancel()
+            sender.cancel()
+
+    async def close(self, code: int, reason: str) -> None:
+        await self._websocket.close(code=code, reason=reason)
+
+    async def _handle(self, handle: Callable[[str], Awaitable[None]], raw: str):
+        try:
+            await handle(raw)
+        except Exception:
+            logging.exception("Handling a channel request failed")
+        finally:
+            self._in_flight.release()
+
+    async def _send_outbox(self) -> None:
+        try:
+            while True:
+                message = await self._outbox.get()
+                await self._websocket.send_text(message.json())
+        except (WebSocketDisconnect, RuntimeError):
+            # Closed while sending; serve() stops on the next receive.
+            pass
+
+
+class SessionChannels:
+    """The open channels of every session on this worker."""
+
+    def __init__(self):
+        self._channels: Dict[UUID4, Set[SessionChannel]] = {}
+
+    def add(self, session_uuid: UUID4, channel: SessionChannel) -> None:
+        self._channels.setdefault(session_uuid, set()).add(channel)
+
+    def remove(self, session_uuid: UUID4, channel: SessionChannel) -> None:
+        channels = self._channels.get(session_uuid, set())
+        channels.discard(channel)
+        if not channels:
+            self._channels.pop(session_uuid, None)
+
+    def push(
+        self,
+        session_uuid: UUID4,
+        event: BaseModel,
+        sender: Optional[SessionChannel] = None,
+    ) -> None:
+        """Pushes `event` to every channel of the session but `sender`."""
+        for channel in self._channels.get(session_uuid, set()):
+            if channel is not sender:
+                channel.push(event)
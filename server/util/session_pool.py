@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import deque
+from configparser import ConfigParser
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Optional
+
+from game.session import Session
+from llm.base import LLMBase
+from schema import GameDef
+from server.typecheck_fighter import RedisType
+from server.util.lore_ingest import LoreIngester
+from server.util.session_builder import build_session
+
+
+@dataclass
+class PoolMetrics:
+    """Sessions handed out by the pool since startup."""
+
+    hits: int = 0
+    misses: int = 0
+    # Pooled sessions dropped because their GameDef changed.
+    invalidated: int = 0
+    refills: int = 0
+    failed_refills: int = 0
+    # How long building a pooled session took.
+    total_refill_ms: float = 0
+    max_refill_ms: float = 0
+
+
+@dataclass
+class _GamePool:
+    target: int
+    # Of the GameDef the sessions were built from.
+    fingerprint: Optional[str] = None
+    sessions: Deque[Session] = field(default_factory=deque)
+
+
+def game_def_fingerprint(game_def: GameDef) -> str:
+    return hashlib.sha256(game_def.json().encode()).hexdigest()
+
+
+def parse_pool_sizes(value: str) -> Dict[str, int]:
+    """Parses `game_uuid:size` pairs separated by commas."""
+    sizes: Dict[str, int] = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        game_uuid, _, size = item.partition(":")
+        sizes[game_uuid.strip()] = int(size or 1)
+    return sizes
+
+
+class SessionPool:
+    """Sessions built ahead of time for the games in `sizes`, so that creating
+    one only has to store it.
+
+    Each game's pool is refilled in the background up to its size, building at
+    most `concurrency` sessions at a time. Pooled sessions are dropped when the
+    GameDef they were built from changes, whether it was saved through this
+    worker or another one."""
+
+    def __init__(
+        self,
+        redis: RedisType,
+        llm: LLMBase,
+        parser: ConfigParser,
+        sizes: Dict[str, int],
+        ingester: Optional[LoreIngester] = None,
+        concurrency: int = 2,
+    ):
+        self._redis = redis
+        self._llm = llm
+        self._parser = parser
+        self._ingester = ingester
+        self._pools = {game_uuid: _GamePool(size) for game_uuid, size in sizes.items()}
+        self._building = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self.metrics = PoolMetrics()
+
+    @property
+    def pooled(self) -> int:
+        return sum(len(pool.sessions) for pool in self._pools.values())
+
+    def take(self, game_def: GameDef) -> Optional[Session]:
+        """A pooled session of `game_def`, if there is one. None for games
+        without a pool."""
+        pool = self._pools.get(str(game_def.uuid))
+        if pool is None:
+            return None
+
+        self._wakeup.set()
+        if pool.fingerprint != game_def_fingerprint(game_def):
+            self._invalidate(pool)
+        if not pool.sessions:
+            self.metrics.misses += 1
+            return None
+        self.metrics.hits += 1
+        return pool.sessions.popleft()
+
+    def invalidate(self, game_uuid: str) -> None:
+        """Drops the pooled sessions of a game whose GameDef changed."""
+        pool = self._pools.get(game_uuid)
+        if pool:
+            self._invalidate(pool)
+            self._wakeup.set()
+
+    async def run(self, interval: float) -> None:
+        """Refills the pools whenever a session is taken or a GameDef changes,
+        and every `interval` seconds in case a refill failed. Runs until
+        cancelled."""
+        while True:
+            self._wakeup.clear()
+            await asyncio.gather(
+                *[
+                    self._refill(game_uuid, pool)
+                    for game_uuid, pool in self._pools.items()
+                ]
+            )
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _refill(self, game_uuid: str, pool: _GamePool) -> None:
+        jsoned = await self._redis.get(game_uuid)
+        if not jsoned:
+            self._invalidate(pool)
+            return
+        fingerprint = game_def_fingerprint(GameDef.parse_raw(jsoned))
+        if pool.fingerprint != fingerprint:
+            self._invalidate(pool)
+            pool.fingerprint = fingerprint
+
+        missing = pool.target - len(pool.sessions)
+        sessions = await asyncio.gather(
+            *[self._build(GameDef.parse_raw(jsoned)) for _ in range(missing)]
+        )
+        if pool.fingerprint != fingerprint:
+            # Built from a GameDef that changed in the meantime.
+            return
+        pool.sessions.extend(session for session in sessions if session)
+
+    async def _build(self, game_def: GameDef) -> Optional[Session]:
+        async with self._building:
+            start = time.monotonic()
+            try:
+                if self._ingester:
+                    await self._ingester.apply(game_def)
+                session = await build_session(game_def, self._llm, self._parser)
+            except Exception:
+                logging.exception(
+                    "Building a pooled session of %s failed", game_def.uuid
+                )
+                self.metrics.failed_refills += 1
+                return None
+
+            elapsed_ms = (time.monotonic() - start) * 1000
+            self.metrics.refills += 1
+            self.metrics.total_refill_ms += elapsed_ms
+            self.metrics.max_refill_ms = max(self.metrics.max_refill_ms, elapsed_ms)
+            return session
+
+    def _invalidate(self, pool: _GamePool) -> None:
+        self.metrics.invalidated += len(pool.sessions)
+        pool.sessions.clear()
+        pool.fingerprint = None
@@ -0,0 +1,204 @@
+import bisect
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from pydantic import UUID4
+
+from game.session import Session
+from server.schema.registry import GameSessionStats
+from server.typecheck_fighter import RedisType
+
+# Indexes are sorted sets of session uuids, all with a score of 0 so that they
+# are ordered by uuid and can be paged through with ZRANGEBYLEX.
+SESSIONS_INDEX = "sessions:index"
+
+# Fields of the session hash read back into a RegistryEntry.
+REGISTRY_FIELDS = ["game_uuid", "owner", "agents", "memory_bytes"]
+
+
+@dataclass(frozen=True)
+class RegistryEntry:
+    """What the registry last counted for a session."""
+
+    game_uuid: str
+    owner: Optional[str]
+    agents: int
+    memory_bytes: int
+
+
+def entry_of(session: Session, owner: Optional[str]) -> RegistryEntry:
+    return RegistryEntry(
+        str(session.game_def.uuid), owner, len(session.agents), session.nbytes
+    )
+
+
+def parse_entry(fields: List[Optional[bytes]]) -> Optional[RegistryEntry]:
+    """The entry of a session from its REGISTRY_FIELDS, or None if it was never
+    registered."""
+    game_uuid, owner, agents, memory_bytes = fields
+    if game_uuid is None or agents is None:
+        return None
+    return RegistryEntry(
+        game_uuid.decode(),
+        owner.decode() if owner else None,
+        int(agents),
+        int(memory_bytes or 0),
+    )
+
+
+def _index_keys(game_uuid: str, owner: Optional[str]) -> List[str]:
+    """Every index the session is in."""
+    keys = [SESSIONS_INDEX, _index_key(game_uuid, None)]
+    if owner:
+        keys += [_index_key(None, owner), _index_key(game_uuid, owner)]
+    return keys
+
+
+def _index_key(game_uuid: Optional[str], owner: Optional[str]) -> str:
+    if game_uuid and owner:
+        return f"sessions:game:{game_uuid}:owner:{owner}"
+    if game_uuid:
+        return f"sessions:game:{game_uuid}"
+    if owner:
+        return f"sessions:owner:{owner}"
+    return SESSIONS_INDEX
+
+
+def _stats_key(game_uuid: str) -> str:
+    return f"sessions:game:{game_uuid}:stats"
+
+
+class InMemorySessionRegistry:
+    """Indexes of the sessions of an InMemorySessionStore by game and owner, and
+    their stats per game, updated as sessions are added, saved and deleted."""
+
+    def __init__(self) -> None:
+        self._entries: Dict[UUID4, RegistryEntry] = {}
+        # Sorted session uuids, by the same keys as in Redis.
+        self._indexes: Dict[str, List[str]] = {}
+        self._stats: Dict[str, GameSessionStats] = {}
+
+    def record(self, session: Session, owner: Optional[str] = None) -> None:
+        """Registers the session, or updates its counts. The owner is only set
+        when it's registered."""
+        previous = self._entries.get(session.uuid)
+        entry = entry_of(session, previous.owner if previous else owner)
+        stats = self._stats.setdefault(
+            entry.game_uuid, GameSessionStats(game_uuid=entry.game_uuid)
+        )
+        if previous is None:
+            for key in _index_keys(entry.game_uuid, entry.owner):
+                bisect.insort(self._indexes.setdefault(key, []), str(session.uuid))
+            stats.sessions += 1
+        stats.agents += entry.agents - (previous.agents if previous else 0)
+        stats.memory_bytes += entry.memory_bytes - (
+            previous.memory_bytes if previous else 0
+        )
+        stats.last_activity = time.time()
+        self._entries[session.uuid] = entry
+
+    def remove(self, session_uuid: UUID4) -> None:
+        entry = self._entries.pop(session_uuid, None)
+        if entry is None:
+            return
+        for key in _index_keys(entry.game_uuid, entry.owner):
+            index = self._indexes[key]
+            del index[bisect.bisect_left(index, str(session_uuid))]
+            if not index:
+                del self._indexes[key]
+        stats = self._stats[entry.game_uuid]
+        stats.sessions -= 1
+        stats.agents -= entry.agents
+        stats.memory_bytes -= entry.memory_bytes
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._indexes.clear()
+        self._stats.clear()
+
+    def list_uuids(
+        self,
+        game_uuid: Optional[str] = None,
+        owner: Optional[str] = None,
+        after: Optional[UUID4] = None,
+        limit: Optional[int] = None,
+    ) -> List[UUID4]:
+        index = self._indexes.get(_index_key(game_uuid, owner), [])
+        start = bisect.bisect_right(index, str(after)) if after else 0
+        end = len(index) if limit is None else start + limit
+        return [UUID4(session_uuid) for session_uuid in index[start:end]]
+
+    def stats(self, game_uuid: str) -> GameSessionStats:
+        stats = self._stats.get(game_uuid)
+        return stats.copy() if stats else GameSessionStats(game_uuid=game_uuid)
+
+
+def queue_record(
+    pipe: Any,
+    session_key: str,
+    session_uuid: UUID4,
+    entry: RegistryEntry,
+    previous: Optional[RegistryEntry],
+) -> None:
+    """Queues the writes that register the session in Redis, or update its
+    counts, e.g. in the pipeline that saves it. `previous` is what was last
+    recorded for it."""
+    stats_key = _stats_key(entry.game_uuid)
+    if previous is None:
+        for key in _index_keys(entry.game_uuid, entry.owner):
+            pipe.zadd(key, {str(session_uuid): 0})
+        pipe.hincrby(stats_key, "sessions", 1)
+    agents = entry.agents - (previous.agents if previous else 0)
+    if agents:
+        pipe.hincrby(stats_key, "agents", agents)
+    memory_bytes = entry.memory_bytes - (previous.memory_bytes if previous else 0)
+    if memory_bytes:
+        pipe.hincrby(stats_key, "memory_bytes", memory_bytes)
+    pipe.hset(stats_key, "last_activity", time.time())
+
+    fields: Dict[str, Any] = {
+        "agents": entry.agents,
+        "memory_bytes": entry.memory_bytes,
+    }
+    if entry.owner:
+        fields["owner"] = entry.owner
+    pipe.hset(session_key, mapping=fields)
+
+
+def queue_unregister(pipe: Any, session_uuid: UUID4, entry: RegistryEntry) -> None:
+    for key in _index_keys(entry.game_uuid, entry.owner):
+        pipe.zrem(key, str(session_uuid))
+    stats_key = _stats_key(entry.game_uuid)
+    pipe.hincrby(stats_key, "sessions", -1)
+    pipe.hincrby(stats_key, "agents", -entry.agents)
+    pipe.hincrby(stats_key, "memory_bytes", -entry.memory_bytes)
+
+
+async def list_registered(
+    redis: RedisType,
+    game_uuid: Optional[str] = None,
+    owner: Optional[str] = None,
+    after: Optional[UUID4] = None,
+    limit: Optional[int] = None,
+) -> List[UUID4]:
+    session_uuids = await redis.zrangebylex(
+        _index_key(game_uuid, owner),
+        f"({after}" if after else "-",
+        "+",
+        start=None if limit is None else 0,
+        num=limit,
+    )
+    return [UUID4(session_uuid.decode()) for session_uuid in session_uuids]
+
+
+async def read_stats(redis: RedisType, game_uuid: str) -> GameSessionStats:
+    fields = await redis.hgetall(_stats_key(game_uuid))
+    last_activity = fields.get(b"last_activity")
+    return GameSessionStats(
+        game_uuid=game_uuid,
+        sessions=int(fields.get(b"sessions", 0)),
+        agents=int(fields.get(b"agents", 0)),
+        memory_bytes=int(fields.get(b"memory_bytes", 0)),
+        last_activity=float(last_activity) if last_activity else None,
+    )
@@ -0,0 +1,875 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import numpy as np
+from pydantic import UUID4
+from redis.exceptions import WatchError
+
+from game.agent import GenAgent
+from game.session import Session
+from schema import Conversation, GameDef, Memory, Message
+from server.schema.registry import GameSessionStats
+from server.typecheck_fighter import RedisType, pipeline_exec
+from server.util.session_registry import (
+    REGISTRY_FIELDS,
+    InMemorySessionRegistry,
+    RegistryEntry,
+    entry_of,
+    list_registered,
+    parse_entry,
+    queue_record,
+    queue_unregister,
+    read_stats,
+)
+
+SESSIONS_SET = "SESSIONS"
+
+# Embeddings are stored next to, not inside, the JSON of the models they belong to.
+_GAME_DEF_EXCLUDE: Any = {
+    "shared_lore": {"__all__": {"memory": {"embedding"}}},
+    "agents": {"__all__": {"personal_lore": {"__all__": {"embedding"}}}},
+}
+
+SessionLoader = Callable[[UUID4, GameDef], Awaitable[Session]]
+"""Builds a Session for a GameDef without filling its agents' memories."""
+
+
+class SessionConflict(Exception):
+    """The session was saved by another request since it was loaded, so saving
+    it would overwrite that request's changes."""
+
+
+class SessionStore(ABC):
+    @abstractmethod
+    async def get(self, session_uuid: UUID4) -> Optional[Session]:
+        pass
+
+    @abstractmethod
+    async def add(self, session: Session, owner: Optional[str] = None) -> None:
+        """Stores a new session. `owner` is who created it, e.g. the email of
+        the user it was created for."""
+        pass
+
+    @abstractmethod
+    async def save(self, session: Session) -> None:
+        """Persists whatever changed in `session` since it was last saved."""
+        pass
+
+    @abstractmethod
+    async def exists(self, session_uuid: UUID4) -> bool:
+        pass
+
+    @abstractmethod
+    async def delete(self, session_uuid: UUID4) -> None:
+        pass
+
+    @abstractmethod
+    async def clear(self) -> None:
+        pass
+
+    @abstractmethod
+    async def list_uuids(
+        self,
+        game_uuid: Optional[str] = None,
+        owner: Optional[str] = None,
+        after: Optional[UUID4] = None,
+        limit: Optional[int] = None,
+    ) -> List[UUID4]:
+        """The sessions of the game with `game_uuid` and of `owner`, or of every
+        game and owner, ordered by uuid. Pages start after the session `after`
+        and hold at most `limit` sessions."""
+        pass
+
+    @abstractmethod
+    async def stats(self, game_uuid: str) -> GameSessionStats:
+        pass
+
+    @asynccontextmanager
+    async def checkout(self, session_uuid: UUID4) -> AsyncIterator[Optional[Session]]:
+        """The session for the length of a request. Whatever changed is saved
+        afterwards."""
+        session = await self.get(session_uuid)
+        try:
+            yield session
+        finally:
+            if session:
+                await self.save(session)
+
+    async def is_current(self, session: Session) -> bool:
+        """Whether `session` has every change saved to it, e.g. by a request
+        that ran since it was checked out. Only stores that give each checkout
+        a session of its own can hand out ones that fall behind."""
+        return True
+
+    async def evict(self, now: Optional[float] = None) -> List[UUID4]:
+        """Drops sessions from memory that can be reloaded. Returns their uuids."""
+        return []
+
+    async def run_eviction(self, interval: float) -> None:
+        """Calls evict() every `interval` seconds, until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict()
+            except Exception:
+                logging.exception("Session eviction failed")
+
+    async def delete_game(self, game_uuid: str) -> List[UUID4]:
+        """Deletes every session of the game with `game_uuid`."""
+        session_uuids = await self.list_uuids(game_uuid)
+        for session_uuid in session_uuids:
+            await self.delete(session_uuid)
+        return session_uuids
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    """Keeps sessions in a dict. Nothing survives a restart."""
+
+    def __init__(self, sessions: Optional[Dict[UUID4, Session]] = None):
+        self._sessions: Dict[UUID4, Session] = sessions or {}
+        self._registry = InMemorySessionRegistry()
+        for session in self._sessions.values():
+            self._registry.record(session)
+
+    async def get(self, session_uuid: UUID4) -> Optional[Session]:
+        return self._sessions.get(session_uuid)
+
+    async def add(self, session: Session, owner: Optional[str] = None) -> None:
+        self._sessions[session.uuid] = session
+        self._registry.record(session, owner)
+
+    async def save(self, session: Session) -> None:
+        if self._sessions.get(session.uuid) is session:
+            self._registry.record(session)
+
+    async def exists(self, session_uuid: UUID4) -> bool:
+        return session_uuid in self._sessions
+
+    async def delete(self, session_uuid: UUID4) -> None:
+        self._sessions.pop(session_uuid, None)
+        self._registry.remove(session_uuid)
+
+    async def clear(self) -> None:
+        self._sessions.clear()
+        self._registry.clear()
+
+    async def list_uuids(
+        self,
+        game_uuid: Optional[str] = None,
+        owner: Optional[str] = None,
+        after: Optional[UUID4] = None,
+        limit: Optional[int] = None,
+    ) -> List[UUID4]:
+        return self._registry.list_uuids(game_uuid, owner, after, limit)
+
+    async def stats(self, game_uuid: str) -> GameSessionStats:
+        return self._registry.stats(game_uuid)
+
+
+@dataclass(frozen=True)
+class _AgentSnapshot:
+    """What was last written for an agent. Compared by identity, since history
+    is only appended to or folded from the front, memories are only appended to
+    or replaced as a whole, and contexts are replaced rather than mutated."""
+
+    history: Optional[List[Message]] = None
+    history_length: int = 0
+    last_message: Optional[Message] = None
+    context: Optional[Conversation] = None
+    summary: Optional[str] = None
+    memories: Optional[List[Memory]] = None
+    memory_count: int = 0
+    last_memory: Optional[Memory] = None
+
+
+@dataclass
+class _SessionSnapshot:
+    game_def: Optional[GameDef] = None
+    agents: Dict[str, _AgentSnapshot] = field(default_factory=dict)
+    # Incremented in Redis by every save that writes something.
+    version: int = 0
+    owner: Optional[str] = None
+    # What the session registry counts for it, None until it's registered.
+    registry: Optional[RegistryEntry] = None
+
+
+def _session_key(session_uuid: UUID4) -> str:
+    return f"session:{session_uuid}"
+
+
+def _agent_key(session_uuid: UUID4, agent_uuid: UUID4, suffix: str = "") -> str:
+    return f"session:{session_uuid}:agent:{agent_uuid}{suffix}"
+
+
+def pack_embedding(embedding: Optional[List[float]]) -> bytes:
+    return np.asarray(embedding or [], dtype=np.float32).tobytes()
+
+
+def unpack_embedding(packed: bytes) -> Optional[List[float]]:
+    if not packed:
+        return None
+    return np.frombuffer(packed, dtype=np.float32).tolist()
+
+
+class RedisSessionStore(SessionStore):
+    """Persists sessions to Redis as they change, so a crash loses at most the
+    turns in flight.
+
+    Each save only writes what changed since the last one (new history turns,
+    new memories, a replaced conversation context or summary) in one pipeline.
+    Sessions are loaded lazily, on first access. Embeddings are stored as packed
+    float32. The same pipeline keeps the session registry up to date: indexes
+    of the sessions by game and owner, and their stats per game.
+
+    evict() drops sessions from memory that have been idle for longer than
+    `idle_ttl` seconds, then the least recently used ones until the sessions in
+    memory take at most `memory_budget` bytes. Evicted sessions are saved first
+    and reloaded on their next request. Sessions checked out by a request are
+    never evicted."""
+
+    def __init__(
+        self,
+        redis: RedisType,
+        loader: SessionLoader,
+        idle_ttl: Optional[float] = None,
+        memory_budget: Optional[int] = None,
+    ):
+        self._redis = redis
+        self._loader = loader
+        self._idle_ttl = idle_ttl
+        self._memory_budget = memory_budget
+        self._sessions: Dict[UUID4, Session] = {}
+        self._snapshots: Dict[UUID4, _SessionSnapshot] = {}
+        self._save_locks: Dict[UUID4, asyncio.Lock] = {}
+        self._loading: Dict[UUID4, "asyncio.Task[Optional[Session]]"] = {}
+        self._last_access: Dict[UUID4, float] = {}
+        self._checkouts: Dict[UUID4, int] = {}
+
+    @property
+    def resident_bytes(self) -> int:
+        """Bytes held by the retrievers of the sessions in memory."""
+        return sum(session.nbytes for session in self._sessions.values())
+
+    def is_resident(self, session_uuid: UUID4) -> bool:
+        return session_uuid in self._sessions
+
+    async def get(self, session_uuid: UUID4) -> Optional[Session]:
+        if session_uuid in self._sessions:
+            self._last_access[session_uuid] = time.monotonic()
+            return self._sessions[session_uuid]
+
+        # Concurrent requests for a session that isn't loaded yet share one load.
+        task = self._loading.get(session_uuid)
+        if task is None:
+            task = asyncio.create_task(self._load(session_uuid))
+            self._loading[session_uuid] = task
+            task.add_done_callback(lambda _: self._loading.pop(session_uuid, None))
+        return await asyncio.shield(task)
+
+    @asynccontextmanager
+    async def checkout(self, session_uuid: UUID4) -> AsyncIterator[Optional[Session]]:
+        self._checkouts[session_uuid] = self._checkouts.get(session_uuid, 0) + 1
+        try:
+            async with super().checkout(session_uuid) as session:
+                yield session
+        finally:
+            self._checkouts[session_uuid] -= 1
+            if not self._checkouts[session_uuid]:
+                del self._checkouts[session_uuid]
+
+    async def add(self, session: Session, owner: Optional[str] = None) -> None:
+        self._sessions[session.uuid] = session
+        self._snapshots[session.uuid] = _SessionSnapshot(owner=owner)
+        self._last_access[session.uuid] = time.monotonic()
+        await self.save(session)
+        if self._memory_budget is not None:
+            await self.evict()
+
+    async def save(self, session: Session) -> None:
+        lock = self._save_locks.setdefault(session.uuid, asyncio.Lock())
+        async with lock:
+            # Deleted or evicted while a request was using it.
+            if self._sessions.get(session.uuid) is not session:
+                return
+            await self._save(session)
+
+    async def evict(self, now: Optional[float] = None) -> List[UUID4]:
+        """Saves and drops idle sessions from memory. Returns their uuids."""
+        now = time.monotonic() if now is None else now
+        candidates = sorted(
+            (
+                session_uuid
+                for session_uuid in self._sessions
+                if session_uuid not in self._checkouts
+            ),
+            key=lambda session_uuid: self._last_access.get(session_uuid, 0),
+        )
+
+        evicted: List[UUID4] = []
+        resident_bytes = self.resident_bytes
+        for session_uuid in candidates:
+            session = self._sessions[session_uuid]
+            idle = now - self._last_access.get(session_uuid, 0)
+            expired = self._idle_ttl is not None and idle > self._idle_ttl
+            over_budget = (
+                self._memory_budget is not None
+                and resident_bytes > self._memory_budget
+            )
+            if not expired and not over_budget:
+                # Candidates are ordered from least recently used.
+                break
+            if await self._spill(session):
+                evicted.append(session_uuid)
+                resident_bytes -= session.nbytes
+
+        if evicted:
+            logging.info(
+                "Evicted %d idle sessions, %d bytes still in memory",
+                len(evicted),
+                resident_bytes,
+            )
+        return evicted
+
+    async def release(self, session_uuid: UUID4) -> bool:
+        """Saves and drops a session from memory, e.g. for another worker to take
+        it over. False if a request is using it."""
+        session = self._sessions.get(session_uuid)
+        if session is None:
+            return True
+        return await self._spill(session)
+
+    async def exists(self, session_uuid: UUID4) -> bool:
+        if session_uuid in self._sessions:
+            return True
+        return bool(await self._redis.exists(_session_key(session_uuid)))
+
+    async def delete(self, session_uuid: UUID4) -> None:
+        self._forget(session_uuid)
+        await _delete_session(self._redis, session_uuid)
+
+    async def clear(self) -> None:
+        for session_uuid in await self.list_uuids():
+            await self.delete(session_uuid)
+        for session_uuid in list(self._sessions):
+            self._forget(session_uuid)
+
+    async def list_uuids(
+        self,
+        game_uuid: Optional[str] = None,
+        owner: Optional[str] = None,
+        after: Optional[UUID4] = None,
+        limit: Optional[int] = None,
+    ) -> List[UUID4]:
+        return await list_registered(self._redis, game_uuid, owner, after, limit)
+
+    async def stats(self, game_uuid: str) -> GameSessionStats:
+        return await read_stats(self._redis, game_uuid)
+
+    async def close(self) -> None:
+        for session in list(self._sessions.values()):
+            await self.save(session)
+
+    def _forget(self, session_uuid: UUID4) -> None:
+        self._sessions.pop(session_uuid, None)
+        self._snapshots.pop(session_uuid, None)
+        self._save_locks.pop(session_uuid, None)
+        self._last_access.pop(session_uuid, None)
+
+    async def _spill(self, session: Session) -> bool:
+        lock = self._save_locks.setdefault(session.uuid, asyncio.Lock())
+        async with lock:
+            if (
+                self._sessions.get(session.uuid) is not session
+                or session.uuid in self._checkouts
+            ):
+                return False
+            await self._save(session)
+            self._forget(session.uuid)
+            return True
+
+    async def _load(self, session_uuid: UUID4) -> Optional[Session]:
+        loaded = await _read_session(self._redis, self._loader, session_uuid)
+        if loaded is None:
+            return None
+
+        session, snapshot = loaded
+        self._sessions[session_uuid] = session
+        self._snapshots[session_uuid] = snapshot
+        self._last_access[session_uuid] = time.monotonic()
+        return session
+
+    async def _save(self, session: Session) -> None:
+        snapshot = self._snapshots.get(session.uuid) or _SessionSnapshot()
+        pipe = self._redis.pipeline(transaction=False)
+        changed, new_snapshot = _queue_session_changes(pipe, session, snapshot)
+        if changed:
+            await pipeline_exec(pipe)
+        self._snapshots[session.uuid] = new_snapshot
+
+
+@dataclass
+class _CachedSession:
+    session: Session
+    snapshot: _SessionSnapshot
+    # Lost a race with another save; never saved or reused.
+    stale: bool = False
+
+
+class StatelessSessionStore(SessionStore):
+    """Lets any worker serve any session, e.g. several workers behind a plain
+    round-robin load balancer.
+
+    Redis holds the authoritative state of every session, with the same layout
+    as RedisSessionStore, and a version counter that each save increments. Each
+    worker keeps the sessions it served last in a local cache, at most
+    `memory_budget` bytes of them, and only reuses one if its version is still
+    the one in Redis. Otherwise the session is reloaded.
+
+    Every checkout gets a session of its own. Saves are optimistic: they are
+    written in a MULTI transaction that WATCHes the session, and raise
+    SessionConflict instead if another request saved it first. Requests that
+    only read a session never write."""
+
+    def __init__(
+        self,
+        redis: RedisType,
+        loader: SessionLoader,
+        memory_budget: Optional[int] = None,
+    ):
+        self._redis = redis
+        self._loader = loader
+        self._memory_budget = memory_budget
+        # Least recently used first.
+        self._cache: "OrderedDict[UUID4, _CachedSession]" = OrderedDict()
+        self._checked_out: Dict[int, _CachedSession] = {}
+
+    @property
+    def resident_bytes(self) -> int:
+        """Bytes held by the retrievers of the cached sessions."""
+        return sum(cached.session.nbytes for cached in self._cache.values())
+
+    def is_resident(self, session_uuid: UUID4) -> bool:
+        return session_uuid in self._cache
+
+    async def get(self, session_uuid: UUID4) -> Optional[Session]:
+        """The current session, shared with other readers. Use checkout() to
+        change it."""
+        cached = await self._take(session_uuid)
+        if cached is None:
+            return None
+        await self._cache_session(cached)
+        return cached.session
+
+    @asynccontextmanager
+    async def checkout(self, session_uuid: UUID4) -> AsyncIterator[Optional[Session]]:
+        cached = await self._take(session_uuid)
+        if cached is None:
+            yield None
+            return
+
+        self._checked_out[id(cached.session)] = cached
+        try:
+            yield cached.session
+        finally:
+            try:
+                await self.save(cached.session)
+            except SessionConflict:
+                logging.warning(
+                    "Discarded changes to session %s saved concurrently", session_uuid
+                )
+            finally:
+                del self._checked_out[id(cached.session)]
+            if not cached.stale:
+                await self._cache_session(cached)
+
+    async def add(self, session: Session, owner: Optional[str] = None) -> None:
+        cached = _CachedSession(session, _SessionSnapshot(owner=owner))
+        await self._commit(cached)
+        await self._cache_session(cached)
+
+    async def save(self, session: Session) -> None:
+        cached = self._checked_out.get(id(session)) or self._cache.get(session.uuid)
+        # Deleted, or replaced by a newer version while it was being used.
+        if cached is None or cached.session is not session or cached.stale:
+            return
+        if _is_dirty(session, cached.snapshot):
+            await self._commit(cached)
+
+    async def is_current(self, session: Session) -> bool:
+        cached = self._checked_out.get(id(session))
+        if cached is None or cached.stale:
+            return False
+        version = await self._redis.hget(_session_key(session.uuid), "version")
+        return int(version or 0) == cached.snapshot.version
+
+    async def evict(self, now: Optional[float] = None) -> List[UUID4]:
+        """Drops the least recently used sessions from the cache until it fits
+        the budget."""
+        evicted: List[UUID4] = []
+        if self._memory_budget is None:
+            return evicted
+
+        resident_bytes = self.resident_bytes
+        while self._cache and resident_bytes > self._memory_budget:
+            session_uuid, cached = self._cache.popitem(last=False)
+            evicted.append(session_uuid)
+            resident_bytes -= cached.session.nbytes
+        return evicted
+
+    async def exists(self, session_uuid: UUID4) -> bool:
+        return bool(await self._redis.exists(_session_key(session_uuid)))
+
+    async def delete(self, session_uuid: UUID4) -> None:
+        self._cache.pop(session_uuid, None)
+        await _delete_session(self._redis, session_uuid)
+
+    async def clear(self) -> None:
+        for session_uuid in await self.list_uuids():
+            await self.delete(session_uuid)
+        self._cache.clear()
+
+    async def list_uuids(
+        self,
+        game_uuid: Optional[str] = None,
+        owner: Optional[str] = None,
+        after: Optional[UUID4] = None,
+        limit: Optional[int] = None,
+    ) -> List[UUID4]:
+        return await list_registered(self._redis, game_uuid, owner, after, limit)
+
+    async def stats(self, game_uuid: str) -> GameSessionStats:
+        return await read_stats(self._redis, game_uuid)
+
+    async def close(self) -> None:
+        for cached in list(self._cache.values()):
+            try:
+                await self.save(cached.session)
+            except SessionConflict:
+                logging.warning(
+                    "Discarded changes to session %s saved concurrently",
+                    cached.session.uuid,
+                )
+
+    async def _take(self, session_uuid: UUID4) -> Optional[_CachedSession]:
+        """Takes the session out of the cache if it's up to date, otherwise
+        loads it."""
+        cached = self._cache.pop(session_uuid, None)
+        if cached is not None:
+            version = await self._redis.hget(_session_key(session_uuid), "version")
+            if version is None:
+                return None
+            if int(version) == cached.snapshot.version:
+                return cached
+
+        loaded = await _read_session(self._redis, self._loader, session_uuid)
+        if loaded is None:
+            return None
+        return _CachedSession(*loaded)
+
+    async def _cache_session(self, cached: _CachedSession) -> None:
+        current = self._cache.get(cached.session.uuid)
+        if current is not None and current.snapshot.version > cached.snapshot.version:
+            return
+        self._cache[cached.session.uuid] = cached
+        self._cache.move_to_end(cached.session.uuid)
+        await self.evict()
+
+    async def _commit(self, cached: _CachedSession) -> None:
+        session = cached.session
+        key = _session_key(session.uuid)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                version = await pipe.hget(key, "version")
+                if int(version or 0) != cached.snapshot.version:
+                    raise SessionConflict(session.uuid)
+                pipe.multi()
+                _, cached.snapshot = _queue_session_changes(
+                    pipe, session, cached.snapshot
+                )
+                await pipe.execute()
+            except (SessionConflict, WatchError):
+                cached.stale = True
+                if self._cache.get(session.uuid) is cached:
+                    del self._cache[session.uuid]
+                raise SessionConflict(session.uuid)
+
+
+def _is_dirty(session: Session, snapshot: _SessionSnapshot) -> bool:
+    return snapshot.game_def is not session.game_def or any(
+        _snapshot_of(gen_agent) != snapshot.agents.get(str(gen_agent.uuid))
+        for gen_agent in session.agents
+    )
+
+
+async def _read_session(
+    redis: RedisType, loader: SessionLoader, session_uuid: UUID4
+) -> Optional[Tuple[Session, _SessionSnapshot]]:
+    while True:
+        game_def_json, version, *registry_fields = await redis.hmget(
+            _session_key(session_uuid), ["game_def", "version", *REGISTRY_FIELDS]
+        )
+        if not game_def_json:
+            return None
+
+        session = await loader(session_uuid, GameDef.parse_raw(game_def_json))
+
+        pipe = redis.pipeline()
+        pipe.hget(_session_key(session_uuid), "version")
+        for gen_agent in session.agents:
+            pipe.hgetall(_agent_key(session_uuid, gen_agent.uuid))
+            pipe.lrange(_agent_key(session_uuid, gen_agent.uuid, ":history"), 0, -1)
+            pipe.lrange(_agent_key(session_uuid, gen_agent.uuid, ":memories"), 0, -1)
+            pipe.lrange(_agent_key(session_uuid, gen_agent.uuid, ":embeddings"), 0, -1)
+        results: List[Any] = await pipeline_exec(pipe)
+        if results[0] != version:
+            # Saved in between, possibly with another GameDef.
+            continue
+
+        registry = parse_entry(registry_fields)
+        snapshot = _SessionSnapshot(
+            game_def=session.game_def,
+            version=int(version or 0),
+            owner=registry.owner if registry else None,
+            registry=registry,
+        )
+        for index, gen_agent in enumerate(session.agents):
+            state, history, memories, embeddings = results[
+                4 * index + 1 : 4 * index + 5
+            ]
+            _restore_agent(gen_agent, state, history, memories, embeddings)
+            snapshot.agents[str(gen_agent.uuid)] = _snapshot_of(gen_agent)
+        return session, snapshot
+
+
+def _restore_agent(
+    gen_agent: GenAgent,
+    state: Dict[bytes, bytes],
+    history: List[bytes],
+    memories: List[bytes],
+    embeddings: List[bytes],
+) -> None:
+    restored_memories: List[Memory] = []
+    for memory_json, packed in zip(memories, embeddings):
+        memory = Memory.parse_raw(memory_json)
+        memory.embedding = unpack_embedding(packed)
+        restored_memories.append(memory)
+    gen_agent.memory.restore_memories(restored_memories)
+
+    context = (
+        Conversation.parse_raw(state[b"context"])
+        if b"context" in state
+        else Conversation()
+    )
+    gen_agent.restore_conversation(
+        context,
+        [Message.parse_raw(message) for message in history],
+        state.get(b"summary", b"").decode(),
+    )
+
+
+def _queue_session_changes(
+    pipe: Any, session: Session, snapshot: _SessionSnapshot
+) -> Tuple[bool, _SessionSnapshot]:
+    """Queues the writes for what changed since `snapshot`, and the version
+    increment. Returns whether anything did, and the snapshot after them."""
+    changed = False
+
+    if snapshot.game_def is not session.game_def:
+        pipe.hset(
+            _session_key(session.uuid),
+            mapping={
+                "game_def": session.game_def.json(exclude=_GAME_DEF_EXCLUDE),
+                "game_uuid": str(session.game_def.uuid),
+            },
+        )
+        pipe.sadd(SESSIONS_SET, str(session.uuid))
+        changed = True
+
+    agent_snapshots: Dict[str, _AgentSnapshot] = {}
+    for gen_agent in session.agents:
+        agent_snapshot = snapshot.agents.get(str(gen_agent.uuid), _AgentSnapshot())
+        changed |= _queue_agent_changes(pipe, session.uuid, gen_agent, agent_snapshot)
+        agent_snapshots[str(gen_agent.uuid)] = _snapshot_of(gen_agent)
+
+    for agent_uuid in snapshot.agents.keys() - agent_snapshots.keys():
+        # Removed from the session when its GameDef was synced.
+        pipe.delete(
+            *[
+                _agent_key(session.uuid, UUID4(agent_uuid), suffix)
+                for suffix in ("", ":history", ":memories", ":embeddings")
+            ]
+        )
+        changed = True
+
+    registry = entry_of(session, snapshot.owner)
+    if changed or registry != snapshot.registry:
+        queue_record(
+            pipe, _session_key(session.uuid), session.uuid, registry, snapshot.registry
+        )
+        changed = True
+
+    version = snapshot.version
+    if changed:
+        pipe.hincrby(_session_key(session.uuid), "version", 1)
+        version += 1
+    return changed, _SessionSnapshot(
+        game_def=session.game_def,
+        agents=agent_snapshots,
+        version=version,
+        owner=snapshot.owner,
+        registry=registry,
+    )
+
+
+async def _delete_session(redis: RedisType, session_uuid: UUID4) -> None:
+    keys = [_session_key(session_uuid)]
+    keys += [
+        key async for key in redis.scan_iter(match=f"{_session_key(session_uuid)}:*")
+    ]
+    registry = parse_entry(await redis.hmget(keys[0], REGISTRY_FIELDS))
+    pipe = redis.pipeline()
+    pipe.delete(*keys)
+    pipe.srem(SESSIONS_SET, str(session_uuid))
+    if registry:
+        queue_unregister(pipe, session_uuid, registry)
+    await pipeline_exec(pipe)
+
+
+async def register_unindexed_sessions(redis: RedisType) -> int:
+    """Registers the sessions saved before the session registry existed, so
+    that they are listed. Their memory bytes are counted from their next save.
+    Returns how many there were."""
+    session_uuids = [
+        UUID4(member.decode()) for member in await redis.smembers(SESSIONS_SET)
+    ]
+    pipe = redis.pipeline()
+    for session_uuid in session_uuids:
+        pipe.hmget(_session_key(session_uuid), ["game_def", *REGISTRY_FIELDS])
+    results: List[Any] = await pipeline_exec(pipe)
+
+    registered = 0
+    pipe = redis.pipeline()
+    for session_uuid, (game_def_json, *registry_fields) in zip(session_uuids, results):
+        if not game_def_json or parse_entry(registry_fields):
+            continue
+        game_def = GameDef.parse_raw(game_def_json)
+        key = _session_key(session_uuid)
+        # Another worker may be registering it at the same time.
+        if not await redis.hsetnx(key, "agents", len(game_def.agents)):
+            continue
+        entry = RegistryEntry(str(game_def.uuid), None, len(game_def.agents), 0)
+        queue_record(pipe, key, session_uuid, entry, None)
+        registered += 1
+    await pipeline_exec(pipe)
+    return registered
+
+
+def _snapshot_of(gen_agent: GenAgent) -> _AgentSnapshot:
+    history = gen_agent.conversation_history
+    memories = gen_agent.memory.get_all_memory()
+    return _AgentSnapshot(
+        history=history,
+        history_length=len(history),
+        last_message=history[-1] if history else None,
+        context=gen_agent.conversation_context,
+        summary=gen_agent.conversation_summary,
+        memories=memories,
+        memory_count=len(memories),
+        last_memory=memories[-1] if memories else None,
+    )
+
+
+def _appended_from(snapshot: _AgentSnapshot, history: List[Message]) -> Optional[int]:
+    """Where the turns added since `snapshot` start, or None if history was
+    replaced or folded and has to be rewritten."""
+    if snapshot.history is not history or len(history) < snapshot.history_length:
+        return None
+    if (
+        snapshot.history_length
+        and history[snapshot.history_length - 1] is not snapshot.last_message
+    ):
+        return None
+    return snapshot.history_length
+
+
+def _memories_appended_from(
+    snapshot: _AgentSnapshot, memories: List[Memory]
+) -> Optional[int]:
+    """Where the memories added since `snapshot` start, or None if some were
+    removed and they have to be rewritten."""
+    if snapshot.memories is not memories or len(memories) < snapshot.memory_count:
+        return None
+    if (
+        snapshot.memory_count
+        and memories[snapshot.memory_count - 1] is not snapshot.last_memory
+    ):
+        return None
+    return snapshot.memory_count
+
+
+def _queue_agent_changes(
+    pipe: Any, session_uuid: UUID4, gen_agent: GenAgent, snapshot: _AgentSnapshot
+) -> bool:
+    changed = False
+    history_key = _agent_key(session_uuid, gen_agent.uuid, ":history")
+    history = gen_agent.conversation_history
+
+    appended_from = _appended_from(snapshot, history)
+    if appended_from is None:
+        pipe.delete(history_key)
+        appended_from = 0
+        changed = True
+    if history[appended_from:]:
+        pipe.rpush(history_key, *[message.json() for message in history[appended_from:]])
+        changed = True
+
+    state: Dict[str, str] = {}
+    if gen_agent.conversation_context is not snapshot.context:
+        state["context"] = gen_agent.conversation_context.json()
+    if gen_agent.conversation_summary != snapshot.summary:
+        state["summary"] = gen_agent.conversation_summary
+    if state:
+        pipe.hset(_agent_key(session_uuid, gen_agent.uuid), mapping=state)
+        changed = True
+
+    memories = gen_agent.memory.get_all_memory()
+    memories_from = _memories_appended_from(snapshot, memories)
+    if memories_from is None:
+        pipe.delete(
+            _agent_key(session_uuid, gen_agent.uuid, ":memories"),
+            _agent_key(session_uuid, gen_agent.uuid, ":embeddings"),
+        )
+        memories_from = 0
+        changed = True
+    new_memories = memories[memories_from:]
+    if new_memories:
+        pipe.rpush(
+            _agent_key(session_uuid, gen_agent.uuid, ":memories"),
+            *[memory.json(exclude={"embedding"}) for memory in new_memories],
+        )
+        pipe.rpush(
+            _agent_key(session_uuid, gen_agent.uuid, ":embeddings"),
+            *[pack_embedding(memory.embedding) for memory in new_memories],
+        )
+        changed = True
+
+    return changed
@@ -0,0 +1,161 @@
+import asyncio
+from configparser import ConfigParser
+from typing import Collection, Dict, List
+
+from pydantic import UUID4
+
+from game.memory import rate_importances
+from game.session import Session
+from llm.base import LLMBase
+from schema import GameDef, Knowledge, Memory
+from server.schema.sync import GameDefDiff
+from server.util.game_def_diff import (
+    LoreKey,
+    agent_lore,
+    diff_game_defs,
+    lore_delta,
+    lore_key,
+)
+from server.util.lore_ingest import get_lore_memories
+from server.util.session_builder import build_agent
+
+
+class LoreVectors:
+    """Embeddings and importances of the lore being synced, computed once
+    however many sessions and agents learn it."""
+
+    def __init__(self, llm: LLMBase):
+        self._llm = llm
+        self._embeddings: Dict[str, List[float]] = {}
+        self._importances: Dict[str, int] = {}
+        self._lock = asyncio.Lock()
+
+    def remember(self, memories: List[Memory]) -> None:
+        """Reuses the vectors of lore that was already embedded or rated, e.g.
+        lore that is now known by more agents."""
+        for memory in memories:
+            if memory.embedding:
+                self._embeddings.setdefault(memory.description, memory.embedding)
+            if memory.importance:
+                self._importances.setdefault(memory.description, memory.importance)
+
+    async def prepare(self, lore: Dict[LoreKey, Memory]) -> List[Memory]:
+        """Copies of `lore`, embedded and rated, to add to an agent's
+        memories."""
+        memories = []
+        for (personal, _), memory in lore.items():
+            memory = memory.copy(deep=True)
+            memory.isPersenal = personal
+            memories.append(memory)
+
+        async with self._lock:
+            unembedded = list(
+                {
+                    memory.description
+                    for memory in memories
+                    if not memory.embedding
+                    and memory.description not in self._embeddings
+                }
+            )
+            unrated = list(
+                {
+                    memory.description: memory
+                    for memory in memories
+                    if memory.importance == 0
+                    and memory.description not in self._importances
+                }.values()
+            )
+            embeddings, importances = await asyncio.gather(
+                self._llm.embed_many(unembedded),
+                rate_importances(self._llm, unrated),
+            )
+            self._embeddings.update(zip(unembedded, embeddings))
+            self._importances.update(
+                (memory.description, importance)
+                for memory, importance in zip(unrated, importances)
+            )
+
+        for memory in memories:
+            if not memory.embedding:
+                memory.embedding = self._embeddings[memory.description]
+            if memory.importance == 0:
+                memory.importance = self._importances[memory.description]
+        return memories
+
+
+async def sync_session(
+    session: Session,
+    updated_game: GameDef,
+    llm: LLMBase,
+    parser: ConfigParser,
+    lore_vectors: LoreVectors,
+    cold_agents: Collection[UUID4] = (),
+) -> GameDefDiff:
+    """Brings `session` up to date with `updated_game` by applying only what
+    changed since its GameDef: agents are added and removed, and agents forget
+    the lore they no longer know and learn the lore that is new to them. The
+    rest of their memories and their conversations are kept.
+
+    `llm` is the one get_game_llm() returns for the game. Agents in
+    `cold_agents` haven't been given their lore yet, so only their knowledge is
+    updated."""
+    old_game = session.game_def
+    diff = diff_game_defs(old_game, updated_game)
+    agents = {gen_agent.uuid: gen_agent for gen_agent in session.agents}
+
+    lore_vectors.remember(get_lore_memories(old_game))
+    # Everything that awaits the LLM happens before the session is changed, so
+    # that a failure leaves it as it was.
+    deltas = {
+        agent_def.uuid: lore_delta(
+            agent_lore(old_game, agent_def.uuid) if agent_def.uuid in agents else {},
+            agent_lore(updated_game, agent_def.uuid),
+        )
+        for agent_def in updated_game.agents
+        if agent_def.uuid not in cold_agents
+    }
+    learned = await asyncio.gather(
+        *[lore_vectors.prepare(delta[1]) for delta in deltas.values()]
+    )
+    added = await asyncio.gather(
+        *[
+            build_agent(
+                updated_game,
+                agent_def,
+                llm,
+                parser,
+                session.guardrail_prefilter,
+                fill_memories=False,
+            )
+            for agent_def in updated_game.agents
+            if agent_def.uuid not in agents
+        ]
+    )
+    agents.update((gen_agent.uuid, gen_agent) for gen_agent in added)
+
+    for (agent_uuid, (forgotten, _)), memories in zip(deltas.items(), learned):
+        memory = agents[agent_uuid].memory
+        if forgotten:
+            memory.remove_memories(
+                [
+                    lore
+                    for lore in memory.get_all_memory()
+                    if lore_key(lore, lore.isPersenal) in forgotten
+                ]
+            )
+        await memory.add_memories(memories)
+
+    session.agents = [agents[agent_def.uuid] for agent_def in updated_game.agents]
+    for agent_def, gen_agent in zip(updated_game.agents, session.agents):
+        gen_agent.updateKnowledge(
+            Knowledge(
+                game_description=updated_game.description,
+                agent_def=agent_def,
+                shared_lore=updated_game.shared_lore,
+            )
+        )
+    session.game_def = updated_game
+    if session.guardrail_prefilter:
+        session.guardrail_prefilter.update_config(updated_game.guardrail)
+    session.reindex()
+    return diff
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from pydantic import UUID4
+
+from game.session import Session
+from server.util.session_store import SessionStore
+
+
+class WarmupFailed(Exception):
+    """Filling an agent's memories failed."""
+
+
+class SessionWarmup:
+    """Fills the memories of a new session's agents in the background,
+    `concurrency` agents at a time and in the order given. An agent someone
+    waits for jumps the queue."""
+
+    def __init__(
+        self,
+        session_uuid: UUID4,
+        agent_uuids: List[UUID4],
+        store: SessionStore,
+        concurrency: int,
+    ):
+        self.session_uuid = session_uuid
+        self._store = store
+        self._concurrency = concurrency
+        self._pending: Deque[UUID4] = deque(agent_uuids)
+        self._filled: Dict[UUID4, asyncio.Event] = {
+            agent_uuid: asyncio.Event() for agent_uuid in agent_uuids
+        }
+        self._errors: Dict[UUID4, str] = {}
+        self.stopped = False
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    @property
+    def ready(self) -> bool:
+        return all(self.is_ready(agent_uuid) for agent_uuid in self._filled)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def is_ready(self, agent_uuid: UUID4) -> bool:
+        filled = self._filled.get(agent_uuid)
+        return filled is None or (filled.is_set() and agent_uuid not in self._errors)
+
+    def error(self, agent_uuid: UUID4) -> Optional[str]:
+        return self._errors.get(agent_uuid)
+
+    def start(self) -> None:
+        if self._task is None and self._pending:
+            self._task = asyncio.create_task(self._run())
+
+    async def wait(self, agent_uuid: UUID4) -> None:
+        """Returns once the agent's memories are filled. An agent that failed
+        to warm up is tried again first. Raises WarmupFailed if it fails."""
+        if self.is_ready(agent_uuid):
+            return
+        if agent_uuid in self._errors and self.stopped:
+            raise WarmupFailed(self._errors[agent_uuid])
+        if agent_uuid in self._errors:
+            del self._errors[agent_uuid]
+            self._filled[agent_uuid] = asyncio.Event()
+            self._pending.appendleft(agent_uuid)
+        elif agent_uuid in self._pending:
+            self._pending.remove(agent_uuid)
+            self._pending.appendleft(agent_uuid)
+        filled = self._filled[agent_uuid]
+        self.start()
+
+        await filled.wait()
+        if agent_uuid in self._errors:
+            raise WarmupFailed(self._errors[agent_uuid])
+
+    def cancel(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        try:
+            # Keeps the session in memory, so it isn't evicted half filled.
+            async with self._store.checkout(self.session_uuid) as session:
+                if session is None:
+                    self._stop("Session was deleted")
+                    return
+                while self._pending:
+                    workers = min(self._concurrency, len(self._pending))
+                    await asyncio.gather(
+                        *[self._fill_pending(session) for _ in range(workers)]
+                    )
+        except asyncio.CancelledError:
+            self._stop("Warm-up was cancelled")
+            raise
+        finally:
+            self._task = None
+        # Agents queued again while the session was being saved.
+        self.start()
+
+    async def _fill_pending(self, session: Session) -> None:
+        while self._pending:
+            agent_uuid = self._pending.popleft()
+            try:
+                if not await self._store.exists(self.session_uuid):
+                    self._pending.appendleft(agent_uuid)
+                    self._stop("Session was deleted")
+                    return
+                gen_agent = session.get_agent(str(agent_uuid))
+                if gen_agent is None:
+                    raise WarmupFailed("Agent was removed from the session")
+                await gen_agent.fill_memories()
+                await self._store.save(session)
+            except asyncio.CancelledError:
+                self._errors[agent_uuid] = "Warm-up was cancelled"
+                raise
+            except Exception as e:
+                logging.exception("Warming up agent %s failed", agent_uuid)
+                self._errors[agent_uuid] = str(e) or type(e).__name__
+            finally:
+                self._filled[agent_uuid].set()
+
+    def _stop(self, error: str) -> None:
+        """Fails the agents still waiting for their turn, for good."""
+        self.stopped = True
+        while self._pending:
+            agent_uuid = self._pending.popleft()
+            self._errors[agent_uuid] = error
+            self._filled[agent_uuid].set()
+
+
+class SessionWarmups:
+    """The sessions of this worker whose agents are still being warmed up."""
+
+    def __init__(self, concurrency: int = 4):
+        self._concurrency = concurrency
+        self._warmups: Dict[UUID4, SessionWarmup] = {}
+
+    def start(
+        self, session: Session, store: SessionStore, first_agent: Optional[str] = None
+    ) -> SessionWarmup:
+        """Warms up the agents of `session`, starting with `first_agent`."""
+        agent_uuids = [gen_agent.uuid for gen_agent in session.agents]
+        first = session.get_agent(first_agent) if first_agent else None
+        if first:
+            agent_uuids.remove(first.uuid)
+            agent_uuids.insert(0, first.uuid)
+
+        warmup = SessionWarmup(session.uuid, agent_uuids, store, self._concurrency)
+        self._warmups[session.uuid] = warmup
+        warmup.start()
+        return warmup
+
+    def get(self, session_uuid: UUID4) -> Optional[SessionWarmup]:
+        warmup = self._warmups.get(session_uuid)
+        if warmup and (warmup.ready or warmup.stopped) and not warmup.running:
+            del self._warmups[session_uuid]
+            return None
+        return warmup
+
+    async def wait(self, session_uuid: UUID4, agent_uuid: UUID4) -> None:
+        """Returns once the agent is warmed up, right away unless it's being
+        warmed up on this worker."""
+        warmup = self.get(session_uuid)
+        if warmup:
+            await warmup.wait(agent_uuid)
+
+    def discard(self, session_uuid: UUID4) -> None:
+        warmup = self._warmups.pop(session_uuid, None)
+        if warmup:
+            warmup.cancel()
+
+    async def close(self) -> None:
+        for session_uuid in list(self._warmups):
+            self.discard(session_uuid)
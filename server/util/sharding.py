@@ -0,0 +1,348 @@
+import asyncio
+import bisect
+import hashlib
+import hmac
+import logging
+import re
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import httpx
+from fastapi import Request, Response
+from fastapi.responses import RedirectResponse
+from pydantic import UUID4
+from redis.exceptions import WatchError
+
+from server.typecheck_fighter import RedisType, pipeline_exec
+from server.util.session_store import RedisSessionStore
+
+WORKERS_SET = "WORKERS"
+FORWARDED_HEADER = "x-eastworld-forwarded-by"
+SIGNATURE_HEADER = "x-eastworld-forwarded-signature"
+
+_SESSION_PATH = re.compile(r"^/session/([0-9a-fA-F-]{36})(?:/|$)")
+# Hop-by-hop headers and ones httpx recomputes.
+_DROPPED_HEADERS = {"host", "content-length", "transfer-encoding", "connection"}
+
+
+class SessionMoving(Exception):
+    """The session is still held by another worker, which will release it on its
+    next refresh."""
+
+
+def _heartbeat_key(worker_id: str) -> str:
+    return f"worker:{worker_id}"
+
+
+def _owner_key(session_uuid: UUID4) -> str:
+    return f"session:{session_uuid}:owner"
+
+
+def _signature(secret: str, worker_id: str, method: str, path: str) -> str:
+    message = f"{worker_id}\n{method}\n{path}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of session uuids onto workers. Each worker is placed at
+    `replicas` points of the ring, so a worker joining or leaving only moves
+    about 1/len(workers) of the sessions."""
+
+    def __init__(self, workers: Iterable[str] = (), replicas: int = 64):
+        self._replicas = replicas
+        self._points: List[Tuple[int, str]] = sorted(
+            (_hash(f"{worker}#{replica}"), worker)
+            for worker in set(workers)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in self._points]
+
+    @property
+    def workers(self) -> Set[str]:
+        return {worker for _, worker in self._points}
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._points:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._points)
+        return self._points[index][1]
+
+
+class ShardRouter:
+    """Assigns each session to one worker, so several uvicorn processes or nodes
+    can serve sessions that live in process memory.
+
+    The worker that should own a session is chosen by consistent hashing over
+    the live workers, which heartbeat into Redis. The worker that currently
+    holds a session in memory is recorded in Redis as well; requests are
+    forwarded (or redirected) to that holder until it releases the session. When
+    workers join or leave, each worker releases the sessions that now hash to
+    someone else by saving them to the store, and their new owner loads them on
+    the next request.
+
+    Each worker must be reachable at its own `address`, e.g. one uvicorn process
+    per port behind the load balancer. Requests forwarded between workers are
+    signed with `secret`, which every worker of the cluster shares, so that
+    clients can't pass their requests off as forwarded ones."""
+
+    def __init__(
+        self,
+        redis: RedisType,
+        store: RedisSessionStore,
+        worker_id: str,
+        address: str,
+        secret: str,
+        redirect: bool = False,
+        heartbeat_ttl: float = 15,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
+        self._redis = redis
+        self._store = store
+        self.worker_id = worker_id
+        self._address = address
+        self._secret = secret
+        self._redirect = redirect
+        self._heartbeat_ttl = heartbeat_ttl
+        self._http_client = http_client or httpx.AsyncClient(timeout=None)
+        self._ring = HashRing([worker_id])
+        self._addresses: Dict[str, str] = {worker_id: address}
+        self._held: Set[UUID4] = set()
+
+    @property
+    def ring(self) -> HashRing:
+        return self._ring
+
+    def owns(self, session_uuid: UUID4) -> bool:
+        return self._ring.owner(str(session_uuid)) == self.worker_id
+
+    def is_forwarded(self, request: Request) -> bool:
+        """Whether `request` was forwarded by a worker of this cluster."""
+        worker_id = request.headers.get(FORWARDED_HEADER)
+        signature = request.headers.get(SIGNATURE_HEADER)
+        if not worker_id or not signature:
+            return False
+        expected = _signature(self._secret, worker_id, request.method, request.url.path)
+        return hmac.compare_digest(signature, expected)
+
+    async def join(self) -> None:
+        await self._heartbeat()
+        await self.refresh()
+
+    async def leave(self) -> None:
+        """Releases every held session and deregisters. Call after the store
+        has saved its sessions."""
+        pipe = self._redis.pipeline()
+        pipe.srem(WORKERS_SET, self.worker_id)
+        pipe.delete(_heartbeat_key(self.worker_id))
+        await pipeline_exec(pipe)
+        for session_uuid in list(self._held):
+            await self._release_ownership(session_uuid)
+
+    async def refresh(self) -> None:
+        """Rebuilds the ring from the live workers and releases the sessions
+        that moved to another worker."""
+        workers = sorted(
+            member.decode() for member in await self._redis.smembers(WORKERS_SET)
+        )
+        addresses = (
+            await self._redis.mget([_heartbeat_key(worker) for worker in workers])
+            if workers
+            else []
+        )
+
+        live: Dict[str, str] = {self.worker_id: self._address}
+        dead: List[str] = []
+        for worker, address in zip(workers, addresses):
+            if address:
+                live[worker] = address.decode()
+            elif worker != self.worker_id:
+                dead.append(worker)
+        if dead:
+            await self._redis.srem(WORKERS_SET, *dead)
+
+        if set(live) != self._ring.workers:
+            logging.info("Workers changed to %s, rebalancing", sorted(live))
+            self._ring = HashRing(live)
+        self._addresses = live
+        await self.rebalance()
+
+    async def rebalance(self) -> None:
+        for session_uuid in list(self._held):
+            if not self.owns(session_uuid) and await self._store.release(session_uuid):
+                await self._release_ownership(session_uuid)
+
+    async def run(self, interval: float) -> None:
+        """Heartbeats and refreshes every `interval` seconds, until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._heartbeat()
+                await self.refresh()
+            except Exception:
+                logging.exception("Refreshing workers failed")
+
+    async def route(
+        self, session_uuid: UUID4, forwarded: bool = False
+    ) -> Optional[str]:
+        """The address of the worker that should handle a request for
+        `session_uuid`, or None if it's this one.
+
+        Requests that were already forwarded are never forwarded again. Raises
+        SessionMoving if another worker still holds the session."""
+        if session_uuid in self._held:
+            return None
+
+        holder = await self._redis.get(_owner_key(session_uuid))
+        holder_id = holder.decode() if holder else None
+        if holder_id == self.worker_id:
+            self._held.add(session_uuid)
+            return None
+        if holder_id in self._addresses:
+            if forwarded:
+                raise SessionMoving(session_uuid)
+            return self._addresses[holder_id]
+
+        owner = self._ring.owner(str(session_uuid))
+        if owner != self.worker_id and not forwarded:
+            return self._addresses[owner]
+
+        # Unclaimed, or held by a worker that died.
+        if not await self._claim(session_uuid, holder_id):
+            return await self.route(session_uuid, forwarded)
+        self._held.add(session_uuid)
+        return None
+
+    async def adopt(self, session_uuid: UUID4) -> None:
+        """Call for sessions created here. Keeps them if this worker owns them,
+        otherwise hands them over to the store for their owner to load."""
+        if self.owns(session_uuid):
+            await self._redis.set(_owner_key(session_uuid), self.worker_id)
+            self._held.add(session_uuid)
+        else:
+            await self._store.release(session_uuid)
+
+    async def forward(
+        self, request: Request, address: str, redirect: Optional[bool] = None
+    ) -> Response:
+        url = address.rstrip("/") + request.url.path
+        if request.url.query:
+            url += "?" + request.url.query
+
+        if self._redirect if redirect is None else redirect:
+            return RedirectResponse(url, status_code=307)
+
+        headers = {
+            key: value
+            for key, value in request.headers.items()
+            if key.lower() not in _DROPPED_HEADERS
+        }
+        headers[FORWARDED_HEADER] = self.worker_id
+        headers[SIGNATURE_HEADER] = _signature(
+            self._secret, self.worker_id, request.method, request.url.path
+        )
+        response = await self._http_client.request(
+            request.method, url, headers=headers, content=await request.body()
+        )
+        return Response(
+            content=response.content,
+            status_code=response.status_code,
+            headers={
+                key: value
+                for key, value in response.headers.items()
+                if key.lower() not in _DROPPED_HEADERS
+            },
+        )
+
+    async def broadcast(self, request: Request) -> None:
+        """Sends `request` to every other live worker, e.g. so they apply a
+        /session/sync to the sessions they hold."""
+        others = [
+            address
+            for worker, address in self._addresses.items()
+            if worker != self.worker_id
+        ]
+        results = await asyncio.gather(
+            *[self.forward(request, address, redirect=False) for address in others],
+            return_exceptions=True,
+        )
+        for address, result in zip(others, results):
+            if isinstance(result, Exception):
+                logging.warning("Broadcasting to %s failed: %s", address, result)
+
+    async def _heartbeat(self) -> None:
+        pipe = self._redis.pipeline()
+        pipe.sadd(WORKERS_SET, self.worker_id)
+        pipe.set(
+            _heartbeat_key(self.worker_id),
+            self._address,
+            px=int(self._heartbeat_ttl * 1000),
+        )
+        await pipeline_exec(pipe)
+
+    async def _claim(self, session_uuid: UUID4, holder_id: Optional[str]) -> bool:
+        """Records this worker as the holder of the session, unless the holder
+        is no longer `holder_id`, e.g. because another worker claimed it
+        first."""
+        key = _owner_key(session_uuid)
+        if holder_id is None:
+            return bool(await self._redis.set(key, self.worker_id, nx=True))
+
+        async with self._redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                holder = await pipe.get(key)
+                if holder is None or holder.decode() != holder_id:
+                    return False
+                pipe.multi()
+                pipe.set(key, self.worker_id)
+                await pipe.execute()
+            except WatchError:
+                return False
+        return True
+
+    async def _release_ownership(self, session_uuid: UUID4) -> None:
+        self._held.discard(session_uuid)
+        # Only the holder ever clears the key; others only claim free keys.
+        holder = await self._redis.get(_owner_key(session_uuid))
+        if holder and holder.decode() == self.worker_id:
+            await self._redis.delete(_owner_key(session_uuid))
+
+
+async def route_to_owner(
+    request: Request, call_next: Callable[[Request], Awaitable[Response]]
+) -> Response:
+    """HTTP middleware sending /session/{session_uuid}/... requests to the worker
+    that owns the session. Does nothing unless a ShardRouter is configured."""
+    shard_router: Optional[ShardRouter] = getattr(request.state, "shard_router", None)
+    match = _SESSION_PATH.match(request.url.path)
+    if not shard_router or not match:
+        return await call_next(request)
+
+    try:
+        session_uuid = UUID4(match.group(1))
+    except ValueError:
+        return await call_next(request)
+
+    try:
+        address = await shard_router.route(
+            session_uuid, forwarded=shard_router.is_forwarded(request)
+        )
+    except SessionMoving:
+        return Response(
+            content="Session is moving between workers",
+            status_code=503,
+            headers={"Retry-After": "1"},
+        )
+    if address is None:
+        return await call_next(request)
+    return await shard_router.forward(request, address)
+
+
+def is_forwarded(request: Request) -> bool:
+    """Whether `request` was forwarded by another worker, e.g. as part of a
+    broadcast it already sent to every worker."""
+    shard_router: Optional[ShardRouter] = getattr(request.state, "shard_router", None)
+    return shard_router is not None and shard_router.is_forwarded(request)
@@ -0,0 +1,62 @@
+from game.actions import ActionRegistry
+from schema import Action, ActionCompletion, Parameter
+
+MOVE = Action(
+    name="move",
+    description="moves",
+    parameters=[
+        Parameter(name="x", description="x coordinate", type="number"),
+        Parameter(name="run", description="whether to run", type="boolean"),
+    ],
+)
+
+ATTACK = Action(
+    name="attack",
+    description="attacks a character",
+    parameters=[
+        Parameter(
+            name="character", description="who", type="string", enum=["Serf", "Noble"]
+        )
+    ],
+)
+
+
+def test_tools_are_cached_payloads():
+    registry = ActionRegistry([MOVE, ATTACK])
+
+    tool = registry.tools[1]
+    assert tool["type"] == "function"
+    assert tool["function"]["parameters"]["properties"]["character"]["enum"] == [
+        "Serf",
+        "Noble",
+    ]
+    assert "enum" not in registry.functions[0]["parameters"]["properties"]["x"]
+    assert registry.functions[0]["parameters"]["required"] == ["x", "run"]
+
+
+def test_valid_args():
+    registry = ActionRegistry([MOVE, ATTACK])
+
+    completion = registry.validate(
+        ActionCompletion(action="move", args={"x": 1.5, "run": False})
+    )
+
+    assert completion.errors == []
+
+
+def test_invalid_args():
+    registry = ActionRegistry([MOVE, ATTACK])
+
+    move = registry.validate(ActionCompletion(action="move", args={"x": True, "y": 2}))
+    attack = registry.validate(
+        ActionCompletion(action="attack", args={"character": "King"})
+    )
+    unknown = registry.validate(ActionCompletion(action="dance", args={}))
+
+    assert [(e.parameter, e.kind) for e in move.errors] == [
+        ("x", "type"),
+        ("run", "missing"),
+        ("y", "unexpected"),
+    ]
+    assert [e.kind for e in attack.errors] == ["enum"]
+    assert [e.kind for e in unknown.errors] == ["unknown_action"]
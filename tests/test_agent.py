@@ -1,27 +1,43 @@
 import uuid
 from typing import Any
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, MagicMock
 
 from game.agent import Conversation, GenAgent, Knowledge
+from game.guardrail import GuardrailPrefilter
+from game.keywords import KeywordAnnotator
+from game.memory import GenAgentMemory
 from game.prompt_helpers import (
     generate_functions_from_actions,
+    generate_tools_from_actions,
     get_action_messages,
     get_chat_messages,
     get_interact_messages,
 )
+from game.summarizer import ConversationSummarizer
+from game.ti_retriever import TIRetriever
 from schema import (
     Action,
     ActionCompletion,
     AgentDef,
     GameStage,
+    GuardrailConfig,
     Lore,
     Memory,
+    MemoryConfig,
     Message,
     Parameter,
 )
 from tests.helpers import AsyncCopyingMock
 
 
+def create_memory() -> Any:
+    """A mocked GenAgentMemory whose keyword and lore lookups find nothing."""
+    memory: Any = AsyncMock()
+    memory.keyword_annotator = KeywordAnnotator()
+    memory.get_similar_memories = MagicMock(return_value=[])
+    return memory
+
+
 def create_agent_def() -> AgentDef:
     move_ps = [
         Parameter(name="x", description="x coordinate to move to", type="number"),
@@ -71,6 +87,8 @@ async def test_add_memory():
         ),
         known_by=set(),
     )
+    personal = Memory(description="I fear the previous king's son.")
+    agent_def.personal_lore = [personal]
     knowledge = Knowledge(
         game_description="Game description",
         agent_def=agent_def,
@@ -78,8 +96,11 @@ async def test_add_memory():
     )
 
     agent = await GenAgent.create(knowledge, llm, memory)
-    assert memory.add_memory.call_count == 1
-    memory.add_memory.assert_called_with(lore1.memory)
+    # The agent's lore is added in one batch: the shared lore it knows, then its
+    # personal lore.
+    memory.add_memories.assert_awaited_once_with([lore1.memory, personal])
+    assert personal.isPersenal
+    memory.add_memory.assert_not_called()
 
     simple_memory = Memory(
         importance=0,
@@ -89,12 +110,11 @@ async def test_add_memory():
     )
 
     await agent.add_memory(simple_memory)
-    memory.add_memory.assert_called_with(simple_memory)
-    assert memory.add_memory.call_count == 2
+    memory.add_memory.assert_called_once_with(simple_memory)
 
 
 async def test_interact():
-    memory: Any = AsyncMock()
+    memory = create_memory()
     llm: Any = AsyncMock()
     # TODO: this is here because the assert() compares the reference, which gets mutated
     # after; Can we remove this?
@@ -118,10 +138,10 @@ async def test_interact():
         get_interact_messages(
             knowledge,
             Conversation(),
-            [m.description for m in memories],
+            memories,
             [Message(role="user", content="What's up?")],
         ),
-        generate_functions_from_actions(agent_def.actions),
+        generate_tools_from_actions(agent_def.actions),
     )
 
     await agent.interact("Wtf?")
@@ -130,14 +150,14 @@ async def test_interact():
         get_interact_messages(
             knowledge,
             Conversation(),
-            [memory.description for memory in memories],
+            memories,
             [
                 Message(role="user", content="What's up?"),
                 Message(role="assistant", content="Not much, peasant!"),
                 Message(role="user", content="Wtf?"),
             ],
         ),
-        generate_functions_from_actions(agent_def.actions),
+        generate_tools_from_actions(agent_def.actions),
     )
 
     llm.completion.return_value = ActionCompletion(
@@ -151,7 +171,7 @@ async def test_interact():
 
 
 async def test_chat():
-    memory: Any = AsyncMock()
+    memory = create_memory()
     llm: Any = AsyncMock()
     # TODO: this is here because the assert() compares the reference, which gets mutated
     # after; Can we remove this?
@@ -174,7 +194,7 @@ async def test_chat():
         get_chat_messages(
             knowledge,
             Conversation(),
-            [memory.description for memory in memories],
+            memories,
             [Message(role="user", content="What's up?")],
         ),
     )
@@ -188,7 +208,7 @@ async def test_chat():
         get_chat_messages(
             knowledge,
             Conversation(),
-            [memory.description for memory in memories],
+            memories,
             [
                 Message(role="user", content="What's up?"),
                 Message(role="assistant", content="Not much, peasant!"),
@@ -205,14 +225,14 @@ async def test_chat():
         get_chat_messages(
             knowledge,
             conversation.copy(),
-            [memory.description for memory in memories],
+            memories,
             [Message(role="user", content="New Conversation")],
         )
     )
 
 
 async def test_act():
-    memory: Any = AsyncMock()
+    memory = create_memory()
     llm: Any = AsyncMock()
     # TODO: this is here because the assert() compares the reference, which gets mutated
     # after; Can we remove this?
@@ -238,7 +258,7 @@ async def test_act():
         get_action_messages(
             knowledge,
             Conversation(),
-            [memory.description for memory in memories],
+            memories,
             [
                 Message(role="user", content="I will usurp your throne!"),
             ],
@@ -249,3 +269,204 @@ async def test_act():
     assert isinstance(resp, ActionCompletion)
     assert resp.action == "attack"
     assert resp.args["character"] == "Player"
+
+
+async def test_batched_query():
+    memory: Any = AsyncMock()
+    llm: Any = AsyncMock()
+
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    agent = await GenAgent.create(knowledge, llm, memory)
+    memory.retrieve_relevant_memories.return_value = [Memory(description="asdf")]
+
+    llm.structured_completion.return_value = ActionCompletion(
+        action="RateAll", args={"rating_1": "Very.", "rating_2": "Not at all."}
+    )
+    ratings = await agent.query(["How happy are you", "How angry are you"])
+
+    assert ratings == [5, 1]
+    assert llm.structured_completion.call_count == 1
+
+
+async def test_batched_query_falls_back():
+    memory: Any = AsyncMock()
+    llm: Any = AsyncMock()
+
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    agent = await GenAgent.create(knowledge, llm, memory)
+    memory.retrieve_relevant_memories.return_value = []
+
+    llm.structured_completion.side_effect = [
+        ActionCompletion(action="RateAll", args={"rating_1": "Fairly."}),
+        ActionCompletion(action="Rate", args={"rating": "Moderately."}),
+    ]
+    ratings = await agent.query(["How happy are you", "How angry are you"])
+
+    assert ratings == [4, 3]
+    assert llm.structured_completion.call_count == 2
+
+
+async def test_guardrail_many():
+    memory: Any = AsyncMock()
+    llm: Any = AsyncMock()
+
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    prefilter = GuardrailPrefilter(llm, GuardrailConfig(blocklist=["phone"]))
+    agent = await GenAgent.create(knowledge, llm, memory, None, prefilter)
+
+    llm.structured_completion.side_effect = [
+        ActionCompletion(action="RateAll", args={"rating_1": "Very."}),
+        ActionCompletion(action="Rate", args={"rating": "Fairly."}),
+    ]
+    ratings = await agent.guardrail_many(
+        ["Hello there.", "Lend me your phone.", "Nice hat."]
+    )
+
+    assert ratings == [5, 1, 4]
+    assert llm.structured_completion.call_count == 2
+    assert "Nice hat." in llm.structured_completion.call_args_list[0][0][0][-1].content
+    assert "phone" not in llm.structured_completion.call_args_list[0][0][0][-1].content
+
+
+async def test_suggest():
+    memory: Any = AsyncMock()
+    llm: Any = AsyncMock()
+
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    agent = await GenAgent.create(knowledge, llm, memory)
+    memory.retrieve_relevant_memories.return_value = []
+
+    llm.structured_completion.side_effect = [
+        ActionCompletion(
+            action="SuggestLines",
+            args={"lines": ["Hello.", "King says: Hello.", "", "Go away."]},
+        ),
+        ActionCompletion(
+            action="RateAll", args={"rating_1": "Very.", "rating_2": "Not very."}
+        ),
+    ]
+    suggestions, ratings, _ = await agent.suggest("Hi!", 3, guardrail=True)
+
+    assert [suggestion.content for suggestion in suggestions] == [
+        "Hello.",
+        "Go away.",
+    ]
+    assert ratings == [5, 2]
+    assert agent._conversation_history == []
+    suggest_messages = llm.structured_completion.call_args_list[0][0][0]
+    assert "Hi!" in suggest_messages[-2].content
+
+
+async def test_history_is_summarized():
+    memory = create_memory()
+    llm: Any = AsyncMock()
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    summarizer = ConversationSummarizer(
+        llm, max_turns=4, window=2, remember_folded_turns=True
+    )
+    agent = await GenAgent.create(knowledge, llm, memory, summarizer)
+    memory.retrieve_relevant_memories.return_value = []
+
+    llm.chat_completion.return_value = Message(role="assistant", content="Hmph.")
+    for i in range(3):
+        await agent.chat(str(i))
+
+    # Summarization runs in the background, after the response.
+    assert agent._summary_task
+    await agent._summary_task
+
+    assert agent._conversation_summary == "Hmph."
+    assert [m.content for m in agent._conversation_history] == ["2", "Hmph."]
+    transcript = "Player says: 0\nKing says: Hmph.\nPlayer says: 1\nKing says: Hmph."
+    memory.add_memories.assert_called_with([Memory(description=transcript)])
+
+    await agent.chat("3")
+    sent = llm.chat_completion.call_args.args[0]
+    assert sent[1].role == "system"
+    assert sent[1].content.endswith("Hmph.")
+
+
+async def test_lore_attribution_is_batched():
+    llm: Any = AsyncMock()
+    memory = GenAgentMemory(llm, 5, TIRetriever(MemoryConfig(embedding_dims=2)))
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    agent = await GenAgent.create(knowledge, llm, memory)
+
+    await memory.add_memories(
+        [
+            Memory(
+                description="The king was poisoned.",
+                client_id="poison",
+                importance=5,
+                embedding=[0.99, 0.1],
+            ),
+            Memory(description="Bread is tasty.", importance=1, embedding=[0.0, 1.0]),
+        ]
+    )
+
+    llm.embed_many.return_value = [[1.0, 0.0], [0.0, 1.0], [0.7, 0.7]]
+    attributions = await agent._processMessage("Poison killed him, I like bread. Both!?")
+
+    llm.embed_many.assert_called_with(["Poison killed him", "I like bread", "Both"])
+    assert attributions == [
+        ("Poison killed him", ["poison"]),
+        ("I like bread", []),
+        ("Both", []),
+    ]
+
+
+async def test_chat_carries_lore_ids():
+    llm: Any = AsyncMock()
+    memory = GenAgentMemory(llm, 5, TIRetriever(MemoryConfig(embedding_dims=2)))
+    knowledge = Knowledge(
+        game_description="Game description",
+        agent_def=create_agent_def(),
+        shared_lore=[],
+    )
+    agent = await GenAgent.create(knowledge, llm, memory)
+    await memory.add_memories(
+        [
+            Memory(
+                description="The king was poisoned.",
+                client_id="poison",
+                importance=5,
+                embedding=[0.99, 0.1],
+            ),
+        ]
+    )
+    llm.embed.return_value = [1.0, 0.0]
+    llm.embed_many.return_value = [[1.0, 0.0], [0.0, 1.0]]
+    llm.chat_completion.return_value = Message(
+        role="assistant",
+        content="Poison killed him[memory_id]poison[/memory_id]. Bread is tasty.",
+    )
+
+    response, _ = await agent.chat("How did he die?")
+
+    llm.embed_many.assert_called_with(["Poison killed him", "Bread is tasty"])
+    assert response.lore_ids == ["poison"]
+    assert response.memory_ids == ["poison"]
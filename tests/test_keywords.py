@@ -0,0 +1,47 @@
+from game.keywords import KeywordAnnotator, parse_citations
+
+
+def test_annotates_all_keywords():
+    annotator = KeywordAnnotator(["king", "dagger"])
+
+    annotated = annotator.annotate("The king hid the dagger. Long live the king!")
+
+    assert annotated == (
+        "The [keyword]king[/keyword] hid the [keyword]dagger[/keyword]. "
+        "Long live the [keyword]king[/keyword]!"
+    )
+
+
+def test_longest_match_wins():
+    annotator = KeywordAnnotator(["king", "kingdom", "dom", "old kingdom"])
+
+    assert annotator.annotate("the old kingdom fell") == (
+        "the [keyword]old kingdom[/keyword] fell"
+    )
+    assert annotator.annotate("a kingdom") == "a [keyword]kingdom[/keyword]"
+
+
+def test_overlapping_keywords_are_not_double_wrapped():
+    annotator = KeywordAnnotator(["abc", "bcd", "c"])
+
+    assert annotator.find("abcd") == [(0, 3, "abc")]
+    assert annotator.annotate("xbcdx") == "x[keyword]bcd[/keyword]x"
+
+
+def test_keywords_added_after_scanning():
+    annotator = KeywordAnnotator(["毒药"])
+    assert annotator.annotate("他用毒药杀了国王") == "他用[keyword]毒药[/keyword]杀了国王"
+
+    annotator.add_keywords(["国王"])
+    assert annotator.annotate("他用毒药杀了国王") == (
+        "他用[keyword]毒药[/keyword]杀了[keyword]国王[/keyword]"
+    )
+
+
+def test_parse_citations():
+    text = (
+        "The king was poisoned.[memory_id]12[/memory_id] I saw it."
+        "[memory_id]7[/memory_id][memory_id]12[/memory_id]"
+    )
+
+    assert parse_citations(text) == ["12", "7"]
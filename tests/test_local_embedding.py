@@ -0,0 +1,46 @@
+from typing import Any
+from unittest.mock import AsyncMock
+
+import numpy as np
+
+from llm.local_embedding import HashedTfidfEmbedder, LocalEmbeddingInterface
+
+LORE = [
+    "The king was poisoned at the royal banquet.",
+    "The blacksmith forges swords for the royal guard.",
+    "A dragon sleeps beneath the northern mountain.",
+]
+
+
+def test_embeddings_are_normalized():
+    embedder = HashedTfidfEmbedder(64).fit(LORE)
+
+    embeddings = embedder.embed_many(LORE + [""])
+
+    assert embeddings.shape == (4, 64)
+    np.testing.assert_allclose(np.linalg.norm(embeddings[:3], axis=1), 1, rtol=1e-5)
+    assert not embeddings[3].any()
+
+
+def test_similar_text_scores_higher():
+    embedder = HashedTfidfEmbedder(256).fit(LORE)
+
+    lore = embedder.embed_many(LORE)
+    query = embedder.embed_many(["Who poisoned the king?"])[0]
+
+    scores = lore @ query
+    assert int(np.argmax(scores)) == 0
+
+
+async def test_interface_embeds_locally():
+    llm: Any = AsyncMock()
+    llm.embedding_size = 32
+
+    interface = LocalEmbeddingInterface.fitted_on(llm, LORE)
+
+    single = await interface.embed(LORE[1])
+    batch = await interface.embed_many(LORE)
+
+    assert interface.embedding_size == 32
+    np.testing.assert_allclose(single, batch[1], rtol=1e-6)
+    llm.embed.assert_not_called()
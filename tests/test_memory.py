@@ -3,7 +3,7 @@ from typing import Any, List
 from unittest.mock import AsyncMock, Mock
 
 from game.memory import GenAgentMemory
-from schema import GameStage, Memory
+from schema import ActionCompletion, GameStage, Memory
 
 
 async def test_add_uses_llm():
@@ -126,3 +126,58 @@ async def test_multi_query_retrieve():
     unittest.TestCase().assertCountEqual(
         relevant_memories, [memories[0], memories[2], memories[4]]
     )
+
+
+async def test_add_memories_rates_in_one_call():
+    retriever: Any = Mock()
+    llm: Any = AsyncMock()
+
+    gen_agent_memory = GenAgentMemory(llm, 5, retriever)
+
+    memories = [Memory(description=str(i)) for i in range(3)]
+    memories.append(Memory(description="rated", importance=4, embedding=[3.0, 4.0]))
+
+    llm.structured_completion.return_value = ActionCompletion(
+        action="RateMemories", args={"ratings": [0, 5, 9]}
+    )
+    llm.embed_many.return_value = [[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]]
+
+    await gen_agent_memory.add_memories(memories)
+
+    assert llm.structured_completion.call_count == 1
+    llm.embed_many.assert_called_once_with(["0", "1", "2"])
+    llm.digit_completions.assert_not_called()
+    assert [m.importance for m in memories] == [1, 6, 10, 4]
+    assert memories[2].embedding == [1.0, 1.0]
+    assert memories[3].embedding == [3.0, 4.0]
+    assert retriever.add_memory.call_count == 4
+
+
+async def test_add_memories_falls_back_per_item():
+    retriever: Any = Mock()
+    llm: Any = AsyncMock()
+
+    gen_agent_memory = GenAgentMemory(llm, 5, retriever)
+
+    memories = [Memory(description=str(i), embedding=[1.0]) for i in range(3)]
+
+    llm.structured_completion.return_value = ActionCompletion(
+        action="RateMemories", args={"ratings": [2, "oops", 12]}
+    )
+    llm.digit_completions.return_value = [7]
+    llm.embed_many.return_value = []
+
+    await gen_agent_memory.add_memories(memories)
+
+    assert llm.digit_completions.call_count == 2
+    assert [m.importance for m in memories] == [3, 8, 8]
+
+    # Unparseable batch response rates everything individually.
+    llm.structured_completion.return_value = None
+    llm.digit_completions.reset_mock()
+    memories = [Memory(description=str(i), embedding=[1.0]) for i in range(2)]
+
+    await gen_agent_memory.add_memories(memories)
+
+    assert llm.digit_completions.call_count == 2
+    assert [m.importance for m in memories] == [8, 8]
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+from typing import Any
+from unittest.mock import AsyncMock
+
+from llm.openai import OpenAIInterface, Singleton
+from schema import Message
+
+
+def create_interface(structured_output: bool) -> Any:
+    Singleton.delete_all_instances()
+    interface: Any = OpenAIInterface(
+        user_api_key="test", structured_output=structured_output
+    )
+    interface._client = AsyncMock()
+    return interface
+
+
+def completion_of(content: Any = None, tool_call: Any = None) -> Any:
+    message = SimpleNamespace(
+        content=content, tool_calls=[tool_call] if tool_call else None
+    )
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def tool_call_of(name: str, arguments: str) -> Any:
+    return SimpleNamespace(function=SimpleNamespace(name=name, arguments=arguments))
+
+
+async def test_structured_action_is_one_round_trip():
+    interface = create_interface(structured_output=True)
+    create = interface._client.chat.completions.create
+    create.return_value = completion_of(
+        tool_call=tool_call_of("Rate", '{"rating": "Very."}')
+    )
+
+    completion = await interface.structured_completion(
+        [Message(role="user", content="How happy?")],
+        {"name": "Rate", "parameters": {}},
+    )
+
+    assert completion and completion.args == {"rating": "Very."}
+    assert create.call_count == 1
+    kwargs = create.call_args.kwargs
+    assert kwargs["tool_choice"] == {"type": "function", "function": {"name": "Rate"}}
+    assert kwargs["tools"][0]["type"] == "function"
+    assert interface.metrics.stats["structured"].calls == 1
+
+
+async def test_retries_dont_mutate_messages():
+    interface = create_interface(structured_output=False)
+    create = interface._client.chat.completions.create
+    create.side_effect = [
+        completion_of(content="I won't."),
+        completion_of(tool_call=tool_call_of("attack", "{}")),
+    ]
+
+    messages = [Message(role="user", content="Attack!")]
+    completion = await interface.action_completion(messages, [{"name": "attack"}])
+
+    assert completion and completion.action == "attack"
+    assert len(messages) == 1
+    assert interface.metrics.stats["action"].retries == 1
+    assert interface.metrics.stats["action"].failures == 0
+
+
+async def test_structured_digit():
+    interface = create_interface(structured_output=True)
+    create = interface._client.chat.completions.create
+    create.return_value = completion_of(tool_call=tool_call_of("Digit", '{"digit": 7}'))
+
+    digits = await interface.digit_completions([[Message(role="user", content="?")]])
+
+    assert digits == [7]
+    assert create.call_count == 1
@@ -0,0 +1,41 @@
+from game.prompt_helpers import CompiledPrompt, get_system_prompt
+from schema import AgentDef, Conversation, Knowledge, Memory
+
+
+def create_knowledge() -> Knowledge:
+    return Knowledge(
+        game_description="A medieval kingdom",
+        agent_def=AgentDef(
+            name="King",
+            description="King is King of all lands and all people.",
+            core_facts="He has a dog named Biscuit.",
+            instructions="Speak like {knowledge.agent_def.name}.",
+        ),
+        shared_lore=[],
+    )
+
+
+def test_memories_come_after_static_prefix():
+    knowledge = create_knowledge()
+    conversation = Conversation(scene_description="The throne room")
+    compiled = CompiledPrompt(knowledge, conversation)
+
+    without_memories = compiled.system_prompt([]).content
+    with_memories = compiled.system_prompt(
+        [Memory(description="The {harvest} failed.", client_id="1")]
+    ).content
+
+    assert with_memories.startswith(without_memories)
+    assert "The {harvest} failed.[memory_id]1[/memory_id]" in with_memories
+    assert "Speak like King." in without_memories
+    assert "The throne room" in without_memories
+
+
+def test_matches_uncompiled_prompt():
+    knowledge = create_knowledge()
+    memories = [Memory(description="I usurped the previous king.")]
+    compiled = CompiledPrompt(knowledge, Conversation())
+
+    assert compiled.system_prompt(memories) == get_system_prompt(
+        knowledge, Conversation(), memories
+    )
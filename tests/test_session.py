@@ -0,0 +1,68 @@
+import pickle
+import uuid
+from typing import Any, List
+from unittest.mock import MagicMock
+
+import pytest
+
+from game.session import Session
+from schema import AgentDef, GameDef
+
+
+def create_gen_agent(agent_def: AgentDef) -> Any:
+    gen_agent = MagicMock()
+    gen_agent.uuid = agent_def.uuid
+    gen_agent.name = agent_def.name
+    return gen_agent
+
+
+def create_session(names: List[str]) -> Session:
+    agent_defs = [AgentDef(name=name) for name in names]
+    return Session(
+        uuid=uuid.uuid4(),
+        game_def=GameDef(name="Game", agents=agent_defs),
+        agents=[create_gen_agent(agent_def) for agent_def in agent_defs],
+    )
+
+
+def test_get_agent_by_uuid_or_name():
+    session = create_session(["King", "Serf"])
+    king, serf = session.agents
+
+    assert session.get_agent(str(serf.uuid)) is serf
+    assert session.get_agent("King") is king
+    assert session.get_agent("Noble") is None
+    assert session.get_agent_def("Serf") is session.game_def.agents[1]
+
+
+def test_ambiguous_name_raises():
+    session = create_session(["Guard", "Guard"])
+
+    with pytest.raises(ValueError, match="Guard"):
+        session.get_agent("Guard")
+    with pytest.raises(ValueError, match="Guard"):
+        session.get_agent_def("Guard")
+    assert session.get_agent(str(session.agents[1].uuid)) is session.agents[1]
+
+
+def test_reindex_after_rename():
+    session = create_session(["King"])
+    session.agents[0].name = "Queen"
+    session.game_def.agents[0].name = "Queen"
+
+    session.reindex()
+
+    assert session.get_agent("King") is None
+    assert session.get_agent("Queen") is session.agents[0]
+
+
+def test_index_survives_pickling():
+    session = Session(
+        uuid=uuid.uuid4(),
+        game_def=GameDef(name="Game", agents=[AgentDef(name="King")]),
+        agents=[],
+    )
+
+    restored = pickle.loads(pickle.dumps(session))
+
+    assert restored.get_agent_def("King") == session.game_def.agents[0]
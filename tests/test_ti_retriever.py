@@ -146,3 +146,24 @@ def test_many_memory_importance_retrieval():
         memories, [king_memory1, king_memory2, king_memory3]
     )
     unittest.TestCase().assertCountEqual(scores, [3.0, 3.0, 3.0])
+
+
+def test_remove_memories():
+    ret = TIRetriever(MemoryConfig(embedding_dims=2))
+    memories = [
+        Memory(importance=i + 1, description=str(i), embedding=[float(i), 1.0])
+        for i in range(12)
+    ]
+    for memory in memories:
+        ret.add_memory(memory)
+
+    ret.remove_memories([memories[0], memories[5]])
+
+    assert [memory.description for memory in ret.get_all_memory()] == [
+        str(i) for i in range(12) if i not in (0, 5)
+    ]
+    [(best, _)] = ret.get_relevant_memories(
+        Memory(description="q", embedding=[1.0, 0.0]), 1
+    )
+    assert best is memories[11]
+    assert ret.get_similarities([[0.0, 1.0]]).shape == (1, 10)